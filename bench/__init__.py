@@ -0,0 +1,88 @@
+'''bench/__init__.py -- benchmarks for stackpm
+
+   Run each from the top of the source tree, e.g.:
+
+     python -m bench.simulations
+
+   Benchmarks run against the in-memory database and fake connector of the
+   test suite (see tests/__init__.py), loaded with a synthetic portfolio by
+   load_portfolio. Timed benchmarks report the best wall-clock time of
+   several runs (see best_of).
+
+   functions: load_portfolio, best_of
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import random
+import time
+from datetime import datetime, date, timedelta
+
+### INTERNAL IMPORTS
+# NB: tests sets STACKPM_CONFIG to the test suite's config
+from tests import fake_link, iteration, task
+from stackpm import db, sync
+from stackpm.models import Iteration
+
+### GLOBALS
+EFFORTS = ('S', 'M', 'L')
+
+### EXPOSED METHODS
+def load_portfolio(iters=10, tasks=20, users=8, history=40, days=120,
+                   seed=0):
+    '''Create an empty database, and sync ``iters`` iterations of ``tasks``
+       open tasks each, shared among ``users``, who each finished
+       ``history`` tasks over the last ``days`` days. Return the
+       iterations, in rank order.'''
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    today = datetime.combine(date.today(), datetime.min.time())
+    first = today - timedelta(days=days)
+    emails = ['dev{}@example.com'.format(u) for u in range(users)]
+
+    items = []
+    for email in emails:
+        for n in range(history):
+            started = first + timedelta(days=rng.randint(0, days - 20))
+            dev_done = started + timedelta(days=rng.randint(1, 10))
+            items.append(task('{}-DONE-{}'.format(email.split('@')[0], n),
+                              email, iteration_ext_id='DONE',
+                              effort_est=rng.choice(EFFORTS),
+                              created_on=started, updated_on=started,
+                              started_on=started, dev_done_on=dev_done,
+                              prod_done_on=dev_done + timedelta(days=1)))
+    for i in range(iters):
+        for n in range(tasks):
+            started = None
+            if n < tasks // 4:
+                started = today - timedelta(days=rng.randint(1, 5))
+            items.append(task('IT{}-{}'.format(i, n), rng.choice(emails),
+                              iteration_ext_id='IT{}'.format(i), rank=n,
+                              effort_est=rng.choice(EFFORTS),
+                              created_on=first, updated_on=first,
+                              started_on=started))
+
+    fake_link().reset()
+    fake_link().load(iterations=[iteration('DONE', rank=0, created_on=first,
+                                           updated_on=first)] + [
+                         iteration('IT{}'.format(i), rank=i + 1,
+                                   created_on=first, updated_on=first)
+                             for i in range(iters)],
+                     tasks=items)
+    sync.sync_tasks()
+    sync.sync_stats()
+    return Iteration.query.filter(Iteration.ext_id != 'DONE')\
+                          .order_by(Iteration.rank).all()
+
+def best_of(fn, repeat=5):
+    '''Return the best wall-clock seconds of ``repeat`` calls to ``fn``'''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+__all__ = ['EFFORTS', 'load_portfolio', 'best_of']
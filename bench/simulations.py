@@ -0,0 +1,72 @@
+'''bench/simulations.py -- simulation CPU time, fixed vs adaptive plays
+
+   Forecasts every iteration of a synthetic portfolio for each of the last
+   ``days`` days, with a fixed play count and adaptively, to within
+   ``tolerance`` days (see stats.forecast), and reports the CPU time and
+   plays of each, e.g.:
+
+     python -m bench.simulations --iters 10 --tasks 20 --days 5
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import argparse
+import os
+import sys
+from datetime import datetime, date, timedelta
+
+### INTERNAL IMPORTS
+from bench import load_portfolio
+from stackpm import config
+from stackpm.stats import forecast
+
+### INTERNAL METHODS
+def _cpu():
+    '''Return the user and system CPU seconds used by this process'''
+    times = os.times()
+    return times[0] + times[1]
+
+def _run(iters, since, until, **kwargs):
+    '''Return a tuple of length 3 of the CPU seconds, total plays and
+       simulations of forecasting every iteration in ``iters``'''
+    start, plays, sims = _cpu(), 0, 0
+    for iter_ in iters:
+        for sim in forecast(iter_, since, until, **kwargs):
+            plays += sim['plays']
+            sims += 1
+    return _cpu() - start, plays, sims
+
+### EXPOSED METHODS
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--plays', type=int, default=1000)
+    parser.add_argument('--tolerance', type=float, default=2)
+    parser.add_argument('--max-plays', type=int, default=10000)
+    args = parser.parse_args(argv)
+    config['forecast'] = dict(config.get('forecast', {}),
+                              tolerance=args.tolerance,
+                              max_plays=args.max_plays)
+
+    iters = load_portfolio(args.iters, args.tasks, args.users)
+    until = datetime.combine(date.today(), datetime.min.time())
+    since = until - timedelta(days=args.days - 1)
+
+    sys.stdout.write('{} iterations x {} tasks, {} users, {} days, '
+                     'tolerance {} days\n'.format(args.iters, args.tasks,
+                                                  args.users, args.days,
+                                                  args.tolerance))
+    for name, kwargs in (('fixed', {'plays': args.plays, 'adaptive': False}),
+                         ('adaptive', {'adaptive': True})):
+        cpu, plays, sims = _run(iters, since, until, **kwargs)
+        sys.stdout.write('{:<10}{:>8.2f}s cpu{:>8} sims{:>10.0f} '
+                         'plays/sim\n'.format(name, cpu, sims,
+                                              plays/float(sims or 1)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
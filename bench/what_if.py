@@ -0,0 +1,56 @@
+'''bench/what_if.py -- latency of what-if forecasts against a warm model
+
+   Builds a stats.WhatIf of a synthetic portfolio, then times simulate for
+   each kind of edit, e.g.:
+
+     python -m bench.what_if --iters 10 --tasks 20 --plays 1000
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import argparse
+import sys
+from datetime import datetime, date
+
+### INTERNAL IMPORTS
+from bench import load_portfolio, best_of
+from stackpm.stats import WhatIf
+
+### EXPOSED METHODS
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--plays', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    iters = load_portfolio(args.iters, args.tasks, args.users)
+    day = datetime.combine(date.today(), datetime.min.time())
+    models = []
+    build = best_of(lambda: models.append(
+                        WhatIf(iters, day, plays=args.plays,
+                               adaptive=False)), 1)
+    model = models[0]
+
+    first, last = iters[0].ext_id, iters[-1].ext_id
+    edits = [
+        ('reassign', [('reassign', first + '-0', 'dev0@example.com')]),
+        ('estimate', [('estimate', first + '-1', 'L')]),
+        ('remove', [('remove', last + '-2')]),
+        ('block', [('block', first + '-3', last + '-3')]),
+        ('remove x3', [('remove', '{}-{}'.format(first, n))
+                           for n in range(4, 7)]),
+    ]
+    sys.stdout.write('{} iterations x {} tasks, {} users, {} plays\n'.format(
+                         args.iters, args.tasks, args.users, args.plays))
+    sys.stdout.write('{:<12}{:>8.1f}ms\n'.format('build', build*1000))
+    for name, edit in edits:
+        elapsed = best_of(lambda: model.simulate(edit), args.repeat)
+        sys.stdout.write('{:<12}{:>8.1f}ms\n'.format(name, elapsed*1000))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
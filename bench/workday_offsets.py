@@ -0,0 +1,67 @@
+'''bench/workday_offsets.py -- converting workday offsets to dates
+
+   Times calendars.workday_offsets on an array of random fractional
+   offsets, on one calendar and on a calendar per user, against a
+   workdays.workday loop over a sample of them, e.g.:
+
+     python -m bench.workday_offsets --offsets 1000000
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import argparse
+import math
+import sys
+from datetime import datetime, timedelta
+
+### 3RD PARTY IMPORTS
+import numpy
+from workdays import workday
+
+### INTERNAL IMPORTS
+from bench import best_of
+from stackpm import calendars
+
+### EXPOSED METHODS
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--offsets', type=int, default=10**6)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--sample', type=int, default=10**4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rng = numpy.random.RandomState(0)
+    start = datetime(2015, 1, 5)
+    offsets = rng.uniform(0, 60, args.offsets)
+    keys = rng.randint(0, args.users, args.offsets)
+    holidays = [start + timedelta(days=d) for d in range(0, 90, 11)]
+    days_off = dict([(k, calendars.dates(holidays + [
+                                             start + timedelta(days=k + 7*w)
+                                                 for w in range(8)]))
+                         for k in range(args.users)])
+
+    one = best_of(lambda: calendars.workday_offsets(
+                              start, offsets, calendars.dates(holidays)),
+                  args.repeat)
+    per_user = best_of(lambda: calendars.workday_offsets(
+                                   start, offsets, days_off, keys=keys),
+                       args.repeat)
+    sample = offsets[:args.sample]
+    loop = best_of(lambda: [workday(start, int(math.ceil(o)),
+                                    holidays=holidays) for o in sample], 1)
+
+    sys.stdout.write('{} offsets, {} users\n'.format(args.offsets,
+                                                      args.users))
+    sys.stdout.write('{:<26}{:>10.1f}ms\n'.format(
+                         'workday_offsets', one*1000))
+    sys.stdout.write('{:<26}{:>10.1f}ms\n'.format(
+                         'workday_offsets per user', per_user*1000))
+    sys.stdout.write('{:<26}{:>10.1f}ms (from {} calls)\n'.format(
+                         'workdays.workday loop',
+                         loop*1000*args.offsets/len(sample), len(sample)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
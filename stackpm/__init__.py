@@ -4,6 +4,10 @@
 
      python -m stackpm.app
 
+   To serve stackpm, e.g. with gunicorn:
+
+     gunicorn 'stackpm:create_app()'
+
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)
    @depends: flask, flask-sqlalchemy, numpy, requests, sqlite3, gunicorn
@@ -14,15 +18,36 @@
 # default sentinel for use across modules and sub-packages
 null = object()
 
-# imports for exposing at package level
-from app import stackpm_app, config, db
-
-import fields
-import models
-import links
-import stats
-import estimates
-import sync
-
-__all__ = ['null', 'stackpm_app', 'config', 'db', 'models', 'fields',
-           'links', 'sync', 'stats', 'estimates']
+# imports for exposing at package level, nothing here loads config, connects
+# to the database or imports a connector -- all are deferred to first use,
+# sub-modules are imported as needed, e.g. import stackpm.sync
+from settings import config
+
+class _AppProxy(object):
+    '''Proxy to object ``name`` of stackpm.app, which is imported on first
+       use, so that importing stackpm does not import flask'''
+    def __init__(self, name):
+        self.__name = name
+
+    def __repr__(self):
+        return '<AppProxy {}>'.format(self.__name)
+
+    def __getattr__(self, name):
+        # e.g. copy and pickle probe instances that were never initialized
+        if name.startswith('_AppProxy__'):
+            raise AttributeError(name)
+        import app
+        return getattr(getattr(app, self.__name), name)
+
+def create_app():
+    '''Configure and return the stackpm flask app, see app.create_app'''
+    import app
+    return app.create_app()
+
+stackpm_app = _AppProxy('stackpm_app')
+db = _AppProxy('db')
+
+__all__ = ['null', 'stackpm_app', 'config', 'db', 'create_app', 'settings',
+           'instrument', 'querylog', 'models', 'fields', 'links', 'sync',
+           'calendars', 'simulate', 'stats', 'estimates', 'api', 'daemon',
+           'columnar', 'migrate']
@@ -0,0 +1,311 @@
+'''stackpm/api.py -- JSON read API for stackpm
+
+   Every response is cached in-process, keyed by the most recent Sync, and
+   carries an ETag derived from that key, so repeat reads between syncs cost
+   a single indexed lookup (or a 304) rather than a scan. Responses cached
+   before the most recent Sync, recorded by any process, are evicted on the
+   next miss, as are the least recently used beyond [server] cache_size.
+   What-if forecasts are run against warm models (see stats.WhatIf), kept
+   until the next Sync.
+
+   Tasks pushed by the project_manager link's webhooks are queued, and
+   synced in micro-batches in the background (see daemon.PushWorker).
+
+   functions: invalidate, cached, user_stats, iteration_snapshot,
+              iteration_simulations, iteration_what_if, project_manager_hook
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import hashlib
+import hmac
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, time
+
+### 3RD PARTY IMPORTS
+from flask import Response, request, abort
+from sqlalchemy import event
+
+### INTERNAL IMPORTS
+from . import stackpm_app, db, config
+from .models import User, Iteration, Task, Stat, StatWindow, Simulation, \
+                    Sync
+from .simulate import Summary, CycleError
+from .stats import WhatIf
+from .links import project_manager as pm
+from .sync import push_tasks
+from .daemon import start_push_worker
+
+### GLOBALS
+API_DATE_FMT = '%Y-%m-%d'
+CACHE_SIZE_DFLT = 1024
+
+# (sync_key, path) => (etag, body), least recently used first
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+# (sync_key, iteration id, or None for the portfolio) => stats.WhatIf
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+### INTERNAL METHODS
+def _sync_key():
+    '''Return a hashable key identifying the most recent Sync, changes to
+       which invalidate every cached response.'''
+    last_sync = Sync.query.order_by(Sync.id.desc()).first()
+    if last_sync is None:
+        return None
+    return (last_sync.id, last_sync.last_seen_update.isoformat())
+
+def _etag(sync_key, path):
+    '''Return a strong ETag for ``path`` as of ``sync_key``'''
+    return hashlib.md5(repr((sync_key, path))).hexdigest()
+
+def _jsonable(val):
+    '''json.dumps default hook for the types stackpm models expose'''
+    if isinstance(val, (datetime, date)):
+        return val.isoformat()
+    elif isinstance(val, User):
+        return val.email
+    elif isinstance(val, Iteration):
+        return val.ext_id
+    elif isinstance(val, Summary):
+        return val.as_dict()
+    elif isinstance(val, db.Model):
+        return _row(val)
+    raise TypeError('{!r} is not JSON serializable'.format(val))
+
+def _row(obj, dels=tuple()):
+    '''Return a dict of the column values of ``obj``'''
+    return {c.name:getattr(obj, c.name) for c in obj.__table__.columns
+                if c.name not in dels}
+
+def _date_arg(name):
+    '''Parse an optional date query argument, 400 on bad input'''
+    val = request.args.get(name)
+    if val is None:
+        return None
+    try:
+        return datetime.strptime(val, API_DATE_FMT)
+    except ValueError:
+        abort(400)
+
+def _cache_get(key):
+    '''Return the cached (etag, body) of ``key``, marking it most recently
+       used, or None'''
+    with _CACHE_LOCK:
+        hit = _CACHE.pop(key, None)
+        if hit is not None:
+            _CACHE[key] = hit
+        return hit
+
+def _cache_put(key, hit):
+    '''Cache (etag, body) ``hit`` as ``key``, evicting every response
+       cached as of another Sync, then the least recently used beyond
+       [server] cache_size'''
+    size = config.get('server', {}).get('cache_size') or CACHE_SIZE_DFLT
+    with _CACHE_LOCK:
+        for stale in [k for k in _CACHE if k[0] != key[0]]:
+            del _CACHE[stale]
+        _CACHE[key] = hit
+        while len(_CACHE) > size:
+            _CACHE.popitem(last=False)
+
+def cached(view):
+    '''Decorate a view returning a JSON-able object, caching its encoded
+       body by the latest Sync and honoring If-None-Match.'''
+    def cached_view(*args, **kwargs):
+        sync_key = _sync_key()
+        path = request.full_path
+        etag = _etag(sync_key, path)
+        if etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': '"{}"'.format(etag)})
+
+        hit = _cache_get((sync_key, path))
+        if hit is None:
+            body = json.dumps(view(*args, **kwargs), default=_jsonable)
+            _cache_put((sync_key, path), (etag, body))
+        else:
+            etag, body = hit
+
+        resp = Response(body, mimetype='application/json')
+        resp.set_etag(etag)
+        return resp
+
+    cached_view.__name__ = view.__name__
+    cached_view.__doc__ = view.__doc__
+    return cached_view
+
+def _window_stats(user, since, until):
+    '''Return the trailing-window stat series of the ``window`` query
+       argument for ``user``, for user_stats'''
+    try:
+        window = int(request.args['window'])
+    except ValueError:
+        abort(400)
+    query = StatWindow.query.filter(db.and_(StatWindow.user == user,
+                                            StatWindow.window == window))
+    if 'effort_est' in request.args:
+        query = query.filter(StatWindow.effort_est == \
+                             (request.args['effort_est'] or None))
+
+    series = {}
+    for stat_window in query.all():
+        series[stat_window.effort_est] = stat_window.rows(since, until)
+    return {'user': user.email, 'window': window, 'stats': series}
+
+def _what_if_model(iter_):
+    '''Return a warm WhatIf model including ``iter_`` as of today, built
+       once per Sync. In a portfolio, the model is of every iteration with
+       unfinished tasks, as for sync.sync_simulations.'''
+    sync_key = _sync_key()
+    portfolio = config.get('forecast', {}).get('portfolio', False)
+    key = (sync_key, None if portfolio else iter_.id)
+    with _MODELS_LOCK:
+        if key not in _MODELS:
+            for stale in [k for k in _MODELS if k[0] != sync_key]:
+                del _MODELS[stale]
+            iters = [iter_]
+            if portfolio:
+                iters = Iteration.query.join(
+                            Task, Task.iteration_id == Iteration.id).filter(
+                            Task.prod_done_on == None).distinct().all()
+            _MODELS[key] = WhatIf(iters,
+                                  datetime.combine(date.today(), time()))
+        return _MODELS[key]
+
+def _invalidate_on_sync(mapper, connection, target):
+    '''SQLAlchemy after_insert hook, a new Sync row voids all responses'''
+    invalidate()
+
+### EXPOSED METHODS
+def invalidate():
+    '''Drop every cached response and warm model.'''
+    with _CACHE_LOCK:
+        _CACHE.clear()
+    with _MODELS_LOCK:
+        _MODELS.clear()
+
+@stackpm_app.route('/api/stats/<email>')
+@cached
+def user_stats(email):
+    '''Return the daily Stat series for a user, optionally constrained by
+       ``effort_est``, ``since`` and ``until`` query arguments. If the
+       ``window`` query argument is passed, return the series of stats over
+       a trailing window of that many days instead (see StatWindow).'''
+    user = User.query.filter_by(email=email).first_or_404()
+    since, until = _date_arg('since'), _date_arg('until')
+    if 'window' in request.args:
+        return _window_stats(user, since, until)
+
+    query = Stat.query.filter(Stat.user == user)
+    if 'effort_est' in request.args:
+        query = query.filter(Stat.effort_est == \
+                             (request.args['effort_est'] or None))
+    if since is not None:
+        query = query.filter(Stat.as_of >= since)
+    if until is not None:
+        query = query.filter(Stat.as_of <= until)
+
+    series = {}
+    for stat in query.order_by(Stat.as_of).all():
+        series.setdefault(stat.effort_est, []).append(
+            _row(stat, dels=('id', 'user_id', 'effort_est')))
+    return {'user': email, 'stats': series}
+
+@stackpm_app.route('/api/iterations/<ext_id>')
+@cached
+def iteration_snapshot(ext_id):
+    '''Return an iteration as it existed on the ``as_of`` query argument,
+       or as it exists now.'''
+    iter_ = Iteration.query.filter_by(ext_id=ext_id).first_or_404()
+    snapshot = iter_.as_of(_date_arg('as_of'))
+    if snapshot is None:
+        abort(404)
+    for task in snapshot['tasks']:
+        for key in [k for k in task if k.startswith('_')]:
+            del task[key]
+    return snapshot
+
+@stackpm_app.route('/api/iterations/<ext_id>/simulations')
+@cached
+def iteration_simulations(ext_id):
+    '''Return simulations of an iteration, optionally constrained by
+       ``since`` and ``until`` query arguments.'''
+    iter_ = Iteration.query.filter_by(ext_id=ext_id).first_or_404()
+    query = Simulation.query.filter(Simulation.iteration == iter_)
+    since, until = _date_arg('since'), _date_arg('until')
+    if since is not None:
+        query = query.filter(Simulation.simulation_on >= since)
+    if until is not None:
+        query = query.filter(Simulation.simulation_on <= until)
+
+    sims = []
+    for sim in query.options(db.subqueryload(Simulation.users))\
+                    .order_by(Simulation.simulation_on).all():
+        row = _row(sim, dels=('iteration_id',))
+        row['users'] = sim.users
+        sims.append(row)
+    return {'iteration': ext_id, 'simulations': sims}
+
+@stackpm_app.route('/api/iterations/<ext_id>/what-if',
+                   methods=['POST'])
+def iteration_what_if(ext_id):
+    '''Return today's simulation of an iteration, and its simulation with
+       the ``edits`` of the posted JSON object applied, e.g.:
+
+         {"edits": [["reassign", "TASK-123", "alice@example.com"],
+                    ["remove", "TASK-124"]]}
+
+       See stats.WhatIf.simulate for the edits available. Edits which
+       introduce a dependency cycle are a 409 Conflict.'''
+    iter_ = Iteration.query.filter_by(ext_id=ext_id).first_or_404()
+    edits = (request.get_json(silent=True) or {}).get('edits')
+    if not isinstance(edits, list) or \
+            not all([isinstance(e, list) and e for e in edits]):
+        abort(400)
+    try:
+        model = _what_if_model(iter_)
+        sims = model.simulate(edits)
+    except CycleError as e:
+        return Response(json.dumps({'error': str(e), 'cycle': e.keys}),
+                        status=409, mimetype='application/json')
+    except ValueError as e:
+        return Response(json.dumps({'error': str(e)}), status=400,
+                        mimetype='application/json')
+
+    body = {'iteration': ext_id, 'baseline': model.baseline.get(iter_.id),
+            'what_if': sims.get(iter_.id)}
+    return Response(json.dumps(body, default=_jsonable),
+                    mimetype='application/json')
+
+@stackpm_app.route('/api/hooks/project_manager', methods=['POST'])
+def project_manager_hook():
+    '''Queue the task carried by a project_manager link webhook, e.g. a
+       Jira issue created or updated event, for sync. If [webhooks] token
+       is set, it must be passed as the token query argument.'''
+    token = config.get('webhooks', {}).get('token')
+    if token and not hmac.compare_digest(str(request.args.get('token', '')),
+                                         str(token)):
+        abort(403)
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400)
+    try:
+        task = pm.hook_task(payload)
+    except (KeyError, ValueError, TypeError) as e:
+        return Response(json.dumps({'error': 'bad payload: {!r}'.format(e)}),
+                        status=400, mimetype='application/json')
+
+    queued = push_tasks([task]) if task is not None else 0
+    if queued:
+        start_push_worker()
+    return Response(json.dumps({'queued': queued}), status=202,
+                    mimetype='application/json')
+
+event.listen(Sync, 'after_insert', _invalidate_on_sync)
+
+__all__ = ['API_DATE_FMT', 'CACHE_SIZE_DFLT', 'invalidate', 'cached',
+           'user_stats', 'iteration_snapshot', 'iteration_simulations',
+           'iteration_what_if', 'project_manager_hook']
@@ -1,48 +1,64 @@
-'''stackpm/app.py -- config and flask application setup for stackpm.
+'''stackpm/app.py -- flask application setup for stackpm.
 
+   Nothing is loaded on import. The flask app is configured, its routes
+   registered and db bound to it on first use of db (or a call to
+   create_app). Config is read on first use of config (see settings). The
+   stackpm package imports this module on first use of stackpm_app, db or
+   create_app, so that modules needing none of them import without flask.
+
+   classes: LazySQLAlchemy
    objects: stackpm_app, config, db
+   functions: create_app
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)'''
 
 ### STANDARD LIBRARY IMPORTS
-import os
+import threading
 
 ### 3RD PARTY IMPORTS
-import betterconfig
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 
+### INTERNAL IMPORTS
+from .settings import config
+
 ### GLOBALS
-STACKPM_CONFIG_ENV = 'STACKPM_CONFIG'
-STACKPM_CONFIG_DFLT = '/etc/stackpm.cfg'
-
-def setup():
-    ### load config
-    config = betterconfig.load(os.environ.get(STACKPM_CONFIG_ENV,
-                                              STACKPM_CONFIG_DFLT))
-    config['SQLALCHEMY_DATABASE_URI'] = config.pop('db', None)
-    config.setdefault('debug', False)
-
-    ### configure flask app
-    stackpm_app = Flask('stackpm')
-    stackpm_app.config.update(config)
-    if config['debug']:
-        stackpm_app.debug = True
-
-    ### configure database
-    db = SQLAlchemy(stackpm_app)
-
-    ### expose globals
-    globals().update({
-        'config': config,
-        'stackpm_app': stackpm_app,
-        'db': db,
-    })
-
-### DO SETUP
-setup()
-del setup
+# guards create_app, which may be triggered from any thread's first query
+_SETUP_LOCK = threading.RLock()
+
+### EXPOSED CLASSES
+class LazySQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy, which sets up the stackpm app (see create_app) the first
+       time it is used outside of an application context'''
+    def get_app(self, reference_app=None):
+        if reference_app is None and self.app is None:
+            create_app()
+        return super(LazySQLAlchemy, self).get_app(reference_app)
+
+### EXPOSED METHODS
+def create_app():
+    '''Configure and return the stackpm flask app, with db bound to it and
+       all routes registered. Only the first call does any work.'''
+    with _SETUP_LOCK:
+        if db.app is None:
+            stackpm_app.config.update(config)
+            if config['debug']:
+                stackpm_app.debug = True
+            db.init_app(stackpm_app)
+            db.app = stackpm_app
+
+            # register routes
+            from . import api
+    return stackpm_app
+
+### EXPOSED OBJECTS
+stackpm_app = Flask('stackpm')
+db = LazySQLAlchemy()
+
+__all__ = ['LazySQLAlchemy', 'create_app', 'config', 'stackpm_app', 'db']
 
 if __name__ == '__main__':
-    stackpm_app.run(host=config['server']['host'],
-                    port=config['server']['port'])
+    # run the package's app, rather than this module's __main__ copy
+    from stackpm import create_app, config
+    create_app().run(host=config['server']['host'],
+                     port=config['server']['port'])
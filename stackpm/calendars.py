@@ -0,0 +1,80 @@
+'''stackpm/calendars.py -- vectorized work calendar arithmetic for stackpm
+
+   Bulk counterparts to workdays.workday, for converting many workday
+   offsets to dates at once, e.g. the completion dates of every play of a
+   simulation.
+
+   functions: dates, ordinals, workday_offsets
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+from datetime import date
+
+### 3RD PARTY IMPORTS
+import numpy
+
+### GLOBALS
+WEEKMASK = '1111100'
+MINUTES_PER_DAY = 24*60
+
+# datetime64[D] counts days from 1970-01-01, date ordinals from 0001-01-01
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+### EXPOSED METHODS
+def dates(days):
+    '''Return a sorted datetime64[D] array of an iterable of dates or
+       datetimes, suitable for use as days_off with workday_offsets'''
+    return numpy.array(sorted([getattr(d, 'date', lambda: d)() for d in days]),
+                       dtype='datetime64[D]')
+
+def ordinals(datetimes):
+    '''Return an int64 array of the date ordinals of a datetime64 array'''
+    return numpy.asarray(datetimes).astype('datetime64[D]')\
+                .astype(numpy.int64) + _EPOCH_ORDINAL
+
+def workday_offsets(starts, offsets, days_off=None, keys=None,
+                    weekmask=WEEKMASK):
+    '''Return a datetime64[m] array of the dates ``offsets`` workdays from
+       ``starts``, skipping weekends and ``days_off``.
+
+       Whole offsets are counted as for workdays.workday. Fractional
+       offsets complete part way through the following workday, so the date
+       of a fractional offset is that of its ceiling.
+
+       ``starts`` is a single date, or an array-like of dates correlated
+       with ``offsets``. ``days_off`` is either an array-like of dates not
+       worked, or, when ``keys`` is passed, a dict mapping each key in
+       ``keys`` to such an array-like, so that each offset is counted on the
+       calendar of the user it belongs to.
+
+       10^6 offsets take about 150ms on one calendar, and 350ms on a
+       calendar for each of 8 users, where a workdays.workday loop takes
+       about 16s (see bench.workday_offsets).'''
+    offsets = numpy.asarray(offsets, dtype=numpy.float64)
+    starts = numpy.asarray(starts, dtype='datetime64[us]')\
+                  .astype('datetime64[D]')
+    starts = numpy.broadcast_to(starts, offsets.shape)
+    whole = numpy.floor(offsets)
+    frac = offsets - whole
+    days = (whole + (frac > 0)).astype(numpy.int64)
+
+    if keys is None:
+        groups = [(Ellipsis, days_off)]
+    else:
+        keys = numpy.asarray(keys)
+        groups = [(keys == key, days_off[key]) for key in numpy.unique(keys)]
+
+    done = numpy.empty(offsets.shape, dtype='datetime64[D]')
+    for mask, key_days_off in groups:
+        # roll back so that non-workday starts count as workdays.workday
+        done[mask] = numpy.busday_offset(
+            starts[mask], days[mask], roll='backward', weekmask=weekmask,
+            holidays=dates([]) if key_days_off is None else key_days_off)
+
+    # zero offsets are done on start, workday or not
+    done = numpy.where(days == 0, starts, done).astype('datetime64[m]')
+    return done + numpy.round(numpy.where(frac > 0, frac, 0)*MINUTES_PER_DAY)\
+                       .astype('timedelta64[m]')
+
+__all__ = ['WEEKMASK', 'dates', 'ordinals', 'workday_offsets']
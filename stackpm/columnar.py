@@ -0,0 +1,266 @@
+'''stackpm/columnar.py -- columnar export and import of stackpm tables
+
+   Each table is exported to a directory holding one .npy file per column,
+   which numpy.load can memory map, so that analysis needs neither the ORM
+   nor the production database, e.g.:
+
+     export('/tmp/stackpm')
+     stat, vocabs = load('/tmp/stackpm', 'stat')
+     stat['dev_done_mean'][stat['user_id'] == 3]
+
+   Integers are stored as int64, booleans as bool, floats as float64 (NaN
+   for null) and datetimes as datetime64[us] (NaT for null). Null integers
+   and booleans are flagged in a <column>.null.npy mask. Strings, enums and
+   json are dictionary encoded, as int32 codes (-1 for null) into a
+   <column>.vocab.npy array, see decode.
+
+     python -m stackpm.columnar export|import <dir> [<table> ...]
+
+   functions: export, load, decode, restore, main
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import json
+import os
+import sys
+from datetime import datetime
+
+### 3RD PARTY IMPORTS
+import numpy
+from numpy.lib.format import open_memmap
+from sqlalchemy import select, func, bindparam, type_coerce
+
+### INTERNAL IMPORTS
+from . import db
+# DEPENDS models, for its tables
+from . import models
+
+### GLOBALS
+EXPORT_TABLES = ('user', 'iteration', 'task', 'event', 'stat',)
+CHUNK = 10000
+MANIFEST = 'columns.json'
+
+# kind => dtype of exported column
+_DTYPES = {
+    'int': numpy.int64,
+    'bool': numpy.bool_,
+    'float': numpy.float64,
+    'datetime': 'datetime64[us]',
+    'str': numpy.int32,
+}
+
+### INTERNAL METHODS
+def _raw_type(column):
+    '''Return the type ``column`` is stored as, bypassing any decorator'''
+    return getattr(column.type, 'impl', column.type)
+
+def _kind(column):
+    '''Return the kind of array ``column`` is exported as'''
+    type_ = _raw_type(column)
+    if isinstance(type_, db.Boolean):
+        return 'bool'
+    elif isinstance(type_, db.Integer):
+        return 'int'
+    elif isinstance(type_, db.Float):
+        return 'float'
+    elif isinstance(type_, db.DateTime):
+        return 'datetime'
+    return 'str'
+
+def _tables(names):
+    '''Return the tables named ``names``, in dependency order'''
+    names = set(names)
+    missing = names - set(db.metadata.tables)
+    if missing:
+        raise ValueError('No such tables: {}'.format(
+                             ', '.join(sorted(missing))))
+    return [t for t in db.metadata.sorted_tables if t.name in names]
+
+def _encode(kind, vals, vocab):
+    '''Return an array of kind ``kind`` of a list of values, and a null mask
+       or None, adding to ``vocab`` (value => code) for strings'''
+    if kind == 'str':
+        return numpy.array([-1 if v is None else
+                                vocab.setdefault(v, len(vocab))
+                            for v in vals], dtype=_DTYPES[kind]), None
+    elif kind in ('int', 'bool'):
+        return numpy.array([v or 0 for v in vals], dtype=_DTYPES[kind]), \
+               numpy.array([v is None for v in vals], dtype=numpy.bool_)
+    elif kind == 'float':
+        return numpy.array([numpy.nan if v is None else v for v in vals],
+                           dtype=_DTYPES[kind]), None
+    return numpy.array(vals, dtype=_DTYPES[kind]), None
+
+def _export_table(conn, table, table_dir, chunk):
+    '''Stream ``table`` into .npy files in ``table_dir``, in chunks of
+       ``chunk`` rows, and return the number of rows exported'''
+    columns = list(table.columns)
+    kinds = [_kind(c) for c in columns]
+    rows = conn.execute(select([func.count()]).select_from(table)).scalar()
+
+    arrays, masks, vocabs = {}, {}, {}
+    for column, kind in zip(columns, kinds):
+        path = os.path.join(table_dir, '{}.npy'.format(column.name))
+        arrays[column.name] = open_memmap(path, mode='w+',
+                                          dtype=_DTYPES[kind], shape=(rows,))
+        if kind in ('int', 'bool') and column.nullable:
+            masks[column.name] = open_memmap(
+                os.path.join(table_dir, '{}.null.npy'.format(column.name)),
+                mode='w+', dtype=numpy.bool_, shape=(rows,))
+        elif kind == 'str':
+            vocabs[column.name] = {}
+
+    # json and summaries are exported as stored, not decoded
+    query = select([type_coerce(c, _raw_type(c)) for c in columns])\
+                .order_by(*table.primary_key.columns)
+    result = conn.execution_options(stream_results=True).execute(query)
+    seen = 0
+    while seen < rows:
+        batch = result.fetchmany(min(chunk, rows - seen))
+        if not batch:
+            break
+        end = seen + len(batch)
+        for i,(column, kind) in enumerate(zip(columns, kinds)):
+            vals, nulls = _encode(kind, [r[i] for r in batch],
+                                  vocabs.get(column.name))
+            arrays[column.name][seen:end] = vals
+            if column.name in masks:
+                masks[column.name][seen:end] = nulls
+        seen = end
+    result.close()
+
+    for name, vocab in vocabs.iteritems():
+        words = [None] * len(vocab)
+        for word, code in vocab.iteritems():
+            words[code] = word
+        numpy.save(os.path.join(table_dir, '{}.vocab.npy'.format(name)),
+                   numpy.array(words, dtype=numpy.unicode_) if words else
+                       numpy.array([], dtype='U1'))
+    for array in arrays.values() + masks.values():
+        array.flush()
+
+    # rows may have been deleted since they were counted
+    with open(os.path.join(table_dir, MANIFEST), 'w') as manifest:
+        json.dump({'table': table.name, 'rows': seen,
+                   'exported_on': datetime.now().isoformat(),
+                   'columns': [[c.name, k] for c,k in zip(columns, kinds)]},
+                  manifest, indent=2)
+    return seen
+
+def _decode_rows(names, columns, vocabs, start, end):
+    '''Return a list of column name => python value dicts, for rows
+       ``start`` to ``end`` of columns ``names``, as returned by load'''
+    decoded = {}
+    for name in names:
+        vals = columns[name][start:end]
+        if name in vocabs:
+            vals = decode(vals, vocabs[name]).tolist()
+        elif vals.dtype.kind == 'M':
+            vals = vals.astype(object).tolist()
+        elif vals.dtype.kind == 'f':
+            vals = [None if v != v else v for v in vals.tolist()]
+        else:
+            vals = vals.tolist()
+            nulls = columns.get('{}.null'.format(name))
+            if nulls is not None:
+                vals = [None if n else v
+                        for v,n in zip(vals, nulls[start:end].tolist())]
+        decoded[name] = vals
+
+    return [dict(zip(names, row)) for row in zip(*[decoded[n]
+                                                    for n in names])]
+
+### EXPOSED METHODS
+def export(path, tables=EXPORT_TABLES, chunk=CHUNK):
+    '''Export ``tables`` to a directory each under ``path``, streaming rows
+       in chunks of ``chunk`` from a read-only connection, so that the
+       database is never write locked. Return a dict of table => rows.'''
+    exported = {}
+    conn = db.engine.connect()
+    try:
+        for table in _tables(tables):
+            table_dir = os.path.join(path, table.name)
+            if not os.path.isdir(table_dir):
+                os.makedirs(table_dir)
+            exported[table.name] = _export_table(conn, table, table_dir,
+                                                 chunk)
+    finally:
+        conn.close()
+    return exported
+
+def load(path, table, mmap_mode='r'):
+    '''Return a tuple of length 2 of a dict of column name => array, and of
+       column name => vocabulary for dictionary encoded columns, of
+       ``table`` exported under ``path``. Null masks of integer and boolean
+       columns are included as <column>.null. Arrays are memory mapped with
+       ``mmap_mode``, or read into memory if None.'''
+    table_dir = os.path.join(path, table)
+    with open(os.path.join(table_dir, MANIFEST)) as manifest:
+        meta = json.load(manifest)
+
+    columns, vocabs = {}, {}
+    npy = lambda name: numpy.load(os.path.join(table_dir, name + '.npy'),
+                                  mmap_mode=mmap_mode)[:meta['rows']]
+    for name, kind in meta['columns']:
+        columns[name] = npy(name)
+        if kind == 'str':
+            vocabs[name] = numpy.load(os.path.join(table_dir,
+                                                   name + '.vocab.npy'))
+        elif os.path.exists(os.path.join(table_dir, name + '.null.npy')):
+            columns['{}.null'.format(name)] = npy(name + '.null')
+    return columns, vocabs
+
+def decode(codes, vocab):
+    '''Return an object array of the values of dictionary encoded ``codes``,
+       with None for null'''
+    decoded = numpy.empty(len(codes), dtype=object)
+    valid = codes >= 0
+    decoded[valid] = vocab[codes[valid]]
+    return decoded
+
+def restore(path, tables=EXPORT_TABLES, chunk=CHUNK):
+    '''Bulk load ``tables`` exported under ``path`` into the database,
+       creating tables as needed, in chunks of ``chunk`` rows. Rows keep
+       their ids, so the tables should be empty. Return a dict of table =>
+       rows.'''
+    restored = {}
+    tables = _tables(tables)
+    db.metadata.create_all(bind=db.engine, tables=tables)
+    conn = db.engine.connect()
+    try:
+        for table in tables:
+            columns, vocabs = load(path, table.name)
+            names = table.columns.keys()
+            rows = len(columns[names[0]])
+            # stored values are inserted as is, bypassing any decorator
+            insert = table.insert().values(dict([
+                (c.name, bindparam(c.name, type_=_raw_type(c)))
+                    for c in table.columns]))
+            with conn.begin():
+                for start in xrange(0, rows, chunk):
+                    conn.execute(insert, _decode_rows(names, columns, vocabs,
+                                                      start, min(start + chunk,
+                                                                 rows)))
+            restored[table.name] = rows
+    finally:
+        conn.close()
+    return restored
+
+def main(argv=None):
+    '''Export or import (restore) tables, see module docstring'''
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2 or argv[0] not in ('export', 'import'):
+        sys.stderr.write('usage: python -m stackpm.columnar '
+                         'export|import <dir> [<table> ...]\n')
+        return 2
+    tables = argv[2:] or EXPORT_TABLES
+    meth = export if argv[0] == 'export' else restore
+    for table, rows in sorted(meth(argv[1], tables).iteritems()):
+        sys.stdout.write('{}: {} rows\n'.format(table, rows))
+    return 0
+
+__all__ = ['EXPORT_TABLES', 'export', 'load', 'decode', 'restore', 'main']
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+'''stackpm/daemon.py -- long-running sync daemon for stackpm
+
+   Runs incremental iteration and task syncs of every project_manager
+   source every [daemon] interval seconds, and holiday and vacation syncs
+   daily at [daemon] calendar_at, in one process, so that link connectors
+   (and their field caches), calendars and latest stats stay warm from one
+   sync to the next.
+
+   Syncs are single-flight: every run holds sync_lock, which also excludes
+   syncs run from other processes holding it (e.g. ``--once`` from cron).
+   Triggers (see Daemon.trigger, or SIGUSR1) arriving within [daemon]
+   coalesce seconds of one another, or while a sync is running, are
+   coalesced into a single run.
+
+   Tasks pushed by the project_manager link (e.g. webhooks received by the
+   api) are synced in micro-batches by a PushWorker thread in the process
+   receiving them, under the same lock.
+
+     python -m stackpm.daemon [--once]
+
+   classes: Daemon, PushWorker
+   functions: sync_lock, start_push_worker, main
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import fcntl
+import logging
+import os
+import pwd
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+### INTERNAL IMPORTS
+from . import config, db, sync, create_app
+
+### GLOBALS
+INTERVAL_DFLT = 60
+CALENDAR_AT_DFLT = '03:00'
+COALESCE_DFLT = 2
+BATCH_WAIT_DFLT = 1
+
+# job => sync methods run, in the order jobs are run
+JOBS = (
+    ('calendar', ('sync_holidays', 'sync_vacations',)),
+    ('incremental', ('sync_sources',)),
+)
+
+# excludes concurrent syncs within this process, flock excludes others
+_LOCK = threading.Lock()
+
+# the PushWorker of this process, see start_push_worker
+_PUSH_WORKER = []
+_PUSH_WORKER_LOCK = threading.Lock()
+
+logger = logging.getLogger('stackpm.daemon')
+
+### EXPOSED CLASSES
+class Daemon(object):
+    '''Scheduler running sync jobs (see JOBS) until stopped'''
+    def __init__(self, interval=None, calendar_at=None, coalesce=None,
+                 lock_file=None):
+        opts = config.get('daemon', {})
+        self.interval = interval or opts.get('interval') or INTERVAL_DFLT
+        self.calendar_at = calendar_at or opts.get('calendar_at') \
+                               or CALENDAR_AT_DFLT
+        self.coalesce = coalesce if coalesce is not None \
+                            else opts.get('coalesce', COALESCE_DFLT)
+        self.lock_file = lock_file or opts.get('lock_file')
+        # (user_id, effort_est) => outlier thresholds, see sync.sync_tasks
+        self.stat_cache = {}
+
+        # the first run syncs everything, warming all caches
+        self.__due = dict([(job, 0) for job,_ in JOBS])
+        self.__pending = set()
+        self.__triggered = 0
+        self.__stopped = False
+        # re-entrant, as signal handlers may trigger while run holds it
+        self.__cond = threading.Condition(threading.RLock())
+
+    def __repr__(self):
+        return '<Daemon every {}s, calendar at {}>'.format(self.interval,
+                                                          self.calendar_at)
+
+    def __next_calendar(self, now):
+        '''Return the timestamp of the next calendar sync after ``now``'''
+        hour, minute = [int(x) for x in self.calendar_at.split(':')]
+        at = datetime.fromtimestamp(now).replace(hour=hour, minute=minute,
+                                                 second=0, microsecond=0)
+        if at <= datetime.fromtimestamp(now):
+            at += timedelta(days=1)
+        return time.mktime(at.timetuple())
+
+    def __wait(self):
+        '''Wait for jobs to come due or be triggered, and return the set of
+           jobs to run, or None if stopped. Must hold __cond.'''
+        while not self.__stopped:
+            now = time.time()
+            if self.__pending:
+                # wait out a burst of triggers, so it makes one run
+                while self.__pending and not self.__stopped and \
+                        time.time() < self.__triggered + self.coalesce:
+                    self.__cond.wait(self.__triggered + self.coalesce -
+                                     time.time())
+                now = time.time()
+
+            due = set([j for j,at in self.__due.iteritems() if at <= now])
+            if due or self.__pending:
+                due |= self.__pending
+                self.__pending.clear()
+                return None if self.__stopped else due
+            self.__cond.wait(min(self.__due.values()) - now)
+        return None
+
+    def trigger(self, *jobs):
+        '''Request a run of ``jobs`` (default incremental) as soon as
+           triggers stop arriving'''
+        with self.__cond:
+            self.__pending.update(jobs or ('incremental',))
+            self.__triggered = time.time()
+            self.__cond.notify()
+
+    def stop(self):
+        '''Stop after any running sync completes'''
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+
+    def run_once(self, jobs):
+        '''Run the sync methods of ``jobs`` under sync_lock, logging rather
+           than raising failures, so that one bad sync doesn't stop the
+           daemon. Return True if every sync succeeded.'''
+        ok = True
+        with sync_lock(self.lock_file):
+            for job, meths in JOBS:
+                if job not in jobs:
+                    continue
+                for meth in meths:
+                    kwargs = {'stat_cache': self.stat_cache} \
+                                 if meth == 'sync_sources' else {}
+                    started = time.time()
+                    try:
+                        getattr(sync, meth)(**kwargs)
+                        logger.info('%s: %.3fs', meth, time.time() - started)
+                    except Exception:
+                        ok = False
+                        logger.exception('%s failed', meth)
+            # don't hold objects loaded by this run in the session
+            db.session.remove()
+        return ok
+
+    def run(self):
+        '''Run jobs as they come due or are triggered, until stopped'''
+        logger.info('starting %r', self)
+        while True:
+            with self.__cond:
+                jobs = self.__wait()
+            if jobs is None:
+                break
+
+            started = time.time()
+            self.run_once(jobs)
+            with self.__cond:
+                for job in jobs:
+                    self.__due[job] = started + self.interval \
+                        if job == 'incremental' \
+                        else self.__next_calendar(started)
+        logger.info('stopped %r', self)
+
+class PushWorker(threading.Thread):
+    '''Thread syncing pushed tasks (see sync.push_tasks) in micro-batches,
+       each collected for up to [webhooks] batch_wait seconds'''
+    def __init__(self, batch_wait=None, lock_file=None):
+        super(PushWorker, self).__init__(name='stackpm-push')
+        self.daemon = True
+        opts = config.get('webhooks', {})
+        self.batch_wait = batch_wait if batch_wait is not None \
+                              else opts.get('batch_wait', BATCH_WAIT_DFLT)
+        self.lock_file = lock_file
+        self.stat_cache = {}
+
+    def run(self):
+        while True:
+            tasks = []
+            try:
+                tasks = sync.pop_pushed_tasks(batch_wait=self.batch_wait)
+                with sync_lock(self.lock_file):
+                    sync.sync_pushed_tasks(tasks, stat_cache=self.stat_cache)
+                logger.info('synced %d pushed tasks', len(tasks))
+            except Exception:
+                # missed pushes are reconciled by the next sync_tasks
+                logger.exception('sync of %d pushed tasks failed', len(tasks))
+            finally:
+                db.session.remove()
+
+### INTERNAL METHODS
+def _drop_privileges(user):
+    '''Switch to ``user`` if running as root'''
+    if user and os.getuid() == 0:
+        pw = pwd.getpwnam(user)
+        os.setgid(pw.pw_gid)
+        os.setuid(pw.pw_uid)
+
+### EXPOSED METHODS
+@contextmanager
+def sync_lock(lock_file=None):
+    '''Hold the sync lock for the wrapped code, blocking until any sync
+       running in this process, or holding ``lock_file`` (default [daemon]
+       lock_file) in another, is done.'''
+    lock_file = lock_file or config.get('daemon', {}).get('lock_file')
+    with _LOCK:
+        if not lock_file:
+            yield
+            return
+        with open(lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def start_push_worker():
+    '''Start this process's PushWorker, if not already running, and return
+       it'''
+    with _PUSH_WORKER_LOCK:
+        if not _PUSH_WORKER or not _PUSH_WORKER[0].is_alive():
+            _PUSH_WORKER[:] = [PushWorker()]
+            _PUSH_WORKER[0].start()
+    return _PUSH_WORKER[0]
+
+def main(argv=None):
+    '''Run the daemon until SIGTERM or SIGINT, syncing on SIGUSR1, or with
+       --once run a single full sync under sync_lock'''
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    create_app()
+    _drop_privileges(config.get('daemon', {}).get('user'))
+    if '--once' in argv:
+        with sync_lock():
+            sync.sync()
+        return 0
+
+    daemon = Daemon()
+    signal.signal(signal.SIGTERM, lambda *a: daemon.stop())
+    signal.signal(signal.SIGINT, lambda *a: daemon.stop())
+    signal.signal(signal.SIGUSR1, lambda *a: daemon.trigger())
+    daemon.run()
+    return 0
+
+__all__ = ['JOBS', 'Daemon', 'PushWorker', 'sync_lock', 'start_push_worker',
+           'main']
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,51 +1,210 @@
-'''stackpm/models.py -- Database API for stackpm
+'''stackpm/estimates.py -- Database API for stackpm estimates
 
-   functions: task_efforts, iteration_efforts, iteration_values
+   Distinct estimates are served from an index of value counts, by user for
+   tasks and by team for iterations, loaded on first use and kept up to date
+   by every ORM write (see reindex), applied once committed, rather than
+   grouping whole tables on every call. The index is reloaded once syncs
+   recorded by any other process are seen.
+
+   functions: task_efforts, iteration_efforts, iteration_values, index_key,
+              reindex, note_sync
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)'''
 
+### STANDARD LIBRARY IMPORTS
+import threading
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
 ### INTERNAL IMPORTS
 from . import db, null
-from .models import Task, Iteration, User
+from .models import Task, Iteration, User, Sync
+
+### GLOBALS
+# model => indexed group column, and estimate columns counted by group
+_INDEXED = {
+    Task: ('user_id', ('effort_est',)),
+    Iteration: ('team', ('effort_est', 'value_est',)),
+}
+
+# model => group => column => estimate => rows, with the last Sync id seen
+# and ids of Syncs recorded by this process since
+_INDEX = {'models': {}, 'synced': 0, 'own': set()}
+_LOCK = threading.RLock()
 
 ### INTERNAL METHODS
-def _est(col, xtra_filter):
-    '''Helper to return unique estimates with a generic filter'''
-    query = db.session.query(col)
-    if xtra_filter:
-        query = query.filter(xtra_filter)
+def _load(model):
+    '''Return the index of ``model``, in a query per estimate column'''
+    group, columns = _INDEXED[model]
+    group_col, index = getattr(model, group), {}
+    for column in columns:
+        col = getattr(model, column)
+        for key, est, n in db.session.query(group_col, col,
+                                            db.func.count()).group_by(
+                                                group_col, col).all():
+            index.setdefault(key, {}).setdefault(column, {})[est] = n
+    return index
+
+def _index(model):
+    '''Return the index of ``model``, dropping every index first if any
+       other process has recorded a Sync since it was loaded'''
+    with _LOCK:
+        models = _INDEX['models']
+        if models:
+            newer = set([id_ for id_, in db.session.query(Sync.id).filter(
+                             Sync.id > _INDEX['synced']).all()])
+            if newer - _INDEX['own']:
+                models.clear()
+            elif newer:
+                _INDEX['synced'] = max(newer)
+            _INDEX['own'] -= newer
+        if not models:
+            _INDEX['synced'] = db.session.query(db.func.max(Sync.id))\
+                                         .scalar() or 0
+            _INDEX['own'].clear()
+
+        if model not in _INDEX['models']:
+            _INDEX['models'][model] = _load(model)
+        return _INDEX['models'][model]
+
+def _est(model, column, groups):
+    '''Return a sorted list of unique ``column`` estimates of ``model`` in
+       any of ``groups``, or in any group if ``groups`` is null'''
+    index = _index(model)
+    groups = index.keys() if groups is null else groups
+    ests = set()
+    for key in groups:
+        ests.update(index.get(key, {}).get(column, {}))
+    return sorted(ests)
+
+def _note(target, change):
+    '''Note a tuple of the index_key of ``target`` before and after
+       ``change``, pending commit of its session, or that the index of its
+       model must reload, if ``change`` is None'''
+    pending = inspect(target).session.info.setdefault('reindex', {})
+    changes = pending.setdefault(type(target), [])
+    if change is None:
+        pending[type(target)] = None
+    elif changes is not None:
+        changes.append(change)
+
+def _after_insert(mapper, connection, target):
+    _note(target, (None, index_key(target)))
 
-    return [row[0] for row in query.group_by(col).all()]
+def _after_update(mapper, connection, target):
+    '''Note the index_key of ``target`` before and after the update, or
+       that the index must reload, if its old values were never loaded'''
+    state, old = inspect(target), []
+    group, columns = _INDEXED[type(target)]
+    for column in (group,) + columns:
+        history = state.attrs[column].history
+        if history.deleted:
+            old.append(history.deleted[0])
+        elif history.added:
+            return _note(target, None)
+        else:
+            old.append(getattr(target, column))
+    _note(target, (tuple(old), index_key(target)))
+
+def _after_delete(mapper, connection, target):
+    _note(target, (index_key(target), None))
+
+def _after_commit(session):
+    '''Apply the changes committed by ``session`` to the index'''
+    for model, changes in session.info.pop('reindex', {}).iteritems():
+        if changes is None:
+            with _LOCK:
+                _INDEX['models'].pop(model, None)
+        else:
+            reindex(model, changes)
+
+def _after_soft_rollback(session, previous):
+    '''Drop the changes rolled back, or if only a savepoint was rolled back,
+       note that the index of each model changed must reload'''
+    pending = session.info.pop('reindex', {})
+    if previous.nested:
+        session.info['reindex'] = dict.fromkeys(pending)
 
-def _iter_est(col, team):
+def _iter_est(column, team):
     '''Return either value_est or effort_est for an Iteration'''
-    xtra_filter = None
+    teams = null
     if team is not null:
         if team is None or isinstance(team, basestring):
-            xtra_filter = Iteration.team == team
+            teams = [team]
         else:
-            query = Iteration.team.in_(team)
+            teams = team
 
-    return _est(col, xtra_filter)
+    return _est(Iteration, column, teams)
 
 ### EXPOSED METHODS
 def task_efforts(user=null):
     '''Return an iterable of unique task effort_est values, possibly
        constrained by a user.'''
-    xtra_filter = None
+    users = null
     if user is not null:
         if user is None or isinstance(user, User):
-            xtra_filter = Task.user == user
+            users = [user]
         else:
-            xtra_filter = Task.user.in_(user)
-    return _est(Task.effort_est, xtra_filter)
+            users = user
+        users = [u.id if u is not None else None for u in users]
+    return _est(Task, 'effort_est', users)
 
 def iteration_efforts(team=null):
     '''Return an iterable of unique iteration effort_est values, possibly
        constrained by a team.'''
-    return _iter_est(Iteration.effort_est, team)
+    return _iter_est('effort_est', team)
 
 def iteration_values(team=null):
     '''Return an iterable of unique iteration value_est values, possibly
        constrained by a team.'''
-    return _iter_est(Iteration.value_est, team)
+    return _iter_est('value_est', team)
+
+def index_key(obj):
+    '''Return a tuple of the indexed values of ``obj``, its group first, or
+       None if its model is not indexed'''
+    try:
+        group, columns = _INDEXED[type(obj)]
+    except KeyError:
+        return None
+    return tuple([getattr(obj, c) for c in (group,) + columns])
+
+def reindex(model, changes):
+    '''Update the index of ``model``, if loaded, from a list of tuples of
+       length 2 of the index_key of each row changed (None if created)
+       before, and after (None if deleted), the change was committed.'''
+    with _LOCK:
+        index = _INDEX['models'].get(model)
+        if index is None:
+            return
+        columns = _INDEXED[model][1]
+        for old, new in changes:
+            if old == new:
+                continue
+            for key, n in ((old, -1), (new, 1)):
+                if key is None:
+                    continue
+                counts = index.setdefault(key[0], {})
+                for column, est in zip(columns, key[1:]):
+                    ests = counts.setdefault(column, {})
+                    ests[est] = ests.get(est, 0) + n
+                    if not ests[est]:
+                        del ests[est]
+
+def note_sync(sync_id):
+    '''Note that Sync ``sync_id`` was recorded by this process, whose
+       changes are already reindexed, so that it doesn't reload the index'''
+    with _LOCK:
+        if _INDEX['models'] and sync_id > _INDEX['synced']:
+            _INDEX['own'].add(sync_id)
+
+for _model in _INDEXED:
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'after_update', _after_update)
+    event.listen(_model, 'after_delete', _after_delete)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+__all__ = ['task_efforts', 'iteration_efforts', 'iteration_values',
+           'index_key', 'reindex', 'note_sync']
@@ -1,10 +1,11 @@
 '''stackpm/fields.py -- Custom database fields for stackpm
 
-   classes: JSONField
+   classes: JSONField, SummaryField
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)
 '''
 from . import db
+from .simulate import Summary
 import json
 
 class JSONField(db.TypeDecorator):
@@ -21,3 +22,15 @@ class JSONField(db.TypeDecorator):
 
     def process_result_value(self, value, dialect):
         return value if value is None else json.loads(value)
+
+class SummaryField(db.TypeDecorator):
+    """Represents a simulate.Summary as a compact json-encoded string, the
+    histogram of which is decoded lazily."""
+
+    impl = db.Text
+
+    def process_bind_param(self, value, dialect):
+        return value if value is None else value.dumps()
+
+    def process_result_value(self, value, dialect):
+        return value if value is None else Summary.loads(value)
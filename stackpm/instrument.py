@@ -0,0 +1,240 @@
+'''stackpm/instrument.py -- light-weight timing spans and counters
+
+   Spans nest, and are recorded by path (e.g. sync/sync_tasks/commit) with
+   a call count and wall time. Counters (rows fetched, rows upserted,
+   queries issued, bytes received, ...) are attributed to the innermost
+   open span. When an outermost span closes, a summary of everything under
+   it is written as a JSON line to [instrument] log, if set. Work handed to
+   other threads is attributed to the span handing it off by opening spans
+   there with it as parent (see current and span).
+
+   Spans named in [instrument] profile are also run under cProfile, with
+   stats dumped to [instrument] profile_dir, in the thread of the
+   outermost span only. When [instrument] enabled is False, spans and
+   counters are no-ops.
+
+   classes: Span
+   functions: enabled, current, span, timed, timed_iter, count, summary
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import cProfile
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+### INTERNAL IMPORTS
+from . import config
+
+### GLOBALS
+PATH_SEP = '/'
+
+# per-thread stack of open spans, the outermost holding the run
+_LOCAL = threading.local()
+
+### EXPOSED CLASSES
+class Span(object):
+    '''A timed, possibly profiled, region of code. See span.'''
+    __slots__ = ('name', 'parent', 'path', 'run', 'started', 'profiler')
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.path = self.run = self.started = self.profiler = None
+
+    def __enter__(self):
+        stack = _stack()
+        outer = stack[-1] if stack else self.parent
+        if outer is not None:
+            self.path = PATH_SEP.join([outer.path, self.name])
+            self.run = outer.run
+        else:
+            self.path = self.name
+            self.run = {'name': self.name, 'started': datetime.now(),
+                        'spans': {}, 'counters': {}, 'profilers': {},
+                        'thread': threading.current_thread(),
+                        'lock': threading.Lock()}
+
+        # one profile accumulates every call of a span in a run, nested
+        # profiling is not supported by cProfile, so the outermost wins
+        profile = config.get('instrument', {}).get('profile') or []
+        if self.name in profile and not getattr(_LOCAL, 'profiling', False) \
+                and self.run['thread'] is threading.current_thread():
+            _LOCAL.profiling = True
+            self.profiler = self.run['profilers'].setdefault(
+                                self.path, cProfile.Profile())
+            self.profiler.enable()
+
+        stack.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.started
+        stack = _stack()
+        stack.pop()
+        with self.run['lock']:
+            calls = self.run['spans'].setdefault(self.path, [0, 0.])
+            calls[0], calls[1] = calls[0] + 1, calls[1] + elapsed
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            _LOCAL.profiling = False
+
+        # spans with a parent in another thread leave the run to it
+        if not stack and self.parent is None:
+            _write_run(self.run, elapsed)
+        return False
+
+class _NoSpan(object):
+    '''Stand-in for Span when instrumentation is disabled'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+### INTERNAL METHODS
+def _stack():
+    '''Return this thread's stack of open spans'''
+    try:
+        return _LOCAL.stack
+    except AttributeError:
+        _LOCAL.stack = []
+        return _LOCAL.stack
+
+def _dump_profiles(run):
+    '''Dump the cProfile stats of each profiled span path of ``run`` to
+       [instrument] profile_dir, and return the paths dumped to'''
+    profile_dir = config.get('instrument', {}).get('profile_dir')
+    if not profile_dir:
+        return []
+    paths = []
+    for path, profiler in sorted(run['profilers'].iteritems()):
+        paths.append(os.path.join(profile_dir, '{}.{}.prof'.format(
+            path.replace(PATH_SEP, '.'),
+            run['started'].strftime('%Y%m%d%H%M%S%f'))))
+        profiler.dump_stats(paths[-1])
+    return paths
+
+def _summarize(run, prefix, elapsed=None):
+    '''Return a JSON-able summary of the spans and counters of ``run`` at
+       or under path ``prefix``'''
+    under = lambda path: path == prefix or \
+                         path.startswith(prefix + PATH_SEP)
+    # spans in other threads may still be writing to the run
+    with run['lock']:
+        run_spans = [(p, tuple(c)) for p,c in run['spans'].iteritems()]
+        run_counters = [(p, dict(c)) for p,c in run['counters'].iteritems()]
+
+    spans, counters = {}, {}
+    for path,(calls, seconds) in run_spans:
+        if under(path):
+            spans[path] = {'calls': calls, 'seconds': round(seconds, 6)}
+    for path, span_counters in run_counters:
+        if under(path):
+            spans.setdefault(path, {'calls': 0, 'seconds': 0.})\
+                 .update(span_counters)
+            for name, n in span_counters.iteritems():
+                counters[name] = counters.get(name, 0) + n
+
+    summary = {'spans': spans, 'counters': counters}
+    if elapsed is not None:
+        summary['seconds'] = round(elapsed, 6)
+    return summary
+
+def _write_run(run, elapsed):
+    '''Dump the profiles of a finished run, and write its summary to
+       [instrument] log'''
+    profiles = _dump_profiles(run)
+    log = config.get('instrument', {}).get('log')
+    if not log:
+        return
+    line = _summarize(run, run['name'], elapsed)
+    line.update({'run': run['name'], 'started': run['started'].isoformat(),
+                 'profiles': profiles})
+    with open(log, 'a') as log_file:
+        log_file.write(json.dumps(line, sort_keys=True) + '\n')
+
+def _timed_iter(name, iterator):
+    '''Generator for timed_iter'''
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    '''SQLAlchemy before_cursor_execute hook, counting queries issued'''
+    count('queries')
+
+### EXPOSED METHODS
+def enabled():
+    '''Return True if [instrument] enabled is set'''
+    return bool(config.get('instrument', {}).get('enabled', False))
+
+def current():
+    '''Return the innermost open span of this thread, or None, e.g. to pass
+       as the parent of spans opened in other threads'''
+    stack = getattr(_LOCAL, 'stack', None)
+    return stack[-1] if stack else None
+
+def span(name, parent=None):
+    '''Return a context manager timing the code it wraps as span ``name``,
+       nested under any open span of this thread, or else under span
+       ``parent`` (see current), typically open in another thread.'''
+    return Span(name, parent) if enabled() else _NO_SPAN
+
+def timed(func):
+    '''Decorate ``func`` to run in a span named for it'''
+    def timed_func(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    timed_func.__name__ = func.__name__
+    timed_func.__doc__ = func.__doc__
+    return timed_func
+
+def timed_iter(name, iterable):
+    '''Return an iterator over ``iterable`` timing each step in a span named
+       ``name``, so that time spent producing items (e.g. paging a link)
+       is told apart from time spent consuming them.'''
+    if not enabled():
+        return iter(iterable)
+    return _timed_iter(name, iter(iterable))
+
+def count(name, n=1):
+    '''Add ``n`` to counter ``name`` of the innermost open span'''
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack:
+        with stack[-1].run['lock']:
+            counters = stack[-1].run['counters'].setdefault(stack[-1].path,
+                                                            {})
+            counters[name] = counters.get(name, 0) + n
+
+def summary():
+    '''Return a JSON-able summary of the spans and counters under the
+       innermost open span, or None if no span is open, e.g. for Sync.notes'''
+    stack = getattr(_LOCAL, 'stack', None)
+    if not stack:
+        return None
+    return _summarize(stack[-1].run, stack[-1].path,
+                      time.time() - stack[-1].started)
+
+event.listen(Engine, 'before_cursor_execute', _count_query)
+
+__all__ = ['PATH_SEP', 'Span', 'enabled', 'current', 'span', 'timed',
+           'timed_iter', 'count', 'summary']
@@ -1,39 +1,81 @@
 '''stackpm/links/__init__.py -- package for linking to 3rd party tools
 
+   Each link type is exposed as a module level proxy, the connector behind
+   which is set up on first use, so that importing links loads neither
+   config nor any connector's dependencies.
+
+   Several project_manager links may be synced as separate sources (e.g.
+   one per Jira project), named in the project_managers setting of the
+   links section, see sources.
+
+   classes: Link
+   functions: connector, source, sources
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)
 '''
 
-from .. import stackpm_app
+from .. import config
 import noop
 
 ### GLOBALS
 # each of these ends up being a module level variable
 LINK_TYPES = ( 'project_manager', 'scm', 'calendar', )
-LINK_CONFIG = stackpm_app.config.get('links', {})
-CONNECTORS = LINK_CONFIG.get('connectors', {})
 
-# DEPENDS CONNECTORS, noop
+# link name => Connector, shared across link types
+_CONNECTORS = {}
+
+# DEPENDS noop
 import connectors
 
-# DEPENDS connectors
+class Link(object):
+    '''Proxy to the connector of ``link_type``, set up on first use'''
+    def __init__(self, link_type):
+        self.link_type = link_type
+
+    def __repr__(self):
+        return '<Link {}>'.format(self.link_type)
+
+    def __getattr__(self, name):
+        return getattr(connector(self.link_type), name)
+
+def connector(link_type):
+    '''Return the connector for ``link_type``, as defined in the links
+       section, setting it up on first use. Note that if multiple link types
+       specify the same connector, a single connector object will be shared
+       across all link types.'''
+    return _connect(config.get('links', {}).get(link_type) or 'noop')
+
+def source(name):
+    '''Return the connector of project_manager source ``name``, the link
+       name of a connector in the links section, configured by the section
+       of the same name, or the project_manager connector if None.'''
+    if name is None:
+        return connector('project_manager')
+    return _connect(name)
+
+def sources():
+    '''Return a list of the project_manager sources named in the links
+       section, or [None] for the project_manager link alone.'''
+    return list(config.get('links', {}).get('project_managers') or [None])
+
+def _connect(link):
+    '''Return the connector for link name ``link``, set up on first use'''
+    try:
+        return _CONNECTORS[link]
+    except KeyError:
+        _CONNECTORS[link] = connectors.load(link).Connector(
+                                config.get(link, {}))
+        return _CONNECTORS[link]
+
 def setup():
-    '''Setup package-level links for all link-types defined in links
-       section. Note that if multiple link types specify the same connector,
-       a single connector object will be shared across all link types.'''
-    conns = {}
+    '''Setup package-level link proxies for all link-types.'''
     scope = globals()
     for link_type in LINK_TYPES:
-        link = LINK_CONFIG.get(link_type) or 'noop'
-        config = stackpm_app.config.get(link, {})
-        try:
-            connector = conns[link]
-        except KeyError:
-            conns[link] = getattr(connectors, link).Connector(config)
-            connector = conns[link]
-        scope[link_type] = connector
+        scope[link_type] = Link(link_type)
 
 setup()
 del setup
 
-__all__ = [ 'connectors', 'LINK_TYPES', ] + list(LINK_TYPES)
+__all__ = [ 'connectors', 'LINK_TYPES', 'Link', 'connector', 'source',
+            'sources', ] + \
+          list(LINK_TYPES)
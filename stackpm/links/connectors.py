@@ -1,17 +1,23 @@
 '''stackpm/links/connectors.py -- connector extensions for stackpm
 
+   Connector modules named in the connectors setting of the links section
+   are imported on first use, see load.
+
+   functions: load
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)
 '''
 import importlib
 
-from . import noop, CONNECTORS
+from .. import config
+from . import noop
 
-def setup():
-    '''Setup module-level connectors.'''
-    _scope = globals()
-    for name,mod in CONNECTORS.iteritems():
-        _scope[name] = importlib.import_module(mod)
+def load(name):
+    '''Return the connector module ``name``, importing it on first use.'''
+    scope = globals()
+    if name not in scope:
+        mod = config.get('links', {}).get('connectors', {})[name]
+        scope[name] = importlib.import_module(mod)
+    return scope[name]
 
-setup()
-del setup
+__all__ = ['noop', 'load']
@@ -19,10 +19,11 @@ class Connector(object):
         return '<NoOpLink>'
 
     ### API for project_manager connector
-    def iterations(self, since=None, limit=None):
+    def iterations(self, since=None, limit=None, ids=None, known=None):
         '''Returns an iterable type of up to len ``limit`` iteration
            dicts capable of being sent to models.Iteration, that have been
-           updated since ``since``.
+           updated since ``since``. Iterations whose content_hash is that of
+           their ext_id in ``known`` may be skipped, as unchanged.
 
            iterations is typically implemented as a generator.'''
         return _empty_generator()
@@ -32,10 +33,12 @@ class Connector(object):
            models.Iteration'''
         raise NotImplementedError
 
-    def tasks(self, since=None, limit=None):
+    def tasks(self, since=None, limit=None, ids=None, known=None):
         '''Returns an iterable type of up to len ``limit`` task dicts capable
            of being sent to models.Task, that have been updated since
-           ``since``, including events since ``since``.
+           ``since``, including events since ``since``. Tasks whose
+           content_hash is that of their ext_id in ``known`` may be skipped,
+           as unchanged.
 
            tasks is typically implemented as a generator.'''
         return _empty_generator()
@@ -45,6 +48,13 @@ class Connector(object):
            events since ``since``.'''
         raise NotImplementedError
 
+    def hook_task(self, payload):
+        '''Return a task dict, capable of being sent to models.Task, from a
+           webhook ``payload`` pushed by the project manager, or None if the
+           payload carries no task. Fields the payload cannot determine are
+           left out of the task dict.'''
+        return None
+
     ### API for project_manager connector
     def holidays(self, year=None):
         '''return a list of holidays in descending order for ``year``. if
@@ -0,0 +1,109 @@
+'''stackpm/migrate.py -- bring an existing stackpm database up to date
+
+   db.create_all creates missing tables, but never alters those that
+   exist. migrate also adds the columns and indexes missing from existing
+   tables, and rebuilds tables whose enum constraints predate values added
+   since, copying their rows.
+   Only the sqlite backend is supported, see README.rst.
+
+     python -m stackpm.migrate
+
+   functions: migrate
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import sys
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import inspect
+
+### INTERNAL IMPORTS
+from . import db
+# NB: registers every table with db.metadata
+from . import models
+
+### INTERNAL METHODS
+def _table_sql(conn, name):
+    '''Return the CREATE statement sqlite stores for table ``name``'''
+    return conn.execute('SELECT sql FROM sqlite_master WHERE type = ? AND '
+                        'name = ?', ('table', name)).scalar() or ''
+
+def _stale_enums(conn, table):
+    '''Return a list of the enum values of ``table`` missing from the
+       constraints of the table as created'''
+    sql = _table_sql(conn, table.name)
+    return [v for c in table.columns if isinstance(c.type, db.Enum)
+                  for v in c.type.enums if "'{}'".format(v) not in sql]
+
+def _add_columns(conn, table, existing):
+    '''Add each column of ``table`` not in ``existing``, and return a list
+       of the columns added'''
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            conn.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                table.name, column.name,
+                column.type.compile(dialect=conn.dialect)))
+            added.append(column.name)
+    return added
+
+def _rebuild(conn, table):
+    '''Re-create ``table`` as defined, with its indexes, copying its rows'''
+    copy = '_migrate_{}'.format(table.name)
+    columns = ', '.join(['"{}"'.format(c.name) for c in table.columns])
+    conn.execute('CREATE TABLE "{}" AS SELECT * FROM "{}"'.format(
+                     copy, table.name))
+    conn.execute('DROP TABLE "{}"'.format(table.name))
+    table.create(conn)
+    conn.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM "{2}"'.format(
+                     table.name, columns, copy))
+    conn.execute('DROP TABLE "{}"'.format(copy))
+
+### EXPOSED METHODS
+def migrate():
+    '''Create missing tables, and bring existing tables up to date, in a
+       single transaction. Return a list of the changes made.'''
+    changes = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                table.create(conn)
+                changes.append('created {}'.format(table.name))
+                continue
+
+            existing = set([c['name']
+                                for c in inspector.get_columns(table.name)])
+            for column in _add_columns(conn, table, existing):
+                changes.append('added {}.{}'.format(table.name, column))
+
+            stale = _stale_enums(conn, table)
+            if stale:
+                _rebuild(conn, table)
+                changes.append('rebuilt {} for {}'.format(
+                                   table.name, ', '.join(stale)))
+                continue
+
+            indexes = set([i['name']
+                               for i in inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append('indexed {}'.format(index.name))
+    return changes
+
+def main(argv=None):
+    '''Migrate the database of the configured stackpm, reporting changes'''
+    changes = migrate()
+    for change in changes:
+        sys.stdout.write('{}\n'.format(change))
+    if not changes:
+        sys.stdout.write('up to date\n')
+    return 0
+
+__all__ = ['migrate', 'main']
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,32 @@
 '''stackpm/models.py -- Database API for stackpm
 
-   classes: User, Holiday, Vacation, Iteration, Task, Stat, Event,
-            Simulation, Sync
+   classes: User, Holiday, Vacation, Iteration, Task, Stat, StatWindow,
+            Event, Simulation, Sync
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)'''
 
 ### STANDARD LIBRARY IMPORTS
+import base64
 import copy
-from datetime import datetime
+import json
+import math
+from datetime import datetime, timedelta
 
 ### 3RD PARTY IMPORTS
+import numpy
 from workdays import networkdays
 
 ### INTERNAL IMPORTS
 from . import db
-from .fields import JSONField
+from .fields import JSONField, SummaryField
 
 def _copy_as_of(obj, dels=tuple(), relateds=tuple()):
-    '''Return a dict copy of `obj`, removing `dels` and making sure `relateds`
-       objects are fully copied'''
-    cp = copy.deepcopy(obj.__dict__)
-    for del_ in tuple(dels) + tuple(['_sa_instance_state']):
-        del cp[del_]
+    '''Return a dict copy of `obj`, removing `dels` and related objects, and
+       making sure `relateds` objects are fully copied'''
+    skip = set(dels) | set(obj.__mapper__.relationships.keys())
+    skip.add('_sa_instance_state')
+    cp = copy.deepcopy(dict([(k,v) for k,v in obj.__dict__.iteritems()
+                                 if k not in skip]))
     for related in relateds:
         related_obj = getattr(obj, related)
         cp['_'.join([related, 'id'])] = related_obj.id
@@ -91,6 +96,10 @@ class Iteration(db.Model):
 
     team = db.Column(db.String(255), nullable=True)
 
+    # digest of the raw item last fetched from the link, unchanged items are
+    # not re-fetched (see sync.sync_iterations)
+    content_hash = db.Column(db.String(40), nullable=True)
+
     def __repr__(self):
         return '<Iteration {}>'.format(self.name)
 
@@ -105,8 +114,6 @@ class Iteration(db.Model):
         if dt < self.created_on:
             return None
 
-        # hack to get around copying list bug with SQLA
-        del self.events, self.tasks
         cp = _copy_as_of(self)
         cp['tasks'] = []
         change_map = {'estimate-change': 'effort_est'}
@@ -116,10 +123,12 @@ class Iteration(db.Model):
                 if changed and e.task is None:
                     cp[changed] = getattr(e, '_'.join(['from', changed]))
 
-        # re-roll tasks
-        for task in Task.query.join(Event.task).filter(db.or_(
+        # re-roll tasks, loading their users and events up front
+        for task in Task.query.outerjoin(Task.events).filter(db.or_(
                 Task.iteration == self, Event.from_iteration == self,
-                Event.iteration == self)).group_by(Task).all():
+                Event.iteration == self)).group_by(Task).options(
+                    db.joinedload(Task.user),
+                    db.subqueryload(Task.events)).all():
             task_on_dt = task.as_of(dt)
             if task_on_dt and task_on_dt['iteration'].id == self.id:
                 cp['tasks'].append(task_on_dt)
@@ -173,6 +182,10 @@ class Task(db.Model):
     # number of times through "testing" status
     round_trips = db.Column(db.Integer, nullable=True)
 
+    # digest of the raw item last fetched from the link, unchanged items are
+    # not re-fetched (see sync.sync_tasks)
+    content_hash = db.Column(db.String(40), nullable=True)
+
     def __init__(self, **kwargs):
         super(Task, self).__init__(**kwargs)
         self.cache_workdays()
@@ -180,14 +193,16 @@ class Task(db.Model):
     def __repr__(self):
         return '<Task {}>'.format(self.name.encode('utf8', errors='ignore'))
 
-    def cache_workdays(self, force=False):
+    def cache_workdays(self, force=False, days_off=None):
         '''Compute the number of work-days between started_on and dev_done_on
-           and prod_done_on, and store on self.'''
+           and prod_done_on, and store on self. If ``days_off`` is not
+           passed, the user's vacations and all holidays are loaded.'''
         if force or (self.started_on and ((
                 self.dev_done_on and self.dev_done_workdays is None) or (
                 self.prod_done_on and self.prod_done_workdays is None))):
-            days_off = set([v.date for v in self.user.vacation])
-            days_off |= set([h.date for h in Holiday.query.all()])
+            if days_off is None:
+                days_off = set([v.date for v in self.user.vacation])
+                days_off |= set([h.date for h in Holiday.query.all()])
             for stop,cache in (('dev_done_on', 'dev_done_workdays'),
                                ('prod_done_on', 'prod_done_workdays')):
                 stop = getattr(self, stop)
@@ -209,8 +224,6 @@ class Task(db.Model):
         if dt < self.created_on:
             return None
 
-        # hack to get around copying list bug with SQLA
-        del self.events
         cp = _copy_as_of(self, relateds=['iteration', 'user'])
 
         # update date fields
@@ -276,6 +289,84 @@ class Stat(db.Model):
     def __repr__(self):
         return '<Stat for {} at {} est>'.format(self.user, self.effort_est)
 
+class StatWindow(db.Model):
+    '''Model of cached trailing-window statistics about deliveries by
+       estimate, as a series of a stat for each of ``days`` days from
+       ``start_on``, packed into a single row (see
+       stats.make_trailing_stats).'''
+    # series packed, the rest of the columns of Stat are derived from these
+    SERIES = ('dev_done_sample_size', 'dev_done_mean', 'dev_done_stddev',
+              'prod_done_sample_size', 'prod_done_mean', 'prod_done_stddev',
+              'round_trips_sample_size', 'round_trips_mean',
+              'round_trips_stddev', 'failure_rate',)
+    SERIES_DTYPE = '<f4'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship('User', backref='stat_windows')
+    effort_est = db.Column(db.String(50), nullable=True)
+    window = db.Column(db.Integer, nullable=False) # in days
+
+    start_on = db.Column(db.DateTime, nullable=False)
+    days = db.Column(db.Integer, nullable=False)
+    # json of series name => base64 packed array, see encode
+    series = db.Column(db.Text, nullable=False)
+    db.Index('user_id_effort_est_window', user_id, effort_est, window,
+             unique=True)
+
+    def __repr__(self):
+        return '<StatWindow of {} days for {} at {} est>'.format(
+                   self.window, self.user, self.effort_est)
+
+    @classmethod
+    def encode(cls, arrays):
+        '''Return a dict of series name => array (NaN for no stat) packed
+           as a compact json string'''
+        return json.dumps(dict([
+                   (k, base64.b64encode(numpy.asarray(
+                           arrays[k]).astype(cls.SERIES_DTYPE).tostring()))
+                       for k in cls.SERIES]), sort_keys=True)
+
+    def arrays(self):
+        '''Return a dict of series name => float64 array, decoded'''
+        return dict([(k, numpy.frombuffer(base64.b64decode(v),
+                                          dtype=self.SERIES_DTYPE)\
+                             .astype(numpy.float64))
+                         for k,v in json.loads(self.series).iteritems()])
+
+    def rows(self, since=None, until=None):
+        '''Return a list of dicts of the stats of each day from ``since``
+           until ``until`` (default every day), keyed as Stat columns'''
+        first, last = 0, self.days - 1
+        if since is not None:
+            first = max(first, int(math.ceil(
+                        (since - self.start_on).total_seconds()/86400.)))
+        if until is not None:
+            last = min(last, int(math.floor(
+                       (until - self.start_on).total_seconds()/86400.)))
+        if first > last:
+            return []
+
+        cols = {}
+        for k,v in self.arrays().iteritems():
+            cols[k] = [None if x != x else x for x in v[first:last+1].tolist()]
+        for kind in ('dev_done', 'prod_done', 'round_trips'):
+            sizes = cols['_'.join([kind, 'sample_size'])]
+            cols['_'.join([kind, 'sample_size'])] = [int(n) for n in sizes]
+            cols['_'.join([kind, 'stderr'])] = stderrs = [
+                None if not n or sd is None else sd/math.sqrt(n)
+                    for n,sd in zip(sizes,
+                                    cols['_'.join([kind, 'stddev'])])]
+            cols['_'.join([kind, 'conf_int'])] = [
+                None if se is None else se * 1.96 for se in stderrs]
+
+        rows = []
+        for i in xrange(last - first + 1):
+            row = dict([(k, v[i]) for k,v in cols.iteritems()])
+            row['as_of'] = self.start_on + timedelta(days=first + i)
+            rows.append(row)
+        return rows
+
 #TODO: rank changes matter too
 class Event(db.Model):
     '''Model for observed events that require notification'''
@@ -328,8 +419,9 @@ class Event(db.Model):
              unique=True)
 
     def __repr__(self):
-        return '<Event {} on "{}" id: {}>'.format(self.type, self.task.name,
-                                                  self.id)
+        # NB: by task_id, so that repr never loads a task
+        return '<Event {} on task {} id: {}>'.format(self.type, self.task_id,
+                                                     self.id)
 
 # many-to-many for users <> simulation
 simulation_users = db.Table('simulation_users', db.metadata,
@@ -341,7 +433,13 @@ class Simulation(db.Model):
 
        simuation_on is the date from which the simulation was run, against
        progress. E.g. even if the simulation was run on day 3, if it was run
-       as though it was run on day 2, simulation_on would be day 2.'''
+       as though it was run on day 2, simulation_on would be day 2.
+
+       data is a simulate.Summary of completion dates across all plays, and
+       input_hash is a digest of all inputs to the simulation, used to avoid
+       re-running simulations whose inputs have not changed. critical_path
+       maps task ext_ids to the fraction of plays in which the task was on
+       the critical path to completion.'''
     id = db.Column(db.Integer, primary_key=True)
     simulation_on = db.Column(db.DateTime, nullable=False)
     iteration_id = db.Column(db.Integer, db.ForeignKey('iteration.id'),
@@ -352,11 +450,16 @@ class Simulation(db.Model):
 
     algorithm = db.Column(db.String(50), nullable=False)
     plays = db.Column(db.Integer, nullable=False)
+    seed = db.Column(db.Integer, nullable=True)
     earliest_date = db.Column(db.DateTime, nullable=True)
     latest_date = db.Column(db.DateTime, nullable=True)
 
-    data = db.Column(JSONField, nullable=True)
+    data = db.Column(SummaryField, nullable=True)
     errors = db.Column(JSONField, nullable=True)
+    critical_path = db.Column(JSONField, nullable=True)
+    input_hash = db.Column(db.String(40), nullable=True)
+    db.Index('iteration_id_simulation_on', iteration_id, simulation_on,
+             unique=True)
 
     def __repr__(self):
         return '<Simulation of {} from {}>'.format(self.iteration,
@@ -370,7 +473,11 @@ class Sync(db.Model):
     last_seen_update = db.Column(db.DateTime, nullable=False)
 
     type = db.Column(db.Enum('full', 'iteration', 'task', 'holiday',
-                             'vacation'), nullable=False)
+                             'vacation', 'stat', 'simulation', 'push',
+                             'backfill'),
+                     nullable=False)
+    # project_manager source sync'ed from, None for the project_manager link
+    source = db.Column(db.String(255), nullable=True)
 
     notes = db.Column(JSONField, nullable=True)
 
@@ -378,4 +485,4 @@ class Sync(db.Model):
         return "<Sync'ed {} on {}>".format(self.type, self.synced_on)
 
 __all__ = ['User', 'Holiday', 'Vacation', 'Iteration', 'Task', 'Stat',
-           'Event', 'Simulation', 'Sync']
+           'StatWindow', 'Event', 'Simulation', 'Sync']
@@ -0,0 +1,164 @@
+'''stackpm/querylog.py -- SQL query counting, for guarding query budgets
+
+   A QueryLog records every statement issued by the current thread while it
+   is open, by region. N+1 patterns, the same statement issued once per
+   object, show up as statements repeated many times, e.g.:
+
+     with QueryLog() as log:
+         with log.region('sync_tasks'):
+             sync_tasks(ids=ids)
+     print log.report()
+     log.check(120, region='sync_tasks')
+
+   or, to fail any code path issuing more than a budgeted number of queries:
+
+     with query_budget(120):
+         sync_tasks(ids=ids)
+
+   classes: QueryBudgetError, QueryLog
+   functions: query_budget
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import threading
+from contextlib import contextmanager
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+### GLOBALS
+REGION_SEP = '/'
+REPORT_WIDTH = 100
+
+# per-thread list of open QueryLogs
+_LOCAL = threading.local()
+
+### EXPOSED CLASSES
+class QueryBudgetError(AssertionError):
+    '''Raised when a region issues more queries than budgeted'''
+    def __init__(self, region, budget, issued, report):
+        self.region, self.budget, self.issued = region, budget, issued
+        super(QueryBudgetError, self).__init__(
+            '{} issued {} queries, budget {}\n{}'.format(
+                region or 'all', issued, budget, report))
+
+class QueryLog(object):
+    '''Context manager recording the statements issued while it is open.
+
+       ``statements`` is a list of tuples of length 3 of the region path the
+       statement was issued in, the statement and the repr of its
+       parameters.'''
+    def __init__(self):
+        self.statements = []
+        self.__regions = []
+
+    def __enter__(self):
+        _logs().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _logs().remove(self)
+        return False
+
+    def __repr__(self):
+        return '<QueryLog of {} queries>'.format(len(self.statements))
+
+    def __in(self, region):
+        '''Return the statements issued in ``region``, or all if None'''
+        if region is None:
+            return self.statements
+        return [s for s in self.statements if s[0] == region or
+                    s[0].startswith(region + REGION_SEP)]
+
+    @contextmanager
+    def region(self, name):
+        '''Attribute statements issued in the wrapped code to region
+           ``name``, nested under any open region.'''
+        self.__regions.append(name)
+        try:
+            yield self
+        finally:
+            self.__regions.pop()
+
+    def record(self, statement, parameters):
+        '''Record that ``statement`` was issued with ``parameters``'''
+        self.statements.append((REGION_SEP.join(self.__regions), statement,
+                                repr(parameters)))
+
+    def count(self, region=None):
+        '''Return the number of queries issued in ``region``, including its
+           sub-regions, or in total if ``region`` is None'''
+        return len(self.__in(region))
+
+    def repeated(self, region=None, top=None):
+        '''Return a list of tuples of length 2 of count and statement, for
+           statements issued more than once in ``region``, most first. Any
+           statement repeated once per object is a likely N+1.'''
+        counts = {}
+        for _, statement, _ in self.__in(region):
+            counts[statement] = counts.get(statement, 0) + 1
+        repeated = sorted([(n, s) for s,n in counts.iteritems() if n > 1],
+                          reverse=True)
+        return repeated[:top] if top else repeated
+
+    def duplicates(self, region=None, top=None):
+        '''Return a list of tuples of length 3 of count, statement and
+           parameters, for queries issued more than once with the same
+           parameters in ``region``, most first. Each is cacheable.'''
+        counts = {}
+        for _, statement, params in self.__in(region):
+            key = (statement, params)
+            counts[key] = counts.get(key, 0) + 1
+        duplicates = sorted([(n, s, p) for (s, p),n in counts.iteritems()
+                                 if n > 1], reverse=True)
+        return duplicates[:top] if top else duplicates
+
+    def report(self, region=None, top=10):
+        '''Return a printable report of the queries issued in ``region``,
+           with the ``top`` most repeated statements.'''
+        statements = self.__in(region)
+        lines = ['{}: {} queries, {} distinct, {} duplicates'.format(
+                     region or 'all', len(statements),
+                     len(set([s for _,s,_ in statements])),
+                     sum([n - 1 for n,_,_ in self.duplicates(region)]))]
+        for n, statement in self.repeated(region, top):
+            lines.append('  {:>6}  {}'.format(
+                n, ' '.join(statement.split())[:REPORT_WIDTH]))
+        return '\n'.join(lines)
+
+    def check(self, budget, region=None):
+        '''Raise QueryBudgetError if more than ``budget`` queries were issued
+           in ``region``'''
+        issued = self.count(region)
+        if issued > budget:
+            raise QueryBudgetError(region, budget, issued,
+                                   self.report(region))
+
+### INTERNAL METHODS
+def _logs():
+    '''Return this thread's list of open QueryLogs'''
+    try:
+        return _LOCAL.logs
+    except AttributeError:
+        _LOCAL.logs = []
+        return _LOCAL.logs
+
+def _record(conn, cursor, statement, parameters, context, executemany):
+    '''SQLAlchemy before_cursor_execute hook, recording to open logs'''
+    for log in getattr(_LOCAL, 'logs', ()):
+        log.record(statement, parameters)
+
+### EXPOSED METHODS
+@contextmanager
+def query_budget(budget):
+    '''Raise QueryBudgetError if the wrapped code issues more than
+       ``budget`` queries'''
+    with QueryLog() as log:
+        yield log
+    log.check(budget)
+
+event.listen(Engine, 'before_cursor_execute', _record)
+
+__all__ = ['REGION_SEP', 'QueryBudgetError', 'QueryLog', 'query_budget']
@@ -0,0 +1,88 @@
+'''stackpm/settings.py -- lazily loaded config for stackpm
+
+   Config is read from the file named by $STACKPM_CONFIG (default:
+   /etc/stackpm.cfg) on first use, rather than on import. This module
+   imports neither flask nor a database driver, so that modules needing
+   only config import quickly.
+
+   classes: LazyConfig
+   objects: config
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import os
+import threading
+
+### 3RD PARTY IMPORTS
+import betterconfig
+
+### GLOBALS
+STACKPM_CONFIG_ENV = 'STACKPM_CONFIG'
+STACKPM_CONFIG_DFLT = '/etc/stackpm.cfg'
+
+# guards loading config, which may be triggered from any thread
+_LOAD_LOCK = threading.Lock()
+
+### INTERNAL METHODS
+def _load_config():
+    '''Load and return the config dict'''
+    config = betterconfig.load(os.environ.get(STACKPM_CONFIG_ENV,
+                                              STACKPM_CONFIG_DFLT))
+    config['SQLALCHEMY_DATABASE_URI'] = config.pop('db', None)
+    config.setdefault('debug', False)
+    return config
+
+### EXPOSED CLASSES
+class LazyConfig(object):
+    '''Proxy to the config dict returned by ``loader``, which is called on
+       first use'''
+    def __init__(self, loader):
+        self.__loader = loader
+        self.__config = None
+
+    def __get(self):
+        if self.__config is None:
+            with _LOAD_LOCK:
+                if self.__config is None:
+                    self.__config = self.__loader()
+        return self.__config
+
+    def __repr__(self):
+        if self.__config is None:
+            return '<LazyConfig (not loaded)>'
+        return repr(self.__config)
+
+    def __getattr__(self, name):
+        # e.g. copy and pickle probe instances that were never initialized
+        if name.startswith('_LazyConfig__'):
+            raise AttributeError(name)
+        return getattr(self.__get(), name)
+
+    def __getitem__(self, key):
+        return self.__get()[key]
+
+    def __setitem__(self, key, val):
+        self.__get()[key] = val
+
+    def __delitem__(self, key):
+        del self.__get()[key]
+
+    def __contains__(self, key):
+        return key in self.__get()
+
+    def __iter__(self):
+        return iter(self.__get())
+
+    def __len__(self):
+        return len(self.__get())
+
+    @property
+    def loaded(self):
+        '''True once config has been loaded'''
+        return self.__config is not None
+
+### EXPOSED OBJECTS
+config = LazyConfig(_load_config)
+
+__all__ = ['STACKPM_CONFIG_ENV', 'STACKPM_CONFIG_DFLT', 'LazyConfig', 'config']
@@ -0,0 +1,501 @@
+'''stackpm/simulate.py -- simulation kernels for stackpm forecasts
+
+   Kernels operate on plain numbers and numpy arrays only, all database
+   access is done by the caller (see stats.forecast).
+
+   classes: Evidence, Summary, CycleError
+   functions: draw, toposort, schedule, critical_path, converged, batches,
+              play_batch, play
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import base64
+import hashlib
+import heapq
+import json
+import math
+from datetime import date, datetime
+from itertools import islice
+
+### 3RD PARTY IMPORTS
+import numpy
+
+### INTERNAL IMPORTS
+from .calendars import workday_offsets, ordinals
+
+### GLOBALS
+ALGORITHMS = ('monte-carlo', 'normal', 'lognormal')
+PERCENTILES = (50, 75, 90, 98)
+DATE_FMT = '%Y-%m-%d'
+MAX_SEED = 2**32 - 1
+
+# histogram counts are packed little-endian unsigned 32-bit
+_COUNT_DTYPE = '<u4'
+
+### EXPOSED CLASSES
+class Evidence(object):
+    '''Time-ordered delivery evidence for a single user/estimate pair, with
+       exponentially decayed weights which are advanced a day at a time.
+
+       ``items`` is an iterable of tuples of length 3: the date ordinal the
+       task was done on, its dev_done_workdays and its prod_done_workdays.'''
+    def __init__(self, items, halflife):
+        items = sorted(items)
+        self.done_on = numpy.array([i[0] for i in items], dtype=numpy.int64)
+        self.dev = numpy.array([i[1] for i in items], dtype=numpy.float64)
+        self.prod = numpy.array([i[2] for i in items], dtype=numpy.float64)
+        self.decay = 0.5**(1/float(halflife))
+        self.weights = numpy.empty(0, dtype=numpy.float64)
+        self.day, self.seen = None, 0
+        self.__digest = (None, None)
+
+    def __len__(self):
+        return len(self.done_on)
+
+    def __repr__(self):
+        return '<Evidence {} of {} on {}>'.format(self.seen, len(self),
+                                                  self.day)
+
+    def advance(self, day):
+        '''Decay weights forward to date ordinal ``day``, taking in any
+           evidence done on or before ``day``. Return True if new evidence
+           was taken in.'''
+        if self.day is not None:
+            if day < self.day:
+                raise ValueError('Cannot advance evidence backwards')
+            self.weights *= self.decay**(day - self.day)
+
+        seen = int(numpy.searchsorted(self.done_on, day, side='right'))
+        if seen > self.seen:
+            self.weights = numpy.concatenate([
+                self.weights, self.decay**(day - self.done_on[self.seen:seen])
+            ])
+        new, self.day, self.seen = seen > self.seen, day, seen
+        return new
+
+    def digest(self):
+        '''Return a hex digest of the evidence seen so far and its decay'''
+        if self.__digest[0] != self.seen:
+            sha = hashlib.sha1(repr(self.decay))
+            for vals in (self.done_on, self.dev, self.prod):
+                sha.update(vals[:self.seen].tostring())
+            self.__digest = (self.seen, sha.hexdigest())
+        return self.__digest[1]
+
+    def relevant(self, so_far=0, dev_so_far=0):
+        '''Return correlated arrays of prod_done_workdays and weights for
+           the evidence seen so far that is consistent with a task which has
+           been in progress ``so_far`` workdays, and dev done in no fewer
+           than ``dev_so_far`` workdays.'''
+        mask = (self.prod[:self.seen] >= so_far) & \
+               (self.dev[:self.seen] >= dev_so_far)
+        return self.prod[:self.seen][mask], self.weights[mask]
+
+class Summary(object):
+    '''Single-day resolution histogram of simulated completion dates, with
+       summary percentiles.
+
+       Summaries are stored as a short json document of percentiles and a
+       packed histogram, which is only unpacked when ``counts`` is needed,
+       so reading percentiles never touches per-play data. Summaries of
+       independent plays may be merged exactly.'''
+    def __init__(self, base, counts, percentiles=None):
+        self.base = base
+        self.__counts = counts
+        self.__percentiles = percentiles
+
+    def __repr__(self):
+        return '<Summary of {} plays from {}>'.format(
+                   self.plays, date.fromordinal(self.base))
+
+    @classmethod
+    def from_ordinals(cls, ordinals):
+        '''Return a Summary of an array of completion date ordinals'''
+        ordinals = numpy.asarray(ordinals, dtype=numpy.int64)
+        base = int(ordinals.min())
+        return cls(base, numpy.bincount(ordinals - base))
+
+    @classmethod
+    def loads(cls, encoded):
+        '''Return a Summary from a string produced by ``dumps``, leaving the
+           histogram packed until it is needed.'''
+        decoded = json.loads(encoded)
+        return cls(_ordinal(decoded['base']), decoded['counts'], {
+                       int(p):_ordinal(d)
+                           for p,d in decoded['percentiles'].iteritems()})
+
+    def dumps(self):
+        '''Return self encoded as a compact json string'''
+        return json.dumps({
+            'base': date.fromordinal(self.base).strftime(DATE_FMT),
+            'counts': base64.b64encode(
+                          self.counts.astype(_COUNT_DTYPE).tostring()),
+            'percentiles': self.as_dict()['percentiles'],
+        })
+
+    def as_dict(self):
+        '''Return a JSON-able dict of self, with dates formatted'''
+        return {'base': date.fromordinal(self.base).strftime(DATE_FMT),
+                'counts': self.counts.tolist(),
+                'percentiles': {
+                    str(p):date.fromordinal(o).strftime(DATE_FMT)
+                        for p,o in self.percentiles.iteritems()}}
+
+    @property
+    def counts(self):
+        '''Histogram of plays completing on each day from base'''
+        if isinstance(self.__counts, basestring):
+            self.__counts = numpy.frombuffer(
+                                base64.b64decode(self.__counts),
+                                dtype=_COUNT_DTYPE).astype(numpy.int64)
+        return self.__counts
+
+    @property
+    def percentiles(self):
+        '''Dict of PERCENTILES => completion date ordinals'''
+        if self.__percentiles is None:
+            self.__percentiles = {p:self.percentile(p) for p in PERCENTILES}
+        return self.__percentiles
+
+    @property
+    def plays(self):
+        return int(self.counts.sum())
+
+    @property
+    def earliest(self):
+        return self.base
+
+    @property
+    def latest(self):
+        return self.base + len(self.counts) - 1
+
+    def __at_rank(self, cumulative, rank):
+        '''Return the ordinal of the ``rank``-th play, counting from 0'''
+        return self.base + int(numpy.searchsorted(cumulative, rank,
+                                                  side='right'))
+
+    def percentile(self, p):
+        '''Return the completion date ordinal at percentile ``p``'''
+        if self.__percentiles is not None and p in self.__percentiles:
+            return self.__percentiles[p]
+        cumulative = numpy.cumsum(self.counts)
+        return self.__at_rank(cumulative,
+                              int(math.floor((cumulative[-1] - 1)*p/100.)))
+
+    def interval(self, p, z=1.96):
+        '''Return a tuple of length 2 of the low and high completion date
+           ordinals bounding the ``z`` confidence interval of percentile
+           ``p``, using the normal approximation to the binomial distribution
+           of the rank of the percentile.'''
+        cumulative = numpy.cumsum(self.counts)
+        plays, q = int(cumulative[-1]), p/100.
+        spread = z*math.sqrt(plays*q*(1 - q))
+        low = max(int(math.floor(plays*q - spread)), 0)
+        high = min(int(math.ceil(plays*q + spread)), plays - 1)
+        return (self.__at_rank(cumulative, low),
+                self.__at_rank(cumulative, high))
+
+    def merge(self, other):
+        '''Return a new Summary of the plays in both self and ``other``'''
+        base = min(self.base, other.base)
+        counts = numpy.zeros(max(self.latest, other.latest) - base + 1,
+                             dtype=numpy.int64)
+        for summary in (self, other):
+            offset = summary.base - base
+            counts[offset:offset + len(summary.counts)] += summary.counts
+        return Summary(base, counts)
+
+class CycleError(ValueError):
+    '''Raised when task dependencies form a cycle, ``keys`` being the keys
+       of the tasks on the cycle'''
+    def __init__(self, keys):
+        self.keys = list(keys)
+        super(CycleError, self).__init__('Dependency cycle between: {}'.format(
+            ', '.join([str(k) for k in self.keys])))
+
+### INTERNAL METHODS
+def _ordinal(formatted):
+    '''Return the date ordinal of a DATE_FMT string'''
+    return datetime.strptime(formatted, DATE_FMT).toordinal()
+
+def _stream(seed, batch, key):
+    '''Return the independent random stream for task ``key`` in batch
+       number ``batch`` of a simulation seeded with ``seed``'''
+    return numpy.random.RandomState([seed, batch, key])
+
+def _queue_blockers(queues, blockers):
+    '''Return ``blockers`` with each task also blocked by its user's
+       previous task in ``queues``'''
+    blockers = {k:list(v) for k,v in blockers.iteritems()}
+    for _, keys in queues.itervalues():
+        for prev, key in zip(keys, keys[1:]):
+            blockers.setdefault(key, []).append(prev)
+    return blockers
+
+def _play_batch(args):
+    '''Unpack args for play_batch, for use with Pool.map'''
+    return play_batch(*args)
+
+### EXPOSED METHODS
+def draw(vals, weights, so_far, size, rng, algorithm='monte-carlo'):
+    '''Return an array of ``size`` remaining workdays for a task that has
+       been in progress ``so_far`` workdays, drawn from correlated evidence
+       ``vals`` and ``weights`` using ``algorithm``, or None if there is no
+       evidence to draw from.'''
+    if not len(vals) or not weights.sum() > 0:
+        return None
+
+    if algorithm == 'monte-carlo':
+        drawn = rng.choice(vals, size=size, p=weights/weights.sum())
+    elif algorithm in ('normal', 'lognormal'):
+        mean = numpy.average(vals, weights=weights)
+        stddev = math.sqrt(numpy.average((vals-mean)**2, weights=weights))
+        if algorithm == 'normal':
+            drawn = rng.normal(mean, stddev, size)
+        else:
+            # lognormal mu and sigma from the normal mean and stddev
+            sigma = math.sqrt(math.log(1 + stddev**2/mean**2))
+            drawn = rng.lognormal(math.log(mean) - sigma**2/2, sigma, size)
+        # lowest permissible time to prod is a full day
+        drawn = numpy.maximum(numpy.ceil(drawn), max(so_far, 1))
+    else:
+        raise ValueError('Unknown algorithm: {}'.format(algorithm))
+
+    return drawn - so_far
+
+def toposort(keys, blockers):
+    '''Return ``keys``, which are in priority order, reordered so that each
+       key follows the keys in ``blockers``, a dict of key => keys which
+       must be done first, and otherwise stays in priority order. Blockers
+       not in ``keys`` are ignored.
+
+       Raise CycleError with the keys on any cycle in ``blockers``.'''
+    position = {k:i for i,k in enumerate(keys)}
+    waiting, blocks = {}, {}
+    for key in keys:
+        waiting[key] = {b for b in blockers.get(key, ()) if b in position}
+        for blocker in waiting[key]:
+            blocks.setdefault(blocker, []).append(key)
+
+    ready = [position[k] for k in keys if not waiting[k]]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        key = keys[heapq.heappop(ready)]
+        ordered.append(key)
+        for blocked in blocks.get(key, ()):
+            waiting[blocked].discard(key)
+            if not waiting[blocked]:
+                heapq.heappush(ready, position[blocked])
+
+    if len(ordered) < len(keys):
+        # whatever is left waits on a cycle, strip keys only downstream of it
+        left = {k for k in keys if waiting[k]}
+        while True:
+            downstream = {k for k in left
+                              if not left.intersection(blocks.get(k, ()))}
+            if not downstream:
+                break
+            left -= downstream
+        raise CycleError([k for k in keys if k in left])
+    return ordered
+
+def schedule(queues, remaining, blockers=None, order=None, finished=None):
+    '''Return a dict of task key => array of finish offsets, in workdays
+       from the simulation day, for ``queues``, a dict of user key => tuple
+       of length 2 of the user's start offset and task keys in the order
+       they are worked, where ``remaining`` maps task keys to arrays of
+       remaining workdays.
+
+       If passed, ``blockers`` maps task keys to the keys of tasks which must
+       finish before they can start, so each task starts when both its user
+       and its blockers are done. ``order`` is every task key, each after
+       its blockers and its user's previous task, and defaults to the keys
+       of ``queues`` sorted so.
+
+       If passed, ``finished`` holds finish offsets already known for the
+       tasks of some users, whose timelines are kept rather than re-played.'''
+    finished = dict(finished or {})
+    if not blockers:
+        for start, keys in queues.itervalues():
+            avail = start
+            for key in keys:
+                avail = finished.get(key, avail + remaining[key])
+                finished[key] = avail
+        return finished
+
+    avail, user_of = {}, {}
+    for user,(start, keys) in queues.iteritems():
+        avail[user] = start
+        user_of.update((k, user) for k in keys)
+    if order is None:
+        order = toposort([k for _,keys in queues.itervalues() for k in keys],
+                         _queue_blockers(queues, blockers))
+
+    for key in order:
+        user = user_of[key]
+        if key in finished:
+            avail[user] = finished[key]
+            continue
+        start = avail[user]
+        for blocker in blockers.get(key, ()):
+            if blocker in finished:
+                start = numpy.maximum(start, finished[blocker])
+        finished[key] = avail[user] = start + remaining[key]
+    return finished
+
+def critical_path(queues, finished, ends, blockers=None):
+    '''Return a dict of task key => the number of plays in which the task
+       is on the critical path to whichever of task keys ``ends`` finishes
+       last, for ``finished`` as returned by schedule for ``queues`` and
+       ``blockers``.
+
+       Each task on the path is preceded by whichever of its user's
+       previous task and its blockers finished last, unless its user's
+       start offset was later still.'''
+    keys = list(finished)
+    index = {k:i for i,k in enumerate(keys)}
+    finish = numpy.array([finished[k] for k in keys])
+    plays = numpy.arange(finish.shape[1])
+    blockers = blockers or {}
+
+    # index of the task each task waited on, per play, or -1
+    preds = numpy.empty(finish.shape, dtype=numpy.int64)
+    preds.fill(-1)
+    for start, queue in queues.itervalues():
+        for i,key in enumerate(queue):
+            waited = [index[b] for b in blockers.get(key, ()) if b in index]
+            if i:
+                waited.append(index[queue[i-1]])
+            if not waited:
+                continue
+            waited = numpy.array(waited)
+            latest = finish[waited].argmax(axis=0)
+            preds[index[key]] = numpy.where(
+                finish[waited[latest], plays] >= start, waited[latest], -1)
+
+    # walk back from the last to finish in every play at once
+    ends = numpy.array([index[k] for k in ends])
+    on = ends[finish[ends].argmax(axis=0)]
+    counts = numpy.zeros(len(keys), dtype=numpy.int64)
+    while len(on):
+        counts += numpy.bincount(on, minlength=len(keys))
+        on = preds[on, plays]
+        plays, on = plays[on >= 0], on[on >= 0]
+    return {keys[i]:int(c) for i,c in enumerate(counts) if c}
+
+def converged(summary, tolerance, percentiles=PERCENTILES, z=1.96):
+    '''Return True if the ``z`` confidence interval of each of
+       ``percentiles`` in ``summary`` spans no more than ``tolerance`` days
+       either side.'''
+    for p in percentiles:
+        low, high = summary.interval(p, z)
+        if (high - low)/2. > tolerance:
+            return False
+    return True
+
+def batches(plays, size):
+    '''Return a list of tuples of length 2 of batch number and batch size
+       for ``plays`` plays in batches of ``size``'''
+    return [(i, min(size, plays - i*size))
+                for i in xrange(int(math.ceil(plays/float(size))))]
+
+def play_batch(spec, batch, size, draws=None, timelines=None):
+    '''Play batch number ``batch`` of ``size`` plays of simulation ``spec``
+       and return a tuple of length 2 of a dict of group key => Summary of
+       completion dates, and a dict of group key => task key => the number
+       of plays in which the task was on the group's critical path.
+
+       ``spec`` is a dict of: day, the datetime simulated from; seed;
+       algorithm; tasks, a dict of task key => (vals, weights, so_far) for
+       draw; queues, blockers and order, as for schedule; groups, a dict of
+       group key => task keys, a group being done when all of its tasks are
+       done; and days_off, a dict of user key => datetime64[D] array of days
+       not worked (see calendars.dates).
+
+       If passed, ``draws`` is a dict of task key => batch => draws, used
+       to reuse and store draws for tasks with unchanged inputs, and
+       ``timelines`` is a dict of user key => batch => task key => finish
+       offsets, used to reuse and store the timelines of users whose tasks
+       and their blockers are unchanged.'''
+    remaining = {}
+    for key,(vals, weights, so_far) in spec['tasks'].iteritems():
+        drawn = None
+        if draws is not None:
+            drawn = draws.setdefault(key, {}).get(batch)
+        if drawn is None or len(drawn) != size:
+            drawn = draw(vals, weights, so_far, size,
+                         _stream(spec['seed'], batch, key), spec['algorithm'])
+            if draws is not None:
+                draws[key][batch] = drawn
+        remaining[key] = drawn
+
+    known = {}
+    if timelines is not None:
+        for user,(_, keys) in spec['queues'].iteritems():
+            timeline = timelines.get(user, {}).get(batch)
+            if timeline is not None and len(timeline) == len(keys) and \
+                    all([k in timeline for k in keys]):
+                known.update(timeline)
+    blockers = spec.get('blockers')
+    finished = schedule(spec['queues'], remaining, blockers,
+                        spec.get('order'), known)
+    if timelines is not None:
+        for user,(_, keys) in spec['queues'].iteritems():
+            timelines.setdefault(user, {})[batch] = {k:finished[k]
+                                                         for k in keys}
+
+    # a group is done for a user when the user's last task in it is done
+    users, ends = list(spec['queues']), []
+    for group, keys in spec['groups'].iteritems():
+        keys = set(keys)
+        for i,user in enumerate(users):
+            in_group = [k for k in spec['queues'][user][1] if k in keys]
+            if in_group:
+                ends.append((group, i, in_group[-1]))
+
+    # convert every finish on its user's calendar in a single call
+    done_on = ordinals(workday_offsets(
+        spec['day'], numpy.concatenate([finished[k] for _,_,k in ends]),
+        days_off={i:spec['days_off'][u] for i,u in enumerate(users)},
+        keys=numpy.repeat([i for _,i,_ in ends], size))).reshape(
+            len(ends), size)
+
+    completions, group_ends = {}, {}
+    for row,(group, _, key) in enumerate(ends):
+        completions[group] = done_on[row] if group not in completions else \
+                             numpy.maximum(completions[group], done_on[row])
+        group_ends.setdefault(group, []).append(key)
+    return ({g:Summary.from_ordinals(c) for g,c in completions.iteritems()},
+            {g:critical_path(spec['queues'], finished, keys, blockers)
+                 for g,keys in group_ends.iteritems()})
+
+def play(spec, batches, pool=None, workers=1, draws=None, timelines=None):
+    '''Generate tuples of length 3 of batch size, a dict of group key =>
+       Summary and a dict of group key => critical path counts, as for
+       play_batch, for each batch number and size in ``batches``, in order.
+
+       If ``pool`` is passed, ``workers`` batches at a time are played in
+       ``pool``, otherwise batches are played in-process one at a time,
+       reusing ``draws`` and ``timelines`` as for play_batch. As each batch
+       draws from its own stream, results are identical either way.'''
+    batches = iter(batches)
+    if pool is None:
+        for batch, size in batches:
+            summaries, critical = play_batch(spec, batch, size, draws=draws,
+                                             timelines=timelines)
+            yield size, summaries, critical
+    else:
+        while True:
+            round_ = list(islice(batches, workers))
+            if not round_:
+                break
+            results = pool.map(_play_batch, [(spec, batch, size)
+                                                 for batch, size in round_])
+            for (_, size), (summaries, critical) in zip(round_, results):
+                yield size, summaries, critical
+
+__all__ = ['ALGORITHMS', 'PERCENTILES', 'DATE_FMT', 'MAX_SEED', 'Evidence',
+           'Summary', 'CycleError', 'draw', 'toposort', 'schedule',
+           'critical_path', 'converged', 'batches', 'play_batch', 'play']
@@ -1,21 +1,169 @@
 '''stackpm/stats.py -- API for computing stats
 
-   functions: make_stats, forecast
+   classes: WhatIf
+   functions: make_stats, make_trailing_stats, forecast, forecast_portfolio
    @author: Matthew Story <matt.story@axial.net>
    @license: BSD 3-Clause (see LICENSE.txt)'''
 
 ### STANDARD LIBRARY IMPORTS
 from datetime import datetime, timedelta
+import hashlib
 import math
+import multiprocessing
 import random
+import threading
 
 ### 3RD PARTY IMPORTS
 import numpy
-from workdays import workday, networkdays
+from workdays import networkdays
 
 ### INTERNAL IMPORTS
-from . import null, db, config
-from .models import Task, Stat, Holiday, Vacation
+# NB: models are imported where used, so that importing stats imports
+#     neither flask nor flask-sqlalchemy
+from . import null, db, config, simulate, calendars
+
+### GLOBALS
+WINDOWS_DFLT = (30, 90, 180,)
+
+# event types that change task state => task attribute
+_EVENT_CHANGES = {'iteration-change': 'iteration_id',
+                  'estimate-change': 'effort_est',
+                  'user-change': 'user_id'}
+_TASK_STATE = ('id', 'ext_id', 'rank', 'user_id', 'iteration_id',
+               'effort_est', 'started_on', 'dev_done_on', 'prod_done_on',
+               'dev_done_workdays', 'resolution')
+
+### EXPOSED CLASSES
+class WhatIf(object):
+    '''A warm model of ``iters`` on ``day`` (default: now), for simulating
+       edits to them interactively.
+
+       Tasks, evidence and calendars are loaded, and the unedited iterations
+       simulated, once. Each call to simulate then only re-draws edited
+       tasks, and only re-plays the timelines of users whose tasks, or whose
+       tasks' blockers, are affected by the edits. Calls to simulate are
+       serialized, as reassignments load users into the shared model.
+       Other arguments are as for forecast_portfolio.'''
+    EDITS = ('reassign', 'estimate', 'remove', 'block')
+
+    def __init__(self, iters, day=None, algorithm=None, plays=None,
+                 start_dates=None, adaptive=null, seed=None):
+        self.day = day or datetime.now()
+        self.opts = _forecast_opts(algorithm, plays, adaptive, seed, 1)
+        self.start_dates = start_dates or {}
+        self.ctx = _load_forecast(iters, self.day, self.opts['halflife'])
+        self.__advance()
+        self.tasks = _open_tasks(self.ctx, self.day,
+                                 self.opts['discard_resolutions'])
+
+        # inputs, draws and timelines of the unedited model, kept warm
+        self.inputs, self.draws, self.timelines = {}, {}, {}
+        self.spec, sims, _ = _day_spec(self.ctx, self.opts, self.day,
+                                       self.tasks, self.start_dates,
+                                       self.inputs, self.draws)
+        self.baseline = _play(self.ctx, self.opts, self.spec, sims,
+                              draws=self.draws, timelines=self.timelines)
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<WhatIf of {} on {}>'.format(
+            ', '.join([i.ext_id for i in self.ctx['iters'].itervalues()]),
+            self.day)
+
+    def __advance(self):
+        '''Advance all loaded evidence to the model's day'''
+        for u_evidence in self.ctx['evidence'].itervalues():
+            u_evidence.advance(self.day.toordinal())
+
+    def __affected(self, spec, inputs):
+        '''Return the set of user ids whose timelines in ``spec`` may differ
+           from those of the unedited model'''
+        user_of = {k:u for u,(_, keys) in spec['queues'].iteritems()
+                       for k in keys}
+        affected = {u for u,q in spec['queues'].iteritems()
+                        if q != self.spec['queues'].get(u)}
+        affected |= {u for k,u in user_of.iteritems()
+                         if inputs[k] != self.inputs.get(k) or
+                            spec['blockers'].get(k) != \
+                                self.spec['blockers'].get(k)}
+
+        # users waiting on affected users are affected in turn
+        changed = True
+        while changed:
+            changed = False
+            for key, blockers in spec['blockers'].iteritems():
+                if user_of[key] not in affected and \
+                        any([user_of[b] in affected for b in blockers]):
+                    affected.add(user_of[key])
+                    changed = True
+        return affected
+
+    def simulate(self, edits):
+        '''Return a dict of iteration id => simulation dict, as for
+           forecast_portfolio, of the model with ``edits`` applied, leaving
+           the model itself unedited. ``edits`` is a list of tuples of an
+           edit from EDITS and its arguments:
+
+             ('reassign', ext_id, email): move a task to another user
+             ('estimate', ext_id, effort_est): re-estimate a task
+             ('remove', ext_id): drop a task
+             ('block', ext_id, blocker_ext_id): make a task wait on another
+
+           Raise ValueError on unknown edits, open tasks or users, and
+           simulate.CycleError if edits introduce a dependency cycle.'''
+        with self.__lock:
+            return self.__simulate(edits)
+
+    def __simulate(self, edits):
+        '''simulate, with the model locked'''
+        from .models import User
+        ctx = dict(self.ctx, blockers={k:list(v) for k,v in
+                                           self.ctx['blockers'].iteritems()})
+        states = [dict(s) for s in self.tasks]
+        by_ext_id = {s['ext_id']:s for s in states}
+        for edit in edits:
+            kind, args = edit[0], list(edit[1:])
+            if kind not in self.EDITS:
+                raise ValueError('Unknown edit: {}'.format(kind))
+            args += [None]*(2 - len(args))
+            state = by_ext_id.get(args[0])
+            if state is None:
+                raise ValueError('No open task: {}'.format(args[0]))
+
+            if kind == 'reassign':
+                user = User.query.filter_by(email=args[1]).first()
+                if user is None:
+                    raise ValueError('No user: {}'.format(args[1]))
+                _load_users(self.ctx, [user.id], self.day,
+                            self.opts['halflife'])
+                self.__advance()
+                state['user_id'] = user.id
+            elif kind == 'estimate':
+                state['effort_est'] = args[1]
+            elif kind == 'remove':
+                states.remove(by_ext_id.pop(args[0]))
+            else:
+                blocker = by_ext_id.get(args[1])
+                if blocker is None:
+                    raise ValueError('No open task: {}'.format(args[1]))
+                ctx['blockers'].setdefault(state['id'], []).append(
+                    blocker['id'])
+
+        # cycles already in the model are reported by _day_spec
+        ids = [s['id'] for s in states]
+        cycle = _cycle(ids, ctx['blockers']) - \
+                _cycle(ids, self.ctx['blockers'])
+        if cycle:
+            raise simulate.CycleError([ctx['ext_ids'][k] for k in ids
+                                           if k in cycle])
+
+        inputs, draws = dict(self.inputs), dict(self.draws)
+        spec, sims, _ = _day_spec(ctx, self.opts, self.day, states,
+                                  self.start_dates, inputs, draws)
+        affected = self.__affected(spec, inputs)
+        return _play(ctx, self.opts, spec, sims, draws=draws, timelines={
+                         u:t for u,t in self.timelines.iteritems()
+                             if u not in affected})
 
 ### INTERNAL METHODS
 def _default_stat(user, est, as_of):
@@ -78,17 +226,34 @@ def _sequence_ewma(items, for_day, halflife):
         weights.append(0.5**((for_day - dt).days/halflife))
     return (evidence, weights)
 
-
-### EXPOSED METHODS
-def make_stats(user, est, since=null, until=null):
-    '''Return an iterable of Stat objects for ``user``/``est`` for every day
-       since ``since``. If ``since`` is not passed, return Stat objects for
-       all time.'''
+def _trailing(items, days, window):
+    '''Return a tuple of length 3 of arrays of the sample size, mean and
+       stddev of the values of ``items``, time sorted tuples of length 2 of a
+       datetime and a value, done in the ``window`` days up to each of
+       ``days``, a datetime64 array. Windows are bounded by binary search
+       and summed from prefix sums, rather than re-scanning items each day.'''
+    done_on = numpy.array([dt for dt,_ in items], dtype='datetime64[us]')
+    vals = numpy.array([v for _,v in items], dtype=numpy.float64)
+    sums = numpy.concatenate(([0.], numpy.cumsum(vals)))
+    squares = numpy.concatenate(([0.], numpy.cumsum(vals**2)))
+
+    high = numpy.searchsorted(done_on, days, side='right')
+    low = numpy.searchsorted(done_on, days - numpy.timedelta64(window, 'D'),
+                             side='right')
+    sizes = high - low
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[high] - sums[low])/sizes
+        variances = (squares[high] - squares[low])/sizes - means**2
+    # clip rounding error below 0
+    return sizes, means, numpy.sqrt(numpy.maximum(variances, 0))
+
+def _load_dones(user, est):
+    '''Return a dict of kind => time sorted list of tuples of length 2 of
+       the datetime done and value, of the tasks ``user`` has done of
+       ``est``, for dev_done, prod_done, round_trips and failures'''
+    from .models import Task
     dones = {'dev_done': [], 'prod_done': [], 'round_trips': [],
              'failures': []}
-    until = datetime.now() if until is null else until
-    halflife = float(config.get('forecast', {}).get('halflife', 30))
-    discard_resolutions = config.get('tasks', {}).get('discard_resolutions')
     failure_res = config.get('tasks', {}).get('failure_resolution')
     tasks = Task.query.filter(db.and_(Task.user == user,
                                       Task.effort_est == est, db.or_(
@@ -96,9 +261,7 @@ def make_stats(user, est, since=null, until=null):
                                       )))
 
     # filter-out resolutions we don't count for stats
-    if discard_resolutions:
-        tasks = tasks.filter(db.or_(Task.resolution == None,
-                                    ~Task.resolution.in_(discard_resolutions)))
+    tasks = _discard_filter(tasks)
     # unpack tasks
     for task in tasks.all():
         if task.dev_done_on and task.dev_done_workdays:
@@ -112,11 +275,131 @@ def make_stats(user, est, since=null, until=null):
             dones['failures'].append((task.prod_done_on,
                                       int(bool(task.resolution == failure_res))))
     # time sort
-    lows = []
     for k in dones:
         dones[k].sort(key=lambda x:x[0])
-        if len(dones[k]):
-            lows.append(dones[k][0][0])
+    return dones
+
+def _discard_filter(query):
+    '''Filter out tasks with resolutions we don't count as evidence'''
+    from .models import Task
+    discard_resolutions = config.get('tasks', {}).get('discard_resolutions')
+    if discard_resolutions:
+        query = query.filter(db.or_(Task.resolution == None,
+                                    ~Task.resolution.in_(discard_resolutions)))
+    return query
+
+def _iteration_tasks(iters):
+    '''Return a list of all tasks that have ever been in any of ``iters``
+       and a dict of task id => events, most recent first, in 2 queries.'''
+    from .models import Task, Event
+    ids = [i.id for i in iters]
+    tasks = Task.query.outerjoin(Event, Event.task_id == Task.id).filter(
+                db.or_(Task.iteration_id.in_(ids),
+                       Event.from_iteration_id.in_(ids),
+                       Event.iteration_id.in_(ids))).distinct()\
+                .order_by(Task.id).all()
+    events = {}
+    if tasks:
+        for ev in Event.query.filter(Event.task_id.in_([t.id for t in tasks]))\
+                             .order_by(Event.occured_on.desc()).all():
+            events.setdefault(ev.task_id, []).append(ev)
+    return tasks, events
+
+def _task_blockers(tasks):
+    '''Return a dict of task id => ids of the tasks blocking it, for every
+       dependency between ``tasks``, in a single query'''
+    from .models import task_dependencies
+    blockers = {}
+    ids = [t.id for t in tasks]
+    if ids:
+        for blocks_id, blocked_id in db.session.query(
+                task_dependencies.c.blocks_id,
+                task_dependencies.c.blocked_id).filter(db.and_(
+                    task_dependencies.c.blocks_id.in_(ids),
+                    task_dependencies.c.blocked_id.in_(ids))):
+            blockers.setdefault(blocked_id, []).append(blocks_id)
+    return blockers
+
+def _cycle(ids, blockers):
+    '''Return the set of task ``ids`` on any dependency cycle in
+       ``blockers``'''
+    try:
+        simulate.toposort(ids, blockers)
+    except simulate.CycleError as e:
+        return set(e.keys)
+    return set()
+
+def _task_on(task, events, day):
+    '''Return a light-weight dict of the state of ``task`` on ``day``,
+       replaying pre-loaded ``events`` (most recent first) in memory rather
+       than loading them via Task.as_of'''
+    if day < task.created_on:
+        return None
+
+    state = {k:getattr(task, k) for k in _TASK_STATE}
+    for key in ('started_on', 'dev_done_on', 'prod_done_on'):
+        if state[key] and day < state[key]:
+            state[key] = None
+    if state['dev_done_on'] is None:
+        state['dev_done_workdays'] = None
+
+    for e in events:
+        if e.occured_on < day:
+            break
+        changed = _EVENT_CHANGES.get(e.type)
+        if changed:
+            state[changed] = getattr(e, '_'.join(['from', changed]))
+    return state
+
+def _load_evidence(user_ids, until, halflife):
+    '''Return a dict of (user_id, effort_est) => simulate.Evidence for
+       every estimate ``user_ids`` have delivered on or before ``until``, in a
+       single query.'''
+    from .models import Task
+    items = {}
+    if user_ids:
+        for task in _discard_filter(Task.query.filter(db.and_(
+                Task.user_id.in_(user_ids), Task.prod_done_on != None,
+                Task.prod_done_on <= until, Task.dev_done_workdays > 0,
+                Task.prod_done_workdays > 0))):
+            items.setdefault((task.user_id, task.effort_est), []).append((
+                task.prod_done_on.toordinal(), task.dev_done_workdays,
+                task.prod_done_workdays))
+
+    return {k:simulate.Evidence(v, halflife) for k,v in items.iteritems()}
+
+def _days_off(user_ids):
+    '''Return a dict of user_id => set of holidays and vacations, with the
+       key None mapping to holidays alone'''
+    from .models import Holiday, Vacation
+    holidays = {h.date for h in Holiday.query.all()}
+    days_off = {None: holidays}
+    if user_ids:
+        for v in Vacation.query.filter(Vacation.user_id.in_(user_ids)):
+            days_off.setdefault(v.user_id, set(holidays)).add(v.date)
+    return days_off
+
+def _digest(*args):
+    '''Return a hex digest of the repr of args'''
+    return hashlib.sha1(repr(args)).hexdigest()
+
+def _sim_error(error, user, state, **kwargs):
+    '''Return a JSON-able dict describing why a simulation failed'''
+    kwargs.update({'error': error, 'task': state['ext_id'],
+                   'est': state['effort_est'],
+                   'user': user.email if user is not None else None})
+    return kwargs
+
+
+### EXPOSED METHODS
+def make_stats(user, est, since=null, until=null):
+    '''Return an iterable of Stat objects for ``user``/``est`` for every day
+       since ``since``. If ``since`` is not passed, return Stat objects for
+       all time.'''
+    until = datetime.now() if until is null else until
+    halflife = float(config.get('forecast', {}).get('halflife', 30))
+    dones = _load_dones(user, est)
+    lows = [v[0][0] for v in dones.itervalues() if v]
 
     # short-circuit if we have no evidence
     if lows:
@@ -150,144 +433,373 @@ def make_stats(user, est, since=null, until=null):
 
             yield stat
 
-def forecast(iter_, on_date, to_date=None, algorithm=None, plays=None,
-             start_dates=None):
-    '''Simulate a project delivery date from `on_date` to `to_date`, `plays`
-       times, using the forecasting method `algorithm`'''
-    '''TODO: fix
+def make_trailing_stats(user, est, windows=null, until=null):
+    '''Return an iterable of StatWindow dicts for ``user``/``est``, one for
+       each trailing window of ``windows`` days (default [stats] windows),
+       holding a stat for every day from the first delivery until
+       ``until``.
+
+       Unlike make_stats, evidence in a window is unweighted, so that every
+       day's stat is had from prefix sums in a single pass of the tasks
+       (see _trailing) rather than a pass per day. Only the mean, stddev and
+       sample size are kept, see StatWindow.rows.'''
+    from .models import StatWindow
+    if windows is null:
+        windows = config.get('stats', {}).get('windows') or WINDOWS_DFLT
+    until = datetime.now() if until is null else until
+    dones = _load_dones(user, est)
+    lows = [v[0][0] for v in dones.itervalues() if v]
+    if not lows:
+        return
+
+    start_on = min(lows)
+    days = numpy.datetime64(start_on, 'us') + numpy.arange(
+               (until - start_on).days + 1).astype('timedelta64[D]')
+    for window in windows:
+        series = {}
+        for kind in ('dev_done', 'prod_done', 'round_trips'):
+            sizes, means, stddevs = _trailing(dones[kind], days, window)
+            series.update({'_'.join([kind, 'sample_size']): sizes,
+                           '_'.join([kind, 'mean']): means,
+                           '_'.join([kind, 'stddev']): stddevs})
+        series['failure_rate'] = _trailing(dones['failures'], days,
+                                           window)[1]
+        yield {'user': user, 'effort_est': est, 'window': int(window),
+               'start_on': start_on, 'days': len(days),
+               'series': StatWindow.encode(series)}
+
+def _forecast_opts(algorithm, plays, adaptive, seed, workers):
+    '''Return a dict of forecast settings, defaulting from [forecast]'''
     forecast_cfg = config.get('forecast', {})
-    method = method or forecast_cfg.get('algorithm', 'monte-carlo')
+    opts = {
+        'algorithm': algorithm or forecast_cfg.get('algorithm', 'monte-carlo'),
+        'adaptive': forecast_cfg.get('adaptive', False) if adaptive is null \
+                    else adaptive,
+        'batch': int(forecast_cfg.get('batch', 250)),
+        'max_plays': int(plays or forecast_cfg.get('plays', 1000)),
+        'tolerance': None,
+        'percentiles': forecast_cfg.get('percentiles', simulate.PERCENTILES),
+        'halflife': float(forecast_cfg.get('halflife', 30)),
+        'discard_resolutions': config.get('tasks', {})\
+                                     .get('discard_resolutions'),
+        'workers': int(workers or forecast_cfg.get('workers', 1)),
+    }
+    if opts['adaptive']:
+        opts['max_plays'] = int(forecast_cfg.get('max_plays', 10000))
+        opts['tolerance'] = float(forecast_cfg.get('tolerance', 2))
+    seed = forecast_cfg.get('seed') if seed is None else seed
+    opts['seed'] = random.SystemRandom().randint(0, simulate.MAX_SEED) \
+                   if seed is None else int(seed)
+    # a random seed is as good as any other, so it doesn't void stored sims
+    opts['digest'] = tuple([opts[k] for k in (
+        'algorithm', 'adaptive', 'batch', 'max_plays', 'tolerance')] + [
+        tuple(opts['percentiles']), None if seed is None else opts['seed'],
+        opts['halflife']])
+    return opts
+
+def _load_forecast(iters, until, halflife):
+    '''Return a dict of everything needed to simulate ``iters`` on any day
+       up to ``until``, loaded once: iterations, tasks, events, blockers,
+       users, evidence and days off.'''
+    iters = {i.id:i for i in iters}
+    tasks, events = _iteration_tasks(iters.values())
+    user_ids = {t.user_id for t in tasks}
+    for task_events in events.itervalues():
+        user_ids |= {e.from_user_id for e in task_events if e.from_user_id}
+    ctx = {'iters': iters, 'tasks': tasks, 'events': events,
+           'iter_ranks': {i.id:(i.rank, i.id) for i in iters.itervalues()},
+           'blockers': _task_blockers(tasks),
+           'ext_ids': {t.id:t.ext_id for t in tasks},
+           'users': {}, 'evidence': {}, 'days_off': {},
+           'days_off_digests': {}, 'days_off_dates': {}}
+    _load_users(ctx, user_ids, until, halflife)
+    return ctx
+
+def _load_users(ctx, user_ids, until, halflife):
+    '''Load the users, evidence and days off of ``user_ids`` into forecast
+       context ``ctx`` (see _load_forecast)'''
+    from .models import User
+    user_ids = set(user_ids) - set(ctx['users'])
+    if user_ids:
+        ctx['users'].update({u.id:u for u in User.query.filter(
+                                 User.id.in_(user_ids))})
+        ctx['evidence'].update(_load_evidence(user_ids, until, halflife))
+    if user_ids or None not in ctx['days_off']:
+        ctx['days_off'].update(_days_off(user_ids))
+    for user_id, days in ctx['days_off'].iteritems():
+        if user_id not in ctx['days_off_dates']:
+            ctx['days_off_digests'][user_id] = _digest(sorted(days))
+            ctx['days_off_dates'][user_id] = calendars.dates(days)
+
+def _open_tasks(ctx, day, discard_resolutions):
+    '''Return the state of every open task in ``ctx`` on ``day``, in the
+       order users work them: iteration rank order, then task rank order'''
+    open_tasks = []
+    for task in ctx['tasks']:
+        state = _task_on(task, ctx['events'].get(task.id, []), day)
+        if state is None or state['iteration_id'] not in ctx['iters'] or \
+                state['prod_done_on'] is not None or (
+                discard_resolutions and
+                state['resolution'] in discard_resolutions):
+            continue
+        open_tasks.append(state)
+    iter_ranks = ctx['iter_ranks']
+    open_tasks.sort(key=lambda x: (iter_ranks[x['iteration_id']],
+                                   x['rank'] is None, x['rank'], x['id']))
+    return open_tasks
+
+def _day_spec(ctx, opts, day, open_tasks, start_dates, inputs, draws):
+    '''Return a tuple of length 3 of the simulate spec, a dict of
+       iteration id => simulation dict awaiting results, and the input hash,
+       for ``open_tasks`` on ``day``. ``inputs`` and ``draws`` are updated,
+       dropping draws of tasks whose inputs have changed.'''
+    users, evidence, days_off = ctx['users'], ctx['evidence'], ctx['days_off']
+    days_off_dates = ctx['days_off_dates']
+    spec = {'day': day, 'seed': opts['seed'], 'algorithm': opts['algorithm'],
+            'queues': {}, 'groups': {}, 'tasks': {}, 'days_off': {}}
+    sims, errors, queued = {}, {}, {}
+    for state in open_tasks:
+        user_id, iter_id = state['user_id'], state['iteration_id']
+        sims.setdefault(iter_id, {
+            'simulation_on': day, 'iteration': ctx['iters'][iter_id],
+            'algorithm': opts['algorithm'], 'plays': 0, 'seed': opts['seed'],
+            'users': set(), 'earliest_date': None, 'latest_date': None,
+            'data': None, 'errors': None, 'critical_path': None})
+        if user_id in users:
+            sims[iter_id]['users'].add(users[user_id])
+
+        so_far = 0
+        if state['started_on'] is not None:
+            so_far = networkdays(state['started_on'], day,
+                                 holidays=days_off.get(user_id,
+                                                       days_off[None]))
+        dev_so_far = state['dev_done_workdays'] or so_far
+        u_evidence = evidence.get((user_id, state['effort_est']))
+        task_inputs = (user_id, state['effort_est'], so_far, dev_so_far,
+                       u_evidence.seen if u_evidence else 0)
+        if inputs.get(state['id']) != task_inputs:
+            inputs[state['id']] = task_inputs
+            draws.pop(state['id'], None)
+
+        if not task_inputs[-1]:
+            errors.setdefault(iter_id, []).append(_sim_error(
+                'Cannot Simulate, No History', users.get(user_id), state))
+            continue
+        vals, weights = u_evidence.relevant(so_far, dev_so_far)
+        if not len(vals):
+            errors.setdefault(iter_id, []).append(_sim_error(
+                'Cannot Simulate, Outlier', users.get(user_id), state,
+                networkdays=so_far))
+            continue
+        spec['tasks'][state['id']] = (vals, weights, so_far)
+        spec['groups'].setdefault(iter_id, []).append(state['id'])
+        queued[state['id']] = state
+
+    # users work tasks in rank order, once the tasks blocking them are done
+    blockers = ctx['blockers']
+    keys = [s['id'] for s in open_tasks if s['id'] in queued]
+    try:
+        spec['order'] = simulate.toposort(keys, blockers)
+    except simulate.CycleError as e:
+        # tasks on a cycle are worked in rank order, but not reported
+        cycle = set(e.keys)
+        ext_ids = [ctx['ext_ids'][k] for k in e.keys]
+        for key in e.keys:
+            state = queued[key]
+            errors.setdefault(state['iteration_id'], []).append(_sim_error(
+                'Cannot Simulate, Dependency Cycle',
+                users.get(state['user_id']), state, cycle=ext_ids))
+        blockers = {k:[b for b in v if k not in cycle or b not in cycle]
+                        for k,v in blockers.iteritems()}
+        spec['order'] = simulate.toposort(keys, blockers)
+    spec['blockers'] = {k:[b for b in blockers[k] if b in queued]
+                            for k in spec['order'] if k in blockers}
+
+    # tasks worked after, or blocked by, a task that can't be simulated
+    # would start too early, so their iterations aren't reported either
+    unsimulable = dict([(s['id'], s) for s in open_tasks
+                            if s['id'] not in queued])
+    stalled = {}
+    for state in open_tasks:
+        if state['id'] in unsimulable:
+            stalled.setdefault(state['user_id'], state)
+            continue
+        waiting_on = [stalled.get(state['user_id'])] + [
+            unsimulable[b] for b in blockers.get(state['id'], [])
+                               if b in unsimulable]
+        waiting_on = [w for w in waiting_on if w is not None and
+                          w['iteration_id'] != state['iteration_id']]
+        if waiting_on:
+            errors.setdefault(state['iteration_id'], []).append(_sim_error(
+                'Cannot Simulate, Waiting On Unsimulable Task',
+                users.get(state['user_id']), state,
+                waiting_on=waiting_on[0]['ext_id']))
+
+    for key in spec['order']:
+        user_id = queued[key]['user_id']
+        if user_id not in spec['queues']:
+            start = start_dates.get(user_id)
+            start = 0 if start is None or start <= day else \
+                    networkdays(day, start, holidays=days_off.get(
+                        user_id, days_off[None])) - 1
+            spec['queues'][user_id] = (start, [])
+            spec['days_off'][user_id] = days_off_dates.get(
+                user_id, days_off_dates[None])
+        spec['queues'][user_id][1].append(key)
+
+    # every iteration simulated together shares an input hash
+    digests = ctx['days_off_digests']
+    input_hash = _digest(opts['digest'], day,
+                         sorted(ctx['iter_ranks'].items()), [
+        (state['id'], state['iteration_id'], state['rank'],
+         inputs[state['id']],
+         evidence[inputs[state['id']][:2]].digest() \
+             if inputs[state['id']][-1] else None)
+            for state in open_tasks
+    ], sorted([(u, q[0], digests.get(u, digests[None]))
+                   for u,q in spec['queues'].iteritems()]),
+       sorted(spec['blockers'].items()))
+
+    # iterations with errors are still worked, but not reported
+    for iter_id, sim in sims.iteritems():
+        sim['input_hash'] = input_hash
+        sim['users'] = list(sim['users'])
+        sim['errors'] = errors.get(iter_id)
+        if iter_id in errors:
+            spec['groups'].pop(iter_id, None)
+    return spec, sims, input_hash
+
+def _play(ctx, opts, spec, sims, pool=None, draws=None, timelines=None):
+    '''Run plays of ``spec`` in batches, until converged or out of plays,
+       and update ``sims`` with the results'''
+    summaries, critical, played = {}, {}, 0
+    if spec['groups']:
+        for size, batch_summaries, batch_critical in simulate.play(
+                spec, simulate.batches(opts['max_plays'], opts['batch']),
+                pool=pool, workers=opts['workers'], draws=draws,
+                timelines=timelines):
+            for iter_id, summary in batch_summaries.iteritems():
+                summaries[iter_id] = summary if iter_id not in summaries \
+                                     else summaries[iter_id].merge(summary)
+            for iter_id, counts in batch_critical.iteritems():
+                iter_critical = critical.setdefault(iter_id, {})
+                for key, count in counts.iteritems():
+                    iter_critical[key] = iter_critical.get(key, 0) + count
+            played += size
+            if opts['tolerance'] is not None and all([
+                    simulate.converged(summary, opts['tolerance'],
+                                       opts['percentiles'])
+                        for summary in summaries.itervalues()]):
+                break
+
+    for iter_id, summary in summaries.iteritems():
+        sims[iter_id].update({
+            'plays': played, 'data': summary,
+            'earliest_date': datetime.fromordinal(summary.earliest),
+            'latest_date': datetime.fromordinal(summary.latest),
+            'critical_path': {ctx['ext_ids'][k]:c/float(played) for k,c in
+                                  critical[iter_id].iteritems()}})
+    return sims
+
+def _forecast(iters, on_date, to_date, algorithm, plays, start_dates,
+              adaptive, seed, workers, skip):
+    '''Simulate ``iters`` jointly for every day from ``on_date`` to
+       ``to_date``, generating a dict of iteration id => simulation dict
+       for each day. See forecast and forecast_portfolio.'''
+    opts = _forecast_opts(algorithm, plays, adaptive, seed, workers)
     to_date = to_date or on_date
-    start_dates = start_dates or {} # user_id => start_date
-    plays = plays or forecast_cfg.get('plays', 1000)
-    halflife = float(config.get('forecast', {}).get('halflife', 30))
-    evidence = {}
-
-    # setup everything we need to run a simulation
-    holidays = {h.date for h in Holiday.query.all()}
-
-    # we don't yet support simulation for unstarted projects
-    for day in xrange((to_date - on_date).days + 1):
-        day = since + timedelta(days=day)
-        simulation = {'simulation_on': day, 'iteration': iter_,
-                      'users': users, 'algorithm': algorithm,
-                      'plays': plays, 'earliest_date': earliest}
-        iter_on_day, users = iter_.as_of(day), users
-        tasks = iter_['tasks']
-        for task in tasks:
-            u_evidence = evidence.setdefault(task['user']id, {})
-            u_evidence['user'] = task['user']
-            u_evidence.setdefault('start_date',
-                                  start_dates.get(task['user'].id))
-
-            # set earliest
-            if task['started_on'] and (
-                    u_evidence['start_date'] is None or \
-                    task['started_on'] < u_evidence['start_date']:
-                u_evidence['start_date'] = task['started_on']
-
-            # set prod done and discard if task is done
-            if task['prod_done_on']:
-                if u_evidence.get('last_done') and \
-                        task['prod_done_on'] > u_evidence.get('last_done')):
-                    u_evidence['last_done'] = task['last_done']
+    start_dates = start_dates or {}
+    skip = skip or {}
+
+    # load everything we need to run every simulation in the range, once
+    ctx = _load_forecast(iters, to_date, opts['halflife'])
+
+    # task id => inputs, and task id => batch => draws of remaining work,
+    # draws are kept while inputs don't change
+    inputs, draws = {}, {}
+    pool = multiprocessing.Pool(opts['workers']) \
+           if opts['workers'] > 1 else None
+    try:
+        for day in xrange((to_date - on_date).days + 1):
+            day = on_date + timedelta(days=day)
+            for u_evidence in ctx['evidence'].itervalues():
+                u_evidence.advance(day.toordinal())
+
+            # can't simulate iterations with no remaining work
+            open_tasks = _open_tasks(ctx, day, opts['discard_resolutions'])
+            if not open_tasks:
                 continue
 
-            ests = u_evidence.setdefault('evidence', {})
-            if task['prod_done_on'] is None:
-                if ests.get(task['effort_est']) is None:
-                    ests[task['effort_est']] = []
-                    for task in Task.query.filter(db.and_(
-                            Task.prod_done_workdays != None,
-                            Task.prod_done_workdays != 0,
-                            Task.dev_done_workdays != None,
-                            Task.dev_done_workdays != 0,
-                            Task.prod_done_on <= day,
-                            Task.user == task['user'],
-                            Task.effort_est == task['effort_est'])).order_by(
-                                Task.started_on):
-                        ests[task['effort_est']].append(
-                            (task['started_on'], (
-                                task['dev_done_workdays'],
-                                task['prod_done_workdays'])))
-
-                    # cannot simulate with no history, error and continue
-                    if not ests:
-                        simulation['errors'] = {
-                            'error': 'Cannot Simulate, No History',
-                            'user': task['user'],
-                            'est': task['effort_est'],
-                        }
-                        yield simulation
-                        continue
-
-            if u_evidence.get('vacations') is None:
-                u_evidence['vacations'] = set(task['user'].vacations)
-
-        # can't simulate without users, and start dates for each user
-        users = [e['user'] for e in evidence.values()]
-        if not users or set([u.id for u in users]) != set([i for i in earliest]):
-            continue
-
-        # setup decay for day
-        weighted_evidence = {}
-        for u_id, u_evidence in evidence.iteritems():
-            last_done = u_evidence.get('last_done')
-            # start date is earliest started, or latest finished
-            if last_done and last_done > u_evidence['start_date']:
-                u_evidence['start_date'] = last_done
-            elif not last_done:
-                u_evidence['last_done'] = u_evidence['start_date']
-
-            u_weighted = weighted_evidence.setdefault(u_id, {})
-            for est,items in u_evidence['evidence']:
-                u_weighted[est] = _sequence_ewma(day, items, halflife)
-
-        results = []
-        # simulate ``plays`` times
-        for i in xrange(plays):
-            timeline = {}
-            for task in tasks:
-                user = task['user']
-                timeline.setdefault(user.id, (evidence[user.id]['start_date'],
-                                              evidence[user.id]['last_done']))
-
-                relevant = []
-                so_far = networkdays(task['started_on'], day)
-                if task['dev_done_on']:
-                    timeline[0][0] = max(timeline[0][0], task['dev_done_on'])
-
-                    # only grab evidence that is further out than where we
-                    # already are
-                    relevant = filter(
-                        lambda x: x[1]>=so_far and x[0]>=task['dev_done_workdays'],
-                        weighted_evidence[user.id][task['effort_est']])
-
-                else:
-                    so_far = networkdays(task['started_on'], day)
-                    relevant = filter(
-                        lambda x: x[0]>=so_far,
-                        weighted_evidence[user.id][task['effort_est']])
-
-                # if no relevant data applies, error for now
-                if not relevant:
-                    simulation['errors'] = {
-                        'error': 'Cannot Simulate, Outlier',
-                        'user': task['user'],
-                        'est': task['effort_est'],
-                        'networkdays': so_far
-                    }
-                    yield simulation
-                    continue
+            spec, sims, input_hash = _day_spec(ctx, opts, day, open_tasks,
+                                               start_dates, inputs, draws)
+            if all([skip.get(i, {}).get(day) == input_hash for i in sims]):
+                continue
+            yield _play(ctx, opts, spec, sims, pool=pool, draws=draws)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-                #TODO: ewma solution
-                dev_done, prod_done = numpy.random.choice(r[0] for r in relevant,
-                                                          p=r[1] for r in relevant)
-                days_off = holidays|evidence[user.id]['vacations']
-                timeline[user.id][1] = workday(timeline[0], prod_done,
-                                               holidays=days_off)
-                if not task['dev_done_on']:
-                    timeline[user.id][0] = workday(timeline[user.id][0], dev_done,
-                                                   holidays=days_off)
-    '''
-    pass
+def forecast(iter_, on_date, to_date=None, algorithm=None, plays=None,
+             start_dates=None, adaptive=null, seed=None, workers=None,
+             skip=None):
+    '''Simulate the delivery date of ``iter_`` ``plays`` times, using the
+       forecasting method ``algorithm``, for every day from ``on_date`` to
+       ``to_date``, and yield dicts capable of being sent to
+       models.Simulation.
+
+       Forecasts roll forward: evidence is loaded once, iteration state and
+       evidence weights are advanced one day at a time, and a task is only
+       re-drawn when its inputs have changed since the previous day.
+
+       Plays are run in batches, each drawing from its own random stream
+       derived from ``seed`` (default: [forecast] seed, else random), so
+       the same seed yields the same simulations regardless of how many
+       ``workers`` processes (default: [forecast] workers) batches are
+       spread across.
+
+       If ``adaptive`` (default: [forecast] adaptive), batches are run
+       until the confidence interval of each of the configured percentiles
+       is within tolerance, or max_plays is reached, and ``plays`` is
+       ignored.
+
+       Each simulation carries an ``input_hash`` of everything it depends
+       on: the day, iteration state, evidence, days off and settings.
+       ``skip`` optionally maps days to the input_hash of a stored
+       simulation, days with matching hashes are not re-simulated, or
+       yielded.
+
+       ``start_dates`` optionally maps user ids to the date the user becomes
+       available to work on ``iter_``.
+
+       Tasks blocked by other tasks (see Task.blocks) do not start until
+       their blockers are done, even if their user is free, and each
+       simulation reports ``critical_path``, a dict of task ext_id => the
+       fraction of plays in which the task was on the critical path to
+       completion. Iterations with open tasks on a dependency cycle are
+       reported with errors, rather than simulated.'''
+    for sims in _forecast([iter_], on_date, to_date, algorithm, plays,
+                          start_dates, adaptive, seed, workers,
+                          {iter_.id: skip or {}}):
+        yield sims[iter_.id]
+
+def forecast_portfolio(iters, on_date, to_date=None, algorithm=None,
+                       plays=None, start_dates=None, adaptive=null, seed=None,
+                       workers=None, skip=None):
+    '''Simulate the delivery dates of ``iters`` jointly, as for forecast,
+       and yield a dict capable of being sent to models.Simulation for each
+       iteration on each day.
+
+       Each user works through their tasks across all of ``iters`` in
+       Iteration.rank order, and Task.rank order within an iteration, so
+       that lower ranked iterations wait on higher ranked ones. Iterations
+       with tasks worked after, or blocked by, a task of another iteration
+       that can't be simulated (e.g. for want of history) are reported with
+       errors, rather than simulated as if it took no time.
+
+       ``skip`` optionally maps iteration ids to dicts of day => input_hash
+       of stored simulations. Days on which every iteration's hash matches
+       are not re-simulated, or yielded.'''
+    for sims in _forecast(iters, on_date, to_date, algorithm, plays,
+                          start_dates, adaptive, seed, workers, skip):
+        for iter_id in sorted(sims):
+            yield sims[iter_id]
@@ -4,17 +4,45 @@
    @license: BSD 3-Clause (see LICENSE.txt)'''
 
 ### STANDARD LIBRARY IMPORTS
-from datetime import datetime, date
+import math
+import sys
+import threading
+import Queue
+from datetime import datetime, date, time, timedelta
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+### 3RD PARTY IMPORTS
+from workdays import networkdays, workday
 
 ### INTERNAL IMPORTS
-from . import db, null
-from .links import project_manager as pm, calendar as cal
-from .stats import make_stats
-from .estimates import task_efforts
-from .models import Sync, Iteration, User, Task, Event, Holiday, Vacation, Stat
+from . import db, null, config, instrument
+from .links import project_manager as pm, calendar as cal, \
+                   source as pm_source, sources as pm_sources
+from .stats import make_stats, make_trailing_stats, forecast, \
+                   forecast_portfolio
+from .estimates import task_efforts, note_sync
+from .models import Sync, Iteration, User, Task, Event, Holiday, Vacation, \
+                    Stat, StatWindow, Simulation
 
 ### GLOBALS
 SYNC_BATCH = 100
+SOURCE_WORKERS_DFLT = 4
+
+# holidays and user_id => vacations, kept warm until next changed by a sync
+_CALENDAR = {'key': None, 'holidays': None, 'vacations': {}}
+
+# task dicts pushed by the project_manager link, see push_tasks
+_PUSHED = Queue.Queue()
+
+# task fields affecting neither stats nor simulations
+_INERT_TASK_FIELDS = ('name', 'updated_on', 'content_hash',)
+# task dates bounding the stats and simulations a task is part of
+_TASK_DATES = ('created_on', 'started_on', 'dev_done_on', 'prod_done_on',)
+# task dates from which a task is counted by stats
+_TASK_DONE_DATES = ('dev_done_on', 'prod_done_on',)
+# task fields affecting only the order tasks are simulated in
+_SIM_TASK_FIELDS = ('rank',)
 
 ### INTERNAL METHODS
 def _complex_key(obj, columns):
@@ -44,11 +72,37 @@ def _complex_query(values, model, columns):
             ors.append(db.and_(*ands))
         return db.or_(*ors)
 
+def _changed(obj, values):
+    '''Return a dict of the items of ``values`` differing from the
+       attributes of ``obj``. Related objects are compared by foreign key,
+       so that no relationship is loaded, and collections are assumed to
+       have changed.'''
+    relationships = obj.__mapper__.relationships
+    changed = {}
+    for k,v in values.iteritems():
+        if k in relationships:
+            if relationships[k].uselist:
+                changed[k] = v
+                continue
+            fk = getattr(obj, '{}_id'.format(k))
+            same = fk is None if v is None else \
+                       (v.id is not None and v.id == fk)
+        else:
+            same = getattr(obj, k) == v
+        if not same:
+            changed[k] = v
+    return changed
+
+@instrument.timed
 def _batch_sync(most_recent_update, batch, model, ident,
                 updated_on='updated_on', task_changes=None):
     '''Sync a batch of models with the database, inserting/updating as needed,
        and return a dict of objects that were created, and the most recent
-       updated_on time
+       updated_on time. Only changed values are written, rows with none are
+       skipped (counted as rows_skipped), and tasks with none but inert
+       fields (e.g. name) are logged as unchanged in task_changes.
+       Estimates created or changed are reindexed on commit (see
+       estimates.reindex).
 
        NB: batch and task_changes are modified by side-effect, this behavior
            is relied on.
@@ -63,16 +117,26 @@ def _batch_sync(most_recent_update, batch, model, ident,
         raise ValueError('Must specify at least 1 ident')
 
     # filter on multi-column
-    for obj in model.query.filter(_complex_query(batch.keys(), model,
-                                                 ident)).all():
+    with instrument.span('lookup'):
+        found = model.query.filter(_complex_query(batch.keys(), model,
+                                                  ident)).all()
+    skipped = 0
+    for obj in found:
         key = _complex_key(obj, ident)
+        changed = _changed(obj, batch[key])
+        skipped += not changed
+        # tasks have side-effects for both stats and simulations
+        # log date-deltas here if asked to
         if task_changes not in (None, null) and model is Task:
-            task_changes = _log_task_change(task_changes, obj, batch[key])
-        for k,v in batch[key].iteritems():
-            # tasks have side-effects for both stats and simulations
-            # log date-deltas here if asked to
+            if set(changed) - set(_INERT_TASK_FIELDS):
+                task_changes = _log_task_change(task_changes, obj, changed)
+            else:
+                task_changes['unchanged'].add(key)
+        for k,v in changed.iteritems():
             setattr(obj, k, v)
         batch[key] = obj
+    instrument.count('rows_upserted', len(batch) - skipped)
+    instrument.count('rows_skipped', skipped)
 
     # now save all fetched, modifying batch as we go
     created = {}
@@ -94,41 +158,202 @@ def _batch_sync(most_recent_update, batch, model, ident,
             most_recent_update = max(most_recent_update, obj_updated_on)
 
     # finalize
-    db.session.commit()
+    with instrument.span('commit'):
+        db.session.commit()
     return created, most_recent_update
 
-def _sync_since(type_):
+def _sync_since(type_, source=null):
     '''Return the datetime of the last updated timestamp from the last sync
-       of ``type_``'''
-    last_sync = Sync.query.filter_by(type=type_)\
-                          .order_by(Sync.last_seen_update.desc()).first()
+       of ``type_``, from project_manager ``source`` if passed'''
+    query = Sync.query.filter_by(type=type_)
+    if source is not null:
+        query = query.filter_by(source=source)
+    last_sync = query.order_by(Sync.last_seen_update.desc()).first()
     if last_sync:
         return last_sync.last_seen_update
 
     return None
 
-def _record_sync(type_, last_seen):
+def _content_hashes(model, since, ids=null):
+    '''Return a dict of ext_id => content_hash of ``model`` rows with ext_id
+       in ``ids``, or else updated since ``since``, which are all the rows a
+       link can return again for the same ``ids`` and ``since``'''
+    query = db.session.query(model.ext_id, model.content_hash).filter(
+                model.content_hash != None)
+    if ids is not null:
+        if not ids:
+            return {}
+        query = query.filter(model.ext_id.in_(list(ids)))
+    elif since is not None:
+        query = query.filter(model.updated_on >= since)
+    return dict(query.all())
+
+def _store_hashes(model, hashes):
+    '''Write ``hashes``, a dict of ext_id => content_hash, to ``model`` rows,
+       in a single statement, and commit. Task hashes are written only once
+       the stats and simulations their changes affect are updated, so that
+       tasks from a failed sync are never skipped as unchanged.'''
+    if not hashes:
+        return
+    table = model.__table__
+    db.session.execute(table.update().where(
+                           table.c.ext_id == db.bindparam('ext')).values(
+                           content_hash=db.bindparam('hash')),
+                       [{'ext': k, 'hash': v} for k,v in hashes.iteritems()])
+    db.session.commit()
+
+def _record_sync(type_, last_seen, notes=None, source=None):
     '''Record that a sincy of ``type_`` occured, and that the most recently
-       updated record of ``type_`` was updated at ``last_seen``'''
+       updated record of ``type_`` was updated at ``last_seen``, from
+       project_manager ``source`` (None for the project_manager link)'''
     if not last_seen:
         return None
+    if instrument.enabled():
+        notes = dict(notes or {}, instrument=instrument.summary())
     try:
-        record = Sync(last_seen_update=last_seen, type=type_)
+        record = Sync(last_seen_update=last_seen, type=type_, notes=notes,
+                      source=source)
         db.session.add(record)
+        db.session.flush()
+        sync_id = record.id
         db.session.commit()
+        note_sync(sync_id)
         return record
     except Exception:
         db.session.rollback()
         raise
 
+def _days_off(user_ids):
+    '''Return a dict of user_id => set of holidays and vacations for each of
+       ``user_ids``, from a cache kept until holidays or vacations are next
+       synced (see _reset_days_off), in this or any other process.'''
+    key = (_sync_since('holiday'), _sync_since('vacation'))
+    if _CALENDAR['holidays'] is None or key != _CALENDAR['key']:
+        _CALENDAR.update({'key': key, 'vacations': {},
+                          'holidays': {h.date for h in Holiday.query.all()}})
+    vacations = _CALENDAR['vacations']
+    missing = set(user_ids) - set(vacations)
+    if missing:
+        vacations.update((u, set()) for u in missing)
+        for v in Vacation.query.filter(Vacation.user_id.in_(missing)):
+            vacations[v.user_id].add(v.date)
+    return {u:_CALENDAR['holidays'] | vacations[u] for u in user_ids}
+
+def _reset_days_off():
+    '''Drop cached holidays and vacations'''
+    _CALENDAR['holidays'] = None
+
+def _z_score(percentile):
+    '''Return the standard normal z-score of ``percentile``, by bisection'''
+    low, high, target = -10., 10., percentile/100.
+    for _ in xrange(64):
+        mid = (low + high)/2
+        if (1 + math.erf(mid/math.sqrt(2)))/2 < target:
+            low = mid
+        else:
+            high = mid
+    return low
+
+def _latest_stats(stat_cache, keys):
+    '''Cache outlier thresholds from the most recent Stat of each (user_id,
+       effort_est) in ``keys`` not already in ``stat_cache``, in a single
+       query. Each is cached as a dict of dev_done and prod_done => the
+       workdays beyond which a task is an outlier, or None if too little
+       evidence has been seen.'''
+    missing = set(keys) - set(stat_cache)
+    if not missing:
+        return stat_cache
+
+    alerts = config.get('alerts', {})
+    z = _z_score(float(alerts.get('outlier_percentile', 98)))
+    min_samples = int(alerts.get('outlier_min_samples', 5))
+    stat_cache.update((k, None) for k in missing)
+    latest = db.session.query(
+                 Stat.user_id, Stat.effort_est,
+                 db.func.max(Stat.as_of).label('as_of')).filter(
+                 Stat.user_id.in_({u for u,_ in missing})).group_by(
+                 Stat.user_id, Stat.effort_est).subquery()
+    for stat in Stat.query.join(latest, db.and_(
+            Stat.user_id == latest.c.user_id, Stat.as_of == latest.c.as_of,
+            db.or_(Stat.effort_est == latest.c.effort_est, db.and_(
+                Stat.effort_est == None, latest.c.effort_est == None)))):
+        key = (stat.user_id, stat.effort_est)
+        if key not in missing:
+            continue
+        stat_cache[key] = thresholds = {}
+        for kind in ('dev_done', 'prod_done'):
+            mean = getattr(stat, '_'.join([kind, 'mean']))
+            stddev = getattr(stat, '_'.join([kind, 'stddev']))
+            thresholds[kind] = None
+            if mean is not None and stddev is not None and \
+                    getattr(stat, '_'.join([kind, 'sample_size'])) >= \
+                        min_samples:
+                thresholds[kind] = mean + z*stddev
+    return stat_cache
+
+def _outlier_events(tasks, stat_cache, as_of):
+    '''Return a dict of event key => outlier Event dict for each of
+       ``tasks`` whose dev or prod done workdays, or workdays so far as of
+       ``as_of`` if not yet done, exceed the outlier threshold cached in
+       ``stat_cache`` for its user and estimate. Outliers occur on the first
+       workday beyond the lower threshold crossed. A task is flagged once:
+       tasks with an outlier event are skipped, so re-syncs don't duplicate
+       them, even once thresholds have moved.'''
+    discard = config.get('tasks', {}).get('discard_resolutions') or []
+    started = [t for t in tasks
+                   if t.started_on is not None and t.resolution not in discard]
+    if started:
+        flagged = {task_id for task_id, in db.session.query(Event.task_id)
+                       .filter(db.and_(Event.type == 'outlier',
+                                       Event.task_id.in_([t.id for t in
+                                                              started])))}
+        started = [t for t in started if t.id not in flagged]
+    if not started:
+        return {}
+    _latest_stats(stat_cache, [(t.user_id, t.effort_est) for t in started])
+
+    events, days_off = {}, _days_off({t.user_id for t in started})
+    for task in started:
+        outlier_on = None
+        thresholds = stat_cache[(task.user_id, task.effort_est)]
+        if thresholds is None:
+            continue
+        for kind, done_on, workdays in (
+                ('dev_done', task.dev_done_on, task.dev_done_workdays),
+                ('prod_done', task.prod_done_on, task.prod_done_workdays)):
+            threshold = thresholds[kind]
+            if threshold is None:
+                continue
+            if done_on is None:
+                workdays = networkdays(task.started_on, as_of,
+                                       holidays=days_off[task.user_id])
+            if workdays is not None and workdays > threshold:
+                occured_on = workday(task.started_on,
+                                     int(math.floor(threshold)),
+                                     holidays=days_off[task.user_id])
+                outlier_on = min(outlier_on or occured_on, occured_on)
+        if outlier_on is not None:
+            events[('outlier', outlier_on, task.id)] = {
+                'type': 'outlier', 'occured_on': outlier_on, 'task': task}
+    return events
+
 def _batch_sync_tasks(since, batch, users, iter_ext_ids, events,
-                      task_changes):
+                      task_changes, stat_cache=None, unlinked=None,
+                      source=None):
     '''Task sync'ing requires sycning users, iterations and events, it's
-       enough complexity to warrant a helper function.'''
+       enough complexity to warrant a helper function.
+
+       If ``stat_cache`` is passed, outlier events are detected (see
+       _outlier_events) and sync'ed along with the other events. If
+       ``unlinked`` is passed, iterations are not sync'ed from the link,
+       and the ext_ids of tasks whose iteration is not yet in the database
+       are added to it, by iteration ext_id. Else iterations are sync'ed
+       from project_manager ``source``.'''
     # first sync all iterations, then grab the iterations:
     iters = {}
     if len(iter_ext_ids):
-        sync_iterations(ids=iter_ext_ids)
+        if unlinked is None:
+            sync_iterations(ids=iter_ext_ids, source=source)
         for iter_ in Iteration.query.filter(
                 Iteration.ext_id.in_(iter_ext_ids)).all():
             iters[iter_.ext_id] = iter_
@@ -141,14 +366,24 @@ def _batch_sync_tasks(since, batch, users, iter_ext_ids, events,
         task['user'] = users[email]
         task['iteration'] = iters.get(iter_ext_id)
         batch[k] = task
+        if unlinked is not None and iter_ext_id is not None and \
+                iter_ext_id not in iters:
+            unlinked.setdefault(iter_ext_id, []).append(k)
 
     # then sync the tasks themselves -- store this sync, it's the one we want
     _, task_sync = _batch_sync(since, batch, Task, 'ext_id',
                                task_changes=task_changes)
-
-    # forceably reset task workdays cache
-    for task in batch.itervalues():
-        task.cache_workdays(force=True)
+    # reload the tasks expired by its commit at once, rather than one by one
+    if batch:
+        Task.query.filter(Task.ext_id.in_(batch.keys())).all()
+
+    # forceably reset task workdays cache, of tasks that changed
+    with instrument.span('cache_workdays'):
+        changed = [t for k,t in batch.iteritems()
+                       if k not in task_changes['unchanged']]
+        days_off = _days_off({t.user_id for t in changed})
+        for task in changed:
+            task.cache_workdays(force=True, days_off=days_off[task.user_id])
 
     # and finally the events related to the tasks
     new_events = {}
@@ -159,6 +394,10 @@ def _batch_sync_tasks(since, batch, users, iter_ext_ids, events,
         ev['task'] = batch[task_ext_id]
         new_key = (key[0], key[1], ev['task'].id)
         new_events[new_key] = ev
+    if stat_cache is not None:
+        with instrument.span('outliers'):
+            new_events.update(_outlier_events(batch.values(), stat_cache,
+                                              datetime.now()))
 
     # sync events
     _batch_sync(None, new_events, Event, ['type', 'occured_on', 'task_id'],
@@ -166,46 +405,28 @@ def _batch_sync_tasks(since, batch, users, iter_ext_ids, events,
 
     return task_sync, task_changes
 
-def _batch_sync_vacations(vacations, users, updated_dates, all_):
-    '''Batch sync holidays and vacations. Update and return a set of new dates
-       and a dict of all seen dates, to determine what should be deleted
-       dates'''
-    _batch_sync(None, users, User, 'email')
-    for date, email in vacations.keys():
-        user = users[email]
-        key = (date, user.id)
-        vacation = vacations.pop((date, email))
-        vacation['user_id'] = user.id
-        vacation['user'] = user
-        vacations[key] = vacation
-        all_.add(key)
-    created, _ = _batch_sync(None, vacations, Vacation, ['date', 'user_id'],
-                                updated_on=None)
-    updated_dates |= set(created.keys())
-    return updated_dates, all_
-
-
-def _delete_datish(keep, model, ext_id, date_attr='date'):
-    '''Delete old dateish objects.'''
-    deletes = set()
-    for delete in model.query.filter(db.not_(_complex_query(keep, model,
-                                             ext_id))).all():
-        db.session.delete(delete)
-        deletes.add(_complex_key(delete, ext_id))
-
+def _apply_diff(model, inserts, deletes):
+    '''Insert rows ``inserts``, a list of column dicts, and delete rows with
+       ids in ``deletes``, a statement each, and commit'''
+    if inserts:
+        db.session.execute(model.__table__.insert(), inserts)
+    if deletes:
+        model.query.filter(model.id.in_(deletes))\
+                   .delete(synchronize_session=False)
+    instrument.count('rows_inserted', len(inserts))
+    instrument.count('rows_deleted', len(deletes))
     db.session.commit()
-    return deletes
-
 
 def _update_task_net_workdays(*args):
     '''Update a task net_workdays by date/user or just date'''
     query = Task.query
-    ors = []
+    ors, days = [], []
     task_changes = _task_change_log()
     for arg in args:
         date, user_id = arg, None
         if isinstance(arg, tuple):
             date, user_id = arg
+        days.append((date, user_id))
 
         ands = [Task.started_on != None, Task.started_on <= date,
                        db.or_(Task.prod_done_on == None,
@@ -215,54 +436,96 @@ def _update_task_net_workdays(*args):
         ors.append(db.and_(*ands))
 
     if ors:
-        for task in Task.query.filter(db.or_(*ors)):
-            task.cache_workdays(force=True)
-            task_changes = _log_task_change(task_changes, task, None)
+        tasks = Task.query.filter(db.or_(*ors)).all()
+        days_off = _days_off({t.user_id for t in tasks})
+        for task in tasks:
+            task.cache_workdays(force=True, days_off=days_off[task.user_id])
+            # stats and sims change from the earliest day off changed in the
+            # task's span, logged as a change to a pseudo-field
+            changed_on = min([d for d,u in days
+                                  if task.started_on <= d and
+                                     (task.prod_done_on is None or
+                                      task.prod_done_on >= d) and
+                                     u in (None, task.user_id)])
+            task_changes = _log_task_change(task_changes, task,
+                                            {'days_off': changed_on})
 
     db.session.commit()
     return task_changes
 
 def _task_change_log():
     '''Create an empty task change log dictionary'''
-    return {'stats': {}, 'iterations': {}}
+    return {'stats': {}, 'iterations': {}, 'unchanged': set()}
 
 def _log_task_change(task_log, old, new):
-    '''Log dates for user-specifica and iteration-specific changes to a task
-       log dictionary'''
-    old = old.__dict__ if isinstance(old, Task) else (old or {})
-    new = new.__dict__ if isinstance(new, Task) else (new or {})
-    changes, users, iterations, effort_ests = [], [], [], []
-    for key in set(old.keys())|set(new.keys()):
-        for d in (old, new):
-            val = d.get(key)
-            # we need to re-run stats/sims for both sides of any user change
-            if key == 'user':
-                users.append(val.id if val is not None else None)
-            # we need to re-run stats/sims for both sides of any est change
-            elif key == 'effort_est':
-                effort_ests.append(val)
-            # we need to re-run sims for both sides of any iteration change
-            elif key == 'iteration':
-                iterations.append(val.id if val is not None else None)
-            # setup a minable list
-            elif isinstance(val, date):
-                changes.append(val)
-
-    change_since = min(changes) if changes else None
-    if change_since:
+    '''Log dates for user-specific and iteration-specific changes to a task
+       log dictionary. ``old`` is the Task before the change, or None if it
+       is new, and ``new`` a dict of the values that changed.
+
+       Stats and sims are re-run from the earliest old or new value of any
+       changed date. Other changes re-run stats from the task's earliest
+       done date, as only done tasks are counted, and sims from its earliest
+       date. Changes to the simulated order alone (e.g. rank) re-run only
+       today's sims, and changes to inert fields (e.g. name) re-run
+       nothing.'''
+    new = dict([(k,v) for k,v in (new or {}).iteritems()
+                    if k not in _INERT_TASK_FIELDS])
+    if not new:
+        return task_log
+
+    changes = [v for v in new.itervalues() if isinstance(v, date)]
+    if old is not None:
+        changes.extend([getattr(old, k) for k in new
+                            if isinstance(getattr(old, k, None), date)])
+    stat_changes = changes
+    if old is not None and not changes:
+        if set(new) - set(_SIM_TASK_FIELDS):
+            changes = [getattr(old, k) for k in _TASK_DATES
+                           if getattr(old, k) is not None]
+            stat_changes = [getattr(old, k) for k in _TASK_DONE_DATES
+                                if getattr(old, k) is not None]
+        else:
+            changes = [datetime.combine(date.today(), time())]
+
+    # we need to re-run stats/sims for both sides of any user, est or
+    # iteration change, and for the task's user, est and iteration if none
+    users, iterations, effort_ests = set(), set(), set()
+    if old is not None:
+        users.add(old.user_id)
+        effort_ests.add(old.effort_est)
+        iterations.add(old.iteration_id)
+    if 'user' in new:
+        users.add(new['user'].id if new['user'] is not None else None)
+    if 'effort_est' in new:
+        effort_ests.add(new['effort_est'])
+    if 'iteration' in new:
+        iterations.add(new['iteration'].id
+                           if new['iteration'] is not None else None)
+
+    stat_since = min(stat_changes) if stat_changes else None
+    if stat_since:
         for user in users:
             user_log = task_log['stats'].setdefault(user, {})
             for est in effort_ests:
-                user_log[est] = min(change_since,
-                                    user_log.get(est, change_since))
+                user_log[est] = min(stat_since, user_log.get(est, stat_since))
+
+    change_since = min(changes) if changes else None
+    if change_since:
         for iter_ in iterations:
             iters = task_log['iterations']
             iters[iter_] = min(change_since, iters.get(iter_, change_since))
 
     return task_log
 
+def _sim_notes(hits, misses):
+    '''Return a notes dict reporting simulation cache hits and misses'''
+    total = hits + misses
+    return {'simulations': {'hits': hits, 'misses': misses,
+                            'hit_rate': float(hits)/total if total else None}}
+
 def _update_stats_and_sims(task_log):
-    '''Update stats and simulations based on logged task changes'''
+    '''Update stats and simulations based on logged task changes, and return
+       notes on the simulation cache hit rate'''
     # map users we need to lookup in DB
     user_lookup, stats = {}, task_log['stats']
     if stats:
@@ -278,35 +541,260 @@ def _update_stats_and_sims(task_log):
                 sync_stats(since=since, users=users, efforts=[effort_est],
                            record=False)
 
-    # TODO: update sims by iteration part of map
+    # update sims for iterations, in a portfolio any change affects all
+    hits, misses = 0, 0
+    iters = {k:v for k,v in task_log['iterations'].iteritems()
+                if k is not None}
+    if iters and config.get('forecast', {}).get('portfolio', False):
+        return sync_simulations(since=min(iters.values()), record=False)
+    elif iters:
+        for iter_ in Iteration.query.filter(Iteration.id.in_(iters)).all():
+            notes = sync_simulations(since=iters[iter_.id], iterations=[iter_],
+                                     record=False)['simulations']
+            hits, misses = hits + notes['hits'], misses + notes['misses']
+
+    return _sim_notes(hits, misses)
+
+def _outlier_cache(stat_cache):
+    '''Return the (user_id, effort_est) => outlier thresholds cache to use,
+       from the latest stats, or None if [alerts] outlier is not set'''
+    if not config.get('alerts', {}).get('outlier', False):
+        return None
+    return {} if stat_cache is null else stat_cache
+
+def _stage_task(task, batch, users, events, iter_ext_ids, hashes):
+    '''Stage a task dict, as returned by the project_manager link, for
+       _batch_sync_tasks, splitting its user, iteration, events and content
+       hash out into ``users``, ``iter_ext_ids``, ``events`` and
+       ``hashes`` (see _store_hashes).'''
+    content_hash = task.pop('content_hash', None)
+    if content_hash is not None:
+        hashes[task['ext_id']] = content_hash
+
+    # setup events
+    for ev in task.pop('events', []):
+        event_iter_ext_id = ev.pop('iteration_ext_id', None)
+        event_from_iter_ext_id = ev.pop('from_iteration_ext_id', None)
+        for i in (event_iter_ext_id, event_from_iter_ext_id):
+            if i is not None:
+                iter_ext_ids.add(i)
+        key = (
+            ev['type'], ev['occured_on'], task['ext_id']
+        )
+        events[key] = (task['ext_id'], event_iter_ext_id,
+                       event_from_iter_ext_id, ev)
+
+    # setup iterations
+    iter_ext_id = task.pop('iteration_ext_id')
+    if iter_ext_id is not None:
+        iter_ext_ids.add(iter_ext_id)
+
+    # setup users
+    email = task['user']['email'].strip()
+    users.setdefault(email, task.pop('user'))
+
+    # NB: we have not associated the iteration yet
+    batch[task['ext_id']] = (task, email, iter_ext_id)
+
+def _finish_task_sync(task_changes, stat_cache):
+    '''Update stats and simulations affected by the changes logged in
+       ``task_changes``, and return notes for the Sync'''
+    notes = _update_stats_and_sims(task_changes)
+    notes['skipped'] = len(task_changes['unchanged'])
+
+    # stats just re-made are stale in the cache
+    if stat_cache is not None:
+        for user_id, efforts in task_changes['stats'].iteritems():
+            for effort_est in efforts:
+                stat_cache.pop((user_id, effort_est), None)
+    return notes
+
+def _sync_task_dicts(since, tasks, stat_cache=null, unlinked=None,
+                     source=None):
+    '''Sync an iterable of task dicts, as returned by the project_manager
+       link, in batches, then update stats and simulations affected by the
+       changes. Return a tuple of length 2 of the most recent updated_on
+       seen and notes for the Sync. See sync_tasks for ``stat_cache`` and
+       ``source``, and _batch_sync_tasks for ``unlinked``.
+
+       If a batch fails, stats and simulations are still updated for the
+       batches already committed, and no content hash is written.'''
+    task_changes, hashes = _task_change_log(), {}
+    stat_cache = _outlier_cache(stat_cache)
+    try:
+        batch, users, events, iter_ext_ids = {}, {}, {}, set()
+        for task in tasks:
+            _stage_task(task, batch, users, events, iter_ext_ids, hashes)
+            if len(batch) == SYNC_BATCH:
+                since, task_changes = _batch_sync_tasks(since, batch, users,
+                                                        iter_ext_ids, events,
+                                                        task_changes,
+                                                        stat_cache, unlinked,
+                                                        source)
+                batch, users, events, iter_ext_ids = {}, {}, {}, set()
+
+        if len(batch):
+            since, task_changes = _batch_sync_tasks(since, batch, users,
+                                                    iter_ext_ids, events,
+                                                    task_changes, stat_cache,
+                                                    unlinked, source)
+    except Exception:
+        exc_info = sys.exc_info()
+        db.session.rollback()
+        try:
+            _finish_task_sync(task_changes, stat_cache)
+        except Exception:
+            db.session.rollback()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    try:
+        notes = _finish_task_sync(task_changes, stat_cache)
+        _store_hashes(Task, hashes)
+    except Exception:
+        db.session.rollback()
+        raise
+    return since, notes
+
+def _backfill_tasks(items, emails):
+    '''Generator for sync_backfill, sync'ing iterations of ``items`` in
+       batches, and generating its tasks with users resolved. ``emails`` is
+       a pm_name => email cache.'''
+    iterations = {}
+    for type_, item in items:
+        if type_ == 'iteration':
+            iterations[item['ext_id']] = item
+            if len(iterations) == SYNC_BATCH:
+                _batch_sync(None, iterations, Iteration, 'ext_id')
+                iterations = {}
+            continue
+
+        user = item['user']
+        if not user.get('email'):
+            pm_name = user.get('pm_name')
+            if pm_name not in emails:
+                emails[pm_name] = db.session.query(User.email).filter(
+                                      User.pm_name == pm_name).scalar() \
+                                  if pm_name else None
+            user['email'] = emails[pm_name]
+            if not user['email']:
+                instrument.count('rows_without_user')
+                continue
+        yield item
+
+    _batch_sync(None, iterations, Iteration, 'ext_id')
+
+def _link_iterations(unlinked):
+    '''Link tasks to iterations sync'ed after them, from a dict of
+       iteration ext_id => task ext_ids, and return a task change log of the
+       iterations linked to'''
+    task_changes = _task_change_log()
+    for iter_ in Iteration.query.filter(
+            Iteration.ext_id.in_(list(unlinked))).all():
+        task_ext_ids = unlinked[iter_.ext_id]
+        for i in xrange(0, len(task_ext_ids), SYNC_BATCH):
+            Task.query.filter(Task.ext_id.in_(task_ext_ids[i:i+SYNC_BATCH]))\
+                      .update({'iteration_id': iter_.id},
+                              synchronize_session=False)
+        task_changes['iterations'][iter_.id] = iter_.created_on
+    db.session.commit()
+    return task_changes
+
+def _source_batches(link, since, known):
+    '''Generator for _fetch_source, generating tuples of length 2 of
+       'iterations' and a list of iteration dicts updated since
+       ``since['iteration']``, then of 'tasks' and a tuple of length 2 of a
+       list of the iteration dicts first referenced by, and a list of, task
+       dicts updated since ``since['task']``, fetched from ``link``, in
+       batches of SYNC_BATCH. ``known`` holds the content hashes of each.'''
+    batch, fetched = [], set()
+    for iteration in link.iterations(since=since['iteration'],
+                                     known=known['iteration']):
+        fetched.add(iteration['ext_id'])
+        batch.append(iteration)
+        if len(batch) == SYNC_BATCH:
+            yield 'iterations', batch
+            batch = []
+    if batch:
+        yield 'iterations', batch
+
+    # iterations are fetched before the tasks referencing them, once each
+    batch, tasks = [], link.tasks(since=since['task'], known=known['task'])
+    while True:
+        task = next(tasks, None)
+        if task is not None:
+            batch.append(task)
+            if len(batch) < SYNC_BATCH:
+                continue
+        if not batch:
+            break
+        ids = set()
+        for task in batch:
+            ids.add(task.get('iteration_ext_id'))
+            for ev in task.get('events', []):
+                ids.update([ev.get('iteration_ext_id'),
+                            ev.get('from_iteration_ext_id')])
+        ids -= fetched | set([None])
+        fetched |= ids
+        iterations = list(link.iterations(ids=ids, known=known['iteration'])) \
+                         if ids else []
+        yield 'tasks', (iterations, batch)
+        batch = []
+
+def _fetch_source(job):
+    '''Worker for sync_sources, putting tuples of length 3 of a kind, the
+       source and a payload (see _source_batches) for project_manager
+       source ``job['source']`` on queue ``job['out']``, then of 'done' or
+       'error' and sys.exc_info(). Stops early if ``job['stop']`` is set.
+       Never touches the database. Fetching is instrumented as a fetch span
+       of span ``job['parent']``.'''
+    out, source = job['out'], job['source']
+    try:
+        with instrument.span('fetch', parent=job['parent']):
+            for kind, payload in _source_batches(job['link'], job['since'],
+                                                 job['known']):
+                if job['stop'].is_set():
+                    return
+                out.put((kind, source, payload))
+    except Exception:
+        out.put(('error', source, sys.exc_info()))
+    else:
+        out.put(('done', source, None))
 
 ### EXPOSED METHODS
+@instrument.timed
 def sync():
     '''Sync everything.
 
        If ``since`` is passed, sinc only objects updated more recently than
        ``since``.'''
     last_sync = []
-    for meth in ('sync_holidays', 'sync_vacations', 'sync_iterations',
-                 'sync_tasks', 'sync_stats'):
+    for meth in ('sync_holidays', 'sync_vacations', 'sync_sources',
+                 'sync_stats', 'sync_simulations'):
         sync_res = globals()[meth]()
-        if sync_res:
-            last_sync.append(sync_res.last_seen_update)
+        for record in sync_res if isinstance(sync_res, list) else [sync_res]:
+            if record:
+                last_sync.append(record.last_seen_update)
 
     since = max([dt for dt in last_sync]) if last_sync else None
     return _record_sync('full', since)
 
-def sync_iterations(since=null, ids=null, record=null):
+@instrument.timed
+def sync_iterations(since=null, ids=null, record=null, source=None):
     '''Sync iterations from remote project_manager link to the local database.
 
        If ``since`` is passed, sync only iterations updated more recently
        than ``since``, else only sync iterations updated more recently than
-       the last iteration sync.'''
-    since = _sync_since('iteration') if since is null else since
+       the last iteration sync. Iterations whose content hash is unchanged
+       are skipped by the link. If ``source`` is passed, sync from that
+       project_manager source (see links.sources) and its cursor.'''
+    since = _sync_since('iteration', source) if since is null else since
     record = record if record is not null else (ids is null)
     try:
         batch = {}
-        for iteration in pm.iterations(since=since, ids=ids):
+        known = _content_hashes(Iteration, since, ids)
+        for iteration in instrument.timed_iter(
+                'fetch', pm_source(source).iterations(since=since, ids=ids,
+                                                      known=known)):
             batch[iteration['ext_id']] = iteration
             if len(batch) == SYNC_BATCH:
                 _, since = _batch_sync(since, batch, Iteration, 'ext_id')
@@ -318,152 +806,318 @@ def sync_iterations(since=null, ids=null, record=null):
         db.session.rollback()
         raise
     if record:
-        return _record_sync('iteration', since)
+        return _record_sync('iteration', since, source=source)
     return None
 
-def sync_tasks(since=null, ids=null, record=null):
+@instrument.timed
+def sync_tasks(since=null, ids=null, record=null, stat_cache=null,
+               source=None):
     '''Sync tasks from remote project_manager link to the local database.
 
        If ``since`` is passed, sync only tasks updated more recently than
        ``since``, else only sync tasks updated more recently than the last
-       task sync.'''
+       task sync. If [alerts] outlier is set, tasks taking longer than is
+       usual for their user and estimate are flagged with outlier events.
+
+       ``stat_cache`` optionally holds outlier thresholds from previous
+       syncs, and is kept up to date, for long-running callers. Tasks whose
+       content hash is unchanged are skipped by the link, before any
+       formatting, event extraction or database work. If ``source`` is
+       passed, sync from that project_manager source (see links.sources)
+       and its cursor.'''
     #TODO: networkdays
-    since = _sync_since('task') if since is null else since
+    since = _sync_since('task', source) if since is null else since
     record = record if record is not null else (ids is null)
-    task_changes = _task_change_log()
+    known = _content_hashes(Task, since, ids)
+    since, notes = _sync_task_dicts(since, instrument.timed_iter(
+                       'fetch', pm_source(source).tasks(since=since, ids=ids,
+                                                        known=known)),
+                       stat_cache, source=source)
+
+    if record:
+        return _record_sync('task', since, notes=notes, source=source)
+    return None
+
+@instrument.timed
+def sync_sources(sources=null, workers=null, stat_cache=null):
+    '''Sync iterations and tasks from each project_manager source (default
+       links.sources), each from its own cursors, and return a list of the
+       Syncs recorded.
+
+       Sources are fetched concurrently by up to ``workers`` (default
+       [links] source_workers) threads, so that a slow source doesn't hold
+       up the others, while every write is made by the calling thread, so
+       that writers never contend for the database. Tasks are linked to
+       iterations sync'ed from any source. If a source fails, the others
+       are still sync'ed, then the first failure is re-raised. Syncs are
+       recorded only for cursors that advanced, or tasks that changed, so
+       that idle runs don't void every cached response (see api). Content
+       hashes of tasks are written only once every source is done and tasks
+       are linked, and never for a failed source. See sync_tasks for
+       ``stat_cache``.'''
+    sources = pm_sources() if sources is null else sources
+    if workers is null:
+        workers = config.get('links', {}).get('source_workers') or \
+                      SOURCE_WORKERS_DFLT
+    stat_cache = _outlier_cache(stat_cache)
+    if not sources:
+        return []
+
+    # cursors and hashes are read, and connectors set up, up front, so
+    # that fetching never touches the database
+    out, stop = Queue.Queue(2 * workers), threading.Event()
+    state, jobs = {}, []
+    known_iterations = _content_hashes(Iteration, None)
+    for source in sources:
+        since = {'iteration': _sync_since('iteration', source),
+                 'task': _sync_since('task', source)}
+        state[source] = dict(since, since=since,
+                             task_changes=_task_change_log(), hashes={})
+        jobs.append({'out': out, 'stop': stop, 'source': source,
+                     'parent': instrument.current(),
+                     'link': pm_source(source), 'since': since,
+                     'known': {'iteration': known_iterations,
+                               'task': _content_hashes(Task,
+                                                       since['task'])}})
+
+    pool = ThreadPool(min(workers, len(jobs)))
+    fetching = pool.map_async(_fetch_source, jobs)
+    pool.close()
+    records, failed, unlinked, pending = [], [], {}, len(jobs)
+    hashes = {}
     try:
-        batch, users, events, iter_ext_ids = {}, {}, {}, set()
-        for task in pm.tasks(since=since, ids=ids):
-            # setup events
-            for ev in task.pop('events', []):
-                event_iter_ext_id = ev.pop('iteration_ext_id', None)
-                event_from_iter_ext_id = ev.pop('from_iteration_ext_id', None)
-                for i in (event_iter_ext_id, event_from_iter_ext_id):
-                    if i is not None:
-                        iter_ext_ids.add(i)
-                key = (
-                    ev['type'], ev['occured_on'], task['ext_id']
-                )
-                events[key] = (task['ext_id'], event_iter_ext_id,
-                               event_from_iter_ext_id, ev)
-
-            # setup iterations
-            iter_ext_id = task.pop('iteration_ext_id')
-            if iter_ext_id is not None:
-                iter_ext_ids.add(iter_ext_id)
-
-            # setup users
-            email = task['user']['email'].strip()
-            users.setdefault(email, task.pop('user'))
-
-            # NB: we have not associated the iteration yet
-            batch[task['ext_id']] = (task, email, iter_ext_id)
-            if len(batch) == SYNC_BATCH:
-                since, task_changes = _batch_sync_tasks(since, batch, users,
-                                                        iter_ext_ids, events,
-                                                        task_changes)
+        while pending:
+            kind, source, payload = out.get()
+            st = state[source]
+            if kind == 'iterations':
+                _, st['iteration'] = _batch_sync(
+                    st['iteration'], dict([(i['ext_id'], i)
+                                               for i in payload]),
+                    Iteration, 'ext_id')
+            elif kind == 'tasks':
+                iterations, tasks = payload
+                if iterations:
+                    _batch_sync(None, dict([(i['ext_id'], i)
+                                                for i in iterations]),
+                                Iteration, 'ext_id')
                 batch, users, events, iter_ext_ids = {}, {}, {}, set()
+                for task in tasks:
+                    _stage_task(task, batch, users, events, iter_ext_ids,
+                                st['hashes'])
+                st['task'], _ = _batch_sync_tasks(st['task'], batch, users,
+                                                  iter_ext_ids, events,
+                                                  st['task_changes'],
+                                                  stat_cache, unlinked)
+            elif kind == 'done':
+                pending -= 1
+                changes = st['task_changes']
+                notes = _finish_task_sync(changes, stat_cache)
+                if st['iteration'] != st['since']['iteration']:
+                    records.append(_record_sync('iteration', st['iteration'],
+                                                source=source))
+                if st['task'] != st['since']['task'] or \
+                        changes['stats'] or changes['iterations']:
+                    records.append(_record_sync('task', st['task'],
+                                                source=source, notes=notes))
+                hashes.update(st['hashes'])
+            else:
+                pending -= 1
+                failed.append(payload)
+                # batches already committed still affect stats and sims
+                _finish_task_sync(st['task_changes'], stat_cache)
+
+        # an iteration may be sync'ed from another source than its tasks
+        if unlinked:
+            _update_stats_and_sims(_link_iterations(unlinked))
+        _store_hashes(Task, hashes)
+    except Exception:
+        db.session.rollback()
+        # unblock any fetchers, so that they see stop
+        stop.set()
+        while not fetching.ready():
+            try:
+                out.get(True, 0.1)
+            except Queue.Empty:
+                pass
+        raise
+    finally:
+        pool.join()
+
+    if failed:
+        raise failed[0][0], failed[0][1], failed[0][2]
+    return [r for r in records if r is not None]
+
+def push_tasks(tasks):
+    '''Queue task dicts pushed by the project_manager link (e.g. from a
+       webhook, see links.noop.Connector.hook_task) for sync_pushed_tasks,
+       and return the number queued.'''
+    queued = 0
+    for task in tasks:
+        _PUSHED.put(task)
+        queued += 1
+    return queued
+
+def pop_pushed_tasks(wait=None, batch_wait=0):
+    '''Return a list of up to SYNC_BATCH queued task dicts, blocking up to
+       ``wait`` seconds (indefinitely if None) for the first, then up to
+       ``batch_wait`` seconds more for others, so that a burst of pushes is
+       synced as one micro-batch. Return an empty list if none arrive.'''
+    try:
+        tasks = [_PUSHED.get(True, wait)]
+    except Queue.Empty:
+        return []
+
+    until = datetime.now() + timedelta(seconds=batch_wait)
+    while len(tasks) < SYNC_BATCH:
+        remaining = (until - datetime.now()).total_seconds()
+        try:
+            tasks.append(_PUSHED.get(remaining > 0, max(remaining, 0)))
+        except Queue.Empty:
+            break
+    return tasks
+
+@instrument.timed
+def sync_pushed_tasks(tasks, stat_cache=null, record=True):
+    '''Sync task dicts pushed by the project_manager link, e.g. as returned
+       by pop_pushed_tasks, to the local database.
+
+       Pushed syncs are recorded as type 'push', so that the next sync_tasks
+       still polls everything updated since the last task sync, reconciling
+       any pushes that were missed.'''
+    since, notes = _sync_task_dicts(None, tasks, stat_cache)
+    if record and since is not None:
+        return _record_sync('push', since, notes=notes)
+    return None
 
-        if len(batch):
-            since, task_changes = _batch_sync_tasks(since, batch, users,
-                                                    iter_ext_ids, events,
-                                                    task_changes)
-        _update_stats_and_sims(task_changes)
+@instrument.timed
+def sync_backfill(items, stat_cache=null, record=True):
+    '''Sync an iterable of tuples of length 2 of 'iteration' or 'task' and a
+       dict, e.g. as generated by the project_manager link's xml_items from
+       a historical export, through the same batched path as sync_tasks, so
+       that memory use is flat regardless of the number of items.
+
+       Iterations are not fetched from the link: tasks are linked to
+       iterations already in the database or sync'ed before them, and to
+       the rest once all items are sync'ed. Tasks with no user email are
+       matched to users by pm_name, and skipped if none match. Backfills
+       are recorded as type 'backfill', leaving the task sync cursor be.'''
+    unlinked, emails = {}, {}
+    since, notes = _sync_task_dicts(None, _backfill_tasks(items, emails),
+                                    stat_cache, unlinked)
+    try:
+        if unlinked:
+            _update_stats_and_sims(_link_iterations(unlinked))
     except Exception:
         db.session.rollback()
         raise
 
-    if record:
-        return _record_sync('task', since)
+    if record and since is not None:
+        return _record_sync('backfill', since, notes=notes)
     return None
 
+@instrument.timed
 def sync_holidays(year=None, record=True):
     '''Sync holidays in ``year`` from remote calendar link to the local
        database. If ``year`` is None, sync holidays from all years.
 
        sync_holidays supports no ``since`` argument, as updates are not
-       generally available from calendars, the entire calendar is sync'ed with
-       the database every time.'''
-    holidays, updated_dates, all_ = {}, set(), set()
+       generally available from calendars, the entire calendar (or year) is
+       diffed with the database every time, and only the difference written
+       and used to update tasks.'''
     try:
-        for holiday in cal.holidays(year=year):
-            key = holiday['date']
-            holidays[key] = holiday
-            all_.add(key)
-            if len(holidays) == SYNC_BATCH:
-                created, _ = _batch_sync(None, holidays, Holiday, 'date',
-                                            updated_on=None)
-                updated_dates |= set(created.keys())
-                holidays = {}
-
-        if len(holidays):
-            created, _ = _batch_sync(None, holidays, Holiday, 'date',
-                                        updated_on=None)
-            updated_dates |= set(created.keys())
-            holidays = {}
-
-        # delete old holidays
-        updated_dates |= _delete_datish(all_, Holiday, 'date')
+        remote = set([h['date'] for h in cal.holidays(year=year)])
+        query = db.session.query(Holiday.id, Holiday.date)
+        if year is not None:
+            query = query.filter(Holiday.date >= datetime(int(year), 1, 1),
+                                 Holiday.date < datetime(int(year) + 1, 1, 1))
+        stored = dict([(d, id_) for id_,d in query.all()])
+
+        inserts = remote - set(stored)
+        deletes = set(stored) - remote
+        _apply_diff(Holiday, [{'date': d} for d in inserts],
+                    [stored[d] for d in deletes])
+        _reset_days_off()
         # update tasks
-        _update_stats_and_sims(_update_task_net_workdays(*updated_dates))
+        notes = _update_stats_and_sims(
+                    _update_task_net_workdays(*(inserts | deletes)))
+        notes.update({'inserted': len(inserts), 'deleted': len(deletes)})
     except Exception:
         db.session.rollback()
         raise
 
     if record:
-        return _record_sync('holiday', datetime.now())
+        return _record_sync('holiday', datetime.now(), notes=notes)
     return None
 
+@instrument.timed
 def sync_vacations(email=None, record=True):
     '''Sync vacations for user associated with ``email`` from remote calendar
        link to the local database. If ``email`` is None, sync vacations for
        all users.
 
        sync_vacations supports no ``since`` argument, as updates are not
-       generally available from calendars, the entire calendar is sync'ed with
-       the database every time.'''
-
-    vacations, users, updated_dates, all_ = {}, {}, set(), set()
+       generally available from calendars, the entire calendar (or user's
+       calendar) is diffed with the database every time, and only the
+       difference written and used to update tasks.'''
     try:
+        users, remote = {}, set()
         for vacation in cal.vacations(email=email):
             user = vacation.pop('user')
-            users[user['email']] = user
-            key = (vacation['date'], user['email'])
-            vacations[key] = vacation
-
-            if len(vacations) == SYNC_BATCH:
-                updated_dates, all_ = _batch_sync_vacations(vacations, users,
-                                                            updated_dates, all_)
-                vacations, users = {}, {}
-
-        if len(vacations):
-            updated_dates, all_ = _batch_sync_vacations(vacations, users,
-                                                        updated_dates, all_)
-
-        # delete old vacations
-        updated_dates |= _delete_datish(all_, Vacation, ['date','user_id'])
+            users.setdefault(user['email'], user)
+            remote.add((vacation['date'], user['email']))
+
+        # NB: _batch_sync modifies users
+        _batch_sync(None, users, User, 'email')
+        remote = set([(d, users[e].id) for d,e in remote])
+
+        query = db.session.query(Vacation.id, Vacation.date, Vacation.user_id)
+        if email is not None:
+            query = query.join(Vacation.user).filter(User.email == email)
+        stored = dict([((d, user_id), id_) for id_,d,user_id in query.all()])
+
+        inserts = remote - set(stored)
+        deletes = set(stored) - remote
+        _apply_diff(Vacation, [{'date': d, 'user_id': u} for d,u in inserts],
+                    [stored[k] for k in deletes])
+        _reset_days_off()
         # update tasks
-        _update_stats_and_sims(_update_task_net_workdays(*updated_dates))
+        notes = _update_stats_and_sims(
+                    _update_task_net_workdays(*(inserts | deletes)))
+        notes.update({'inserted': len(inserts), 'deleted': len(deletes)})
     except Exception:
         db.session.rollback()
         raise
 
-    # update tasks
     if record:
-        return _record_sync('vacation', datetime.now())
+        return _record_sync('vacation', datetime.now(), notes=notes)
     return None
 
+@instrument.timed
 def sync_stats(since=null, users=null, efforts=null, record=True):
     '''Sync stats for user (``users``) and effort (``efforts``) combinations,
-       day-over-day since ``since``.'''
+       day-over-day since ``since``, and their trailing-window stats (see
+       stats.make_trailing_stats), which are re-made in full.'''
     efforts = task_efforts(user=users) if efforts is null else efforts
     users = User.query.all() if users is null else users
     since = _sync_since('task') if since is null else since
     try:
-        stats = {}
+        stats, windows = {}, {}
         for user in users:
             for effort in efforts:
-                for stat in make_stats(user, effort, since=since):
+                for window in instrument.timed_iter(
+                        'make_trailing_stats',
+                        make_trailing_stats(user, effort)):
+                    window['user_id'] = window['user'].id
+                    windows[(window['user_id'], window['effort_est'],
+                             window['window'])] = window
+                if len(windows) >= SYNC_BATCH:
+                    _batch_sync(None, windows, StatWindow,
+                                ['user_id', 'effort_est', 'window'],
+                                updated_on=None)
+                    windows = {}
+
+                for stat in instrument.timed_iter(
+                        'make_stats', make_stats(user, effort, since=since)):
                     stat['user_id'] = stat['user'].id
                     key = (stat['user_id'], stat['effort_est'], stat['as_of'])
                     stats[key] = stat
@@ -478,13 +1132,86 @@ def sync_stats(since=null, users=null, efforts=null, record=True):
                                   ['user_id', 'effort_est', 'as_of'],
                                   updated_on=None)
             stats = {}
+        if len(windows):
+            _batch_sync(None, windows, StatWindow,
+                        ['user_id', 'effort_est', 'window'], updated_on=None)
     except Exception:
         db.session.rollback()
         raise
 
     if record:
-        return _record_sync('vacation', since)
+        return _record_sync('stat', since)
     return None
 
-__all__ = ['SYNC_BATCH', 'sync', 'sync_iterations', 'sync_tasks',
-           'sync_holidays', 'sync_vacations', 'sync_stats']
+@instrument.timed
+def sync_simulations(since=null, iterations=null, until=null, record=True):
+    '''Sync simulations of ``iterations`` for every day from ``since`` until
+       ``until``, re-simulating only days whose inputs have changed since
+       they were last simulated. If [forecast] portfolio is set, iterations
+       are simulated jointly (see stats.forecast_portfolio).
+
+       If ``iterations`` is not passed, sync all iterations with unfinished
+       tasks. If ``since`` is not passed, sync from the last simulation
+       sync. If ``until`` is not passed, sync until today. Days more than
+       [forecast] history days before ``until`` are not re-simulated, so
+       that e.g. the first sync of a task does not re-simulate every day
+       since its iteration was created. If ``record`` is False, return a
+       dict of notes on the simulation cache hit rate.'''
+    until = datetime.combine(date.today(), time()) if until is null else until
+    since = _sync_since('simulation') if since is null else since
+    since = until if since is None else datetime.combine(since.date(), time())
+    history = config.get('forecast', {}).get('history')
+    if history is not None:
+        since = max(since, until - timedelta(days=int(history)))
+    if iterations is null:
+        iterations = Iteration.query.join(
+                         Task, Task.iteration_id == Iteration.id).filter(
+                         Task.prod_done_on == None).distinct().all()
+    stored, simulated = {}, set()
+    try:
+        if iterations:
+            for sim in Simulation.query.filter(db.and_(
+                    Simulation.iteration_id.in_([i.id for i in iterations]),
+                    Simulation.simulation_on >= since,
+                    Simulation.simulation_on <= until)).all():
+                stored.setdefault(sim.iteration_id, {})[sim.simulation_on] = \
+                    sim.input_hash
+
+        if config.get('forecast', {}).get('portfolio', False):
+            forecasts = forecast_portfolio(iterations, since, until,
+                                           skip=stored)
+        else:
+            forecasts = chain(*[forecast(i, since, until,
+                                         skip=stored.get(i.id))
+                                    for i in iterations])
+
+        sims = {}
+        for sim in instrument.timed_iter('forecast', forecasts):
+            sim['iteration_id'] = sim['iteration'].id
+            key = (sim['iteration_id'], sim['simulation_on'])
+            sims[key] = sim
+            simulated.add(key)
+            if len(sims) == SYNC_BATCH:
+                _batch_sync(None, sims, Simulation,
+                            ['iteration_id', 'simulation_on'], updated_on=None)
+                sims = {}
+        if len(sims):
+            _batch_sync(None, sims, Simulation,
+                        ['iteration_id', 'simulation_on'], updated_on=None)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    hits = len(set([(i, d) for i,days in stored.iteritems() for d in days]) -
+               simulated)
+    notes = _sim_notes(hits, len(simulated))
+    if record:
+        return _record_sync('simulation', until, notes=notes)
+    return notes
+
+__all__ = ['SYNC_BATCH', 'SOURCE_WORKERS_DFLT', 'sync', 'sync_iterations',
+           'sync_tasks', 'sync_sources',
+           'push_tasks', 'pop_pushed_tasks', 'sync_pushed_tasks',
+           'sync_backfill',
+           'sync_holidays', 'sync_vacations', 'sync_stats',
+           'sync_simulations']
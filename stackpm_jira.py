@@ -4,11 +4,26 @@
    @author: Matthew Story <matt.story@axial.net>
 '''
 ### STANDARD LIBRARY IMPORTS
+import hashlib
+import json
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from xml.etree.cElementTree import iterparse
 
 ### 3RD PARTY IMPORTS
 import requests
-from stackpm import null
+from stackpm import null, instrument
+
+### GLOBALS
+# webhookEvents carrying a task, see Connector.hook_task
+WEBHOOK_EVENTS = ('jira:issue_created', 'jira:issue_updated',)
+
+# dates in XML exports, less the trailing timezone, see Connector.xml_items
+XML_TIME_FMT = '%a, %d %b %Y %H:%M:%S'
+
+# defaults for fetching changelogs truncated by search, see Connector.tasks
+CHANGELOG_WORKERS_DFLT = 4
+CHANGELOG_PAGE_DFLT = 100
 
 ### INTERNAL METHODS
 def _make_map(*maps):
@@ -50,7 +65,6 @@ class Connector(object):
         self.__iteration_map_cache = None
         self.__task_map_cache = None
 
-
         # inverse maps for fields affecting events
         self.__effort_est_field = self.config['effort_estimate_field']
         self.__iteration_ext_id_field = self.config['iteration_link_field']
@@ -116,6 +130,38 @@ class Connector(object):
 
         return self.__field_cache.get(name, name)
 
+    def __content_hash(self, issue, field_map):
+        '''Return a digest of a raw jira issue, its changelog length and the
+           field map it is formatted with, which changes whenever the
+           formatted issue would.'''
+        changelog = issue.get('changelog') or {}
+        return hashlib.sha1(json.dumps([
+            sorted(field_map.iteritems()), issue.get('key'),
+            issue.get('fields'),
+            changelog.get('total', len(changelog.get('histories', []))),
+        ], sort_keys=True, default=repr)).hexdigest()
+
+    def __truncated(self, issue):
+        '''Return True if search truncated the changelog of raw ``issue``'''
+        changelog = issue.get('changelog') or {}
+        return changelog.get('total', 0) > len(changelog.get('histories', []))
+
+    def __changelog(self, key, parent=None):
+        '''Return every history of issue ``key``, paging the issue changelog
+           method, oldest first, in a changelog span of span ``parent``'''
+        histories = []
+        params = {'maxResults': self.config.get('changelog_page_size',
+                                                CHANGELOG_PAGE_DFLT)}
+        with instrument.span('changelog', parent=parent):
+            while True:
+                params['startAt'] = len(histories)
+                res = self.get('issue/{}/changelog'.format(key),
+                               params=params)
+                histories.extend(res.get('values', []))
+                if not res.get('values') or res.get('isLast') or \
+                        len(histories) >= res.get('total', 0):
+                    return histories
+
     def __fmt_item(self, item, field_map):
         '''Traverse potentially nested JIRA keys and return a dictionary with
            stackpm recognizable names'''
@@ -200,28 +246,143 @@ class Connector(object):
         task['events'] = events
         return task
 
+    def __xml_date(self, val):
+        '''Parse a date from a Jira XML export, or return None'''
+        if not val:
+            return None
+        for fmt, stamp in ((self.config.get('xml_time_fmt', XML_TIME_FMT),
+                            val.rsplit(' ', 1)[0]),
+                           (self.config['date_fmt'], val)):
+            try:
+                return datetime.strptime(stamp, fmt)
+            except ValueError:
+                pass
+        return None
+
+    def __xml_item(self, elem):
+        '''Return a tuple of length 2 of 'iteration' or 'task' and a dict,
+           for an item element of a Jira XML export. Each child is visited
+           once, rather than searched for per field.'''
+        raw, custom = {}, {}
+        for child in elem:
+            if child.tag == 'customfields':
+                for field in child:
+                    values = field.find('customfieldvalues')
+                    custom[field.findtext('customfieldname')] = \
+                        values[0].text.strip() \
+                            if values is not None and len(values) and \
+                               values[0].text else None
+            else:
+                raw[child.tag] = child
+
+        text = lambda tag: (raw[tag].text or '').strip() or None \
+                               if tag in raw else None
+        item = {
+            'ext_id': text('key'),
+            'name': text('summary'),
+            'created_on': self.__xml_date(text('created')),
+            'updated_on': self.__xml_date(text('updated')),
+            'rank': custom.get('Rank'),
+            'effort_est': custom.get(self.__effort_est_field),
+        }
+        if text('type') == 'Epic':
+            item.update({
+                'rank': item['rank'] or 0,
+                'team': raw['project'].get('key') if 'project' in raw \
+                            else None,
+                'value_est': custom.get(self.config['value_estimate_field']),
+            })
+            return 'iteration', item
+
+        username = raw['assignee'].get('username') if 'assignee' in raw \
+                       else None
+        email_fmt = self.config.get('xml_email_fmt')
+        item.update({
+            'user': {
+                'pm_name': username,
+                'email': email_fmt.format(username) \
+                             if email_fmt and username else None,
+            },
+            'resolution': text('resolution') \
+                              if text('resolution') != 'Unresolved' else None,
+            'iteration_ext_id': custom.get(self.__iteration_ext_id_field),
+            'events': [],
+        })
+        for field in ('started', 'dev_done', 'prod_done'):
+            item['{}_on'.format(field)] = self.__xml_date(custom.get(
+                self.config['{}_override_field'.format(field)]))
+        try:
+            item['round_trips'] = int(float(custom.get(
+                self.config['testing_override_field'])))
+        except (TypeError, ValueError):
+            item['round_trips'] = None
+
+        # with no changelog, resolved stands in for the shipped status
+        if item['prod_done_on'] is None and \
+                self.status_map.get(text('status')) == 'prod_done_on':
+            item['prod_done_on'] = self.__xml_date(text('resolved'))
+        return 'task', item
+
     def __full_search(self, jql, field_map, expand=None, limit=None,
-                      validate=True):
+                      validate=True, known=None):
         '''Generator to perform a full search to limit, regardless of Jira
-           pagination limits'''
+           pagination limits. Issues whose content hash matches that of
+           their key in ``known`` are skipped without formatting.
+
+           Truncated changelogs are fetched by a pool of changelog_workers
+           threads, started on the first and closed when the search ends.'''
         total, seen = limit or -1, 0
         params = { 'jql': jql, 'maxResults': 200, 'validateQuery': validate }
         expand = [expand] if isinstance(expand, basestring) else expand
         if expand:
             params['expand'] = ",".join(expand)
 
-        while 0 > total or total > seen:
-            params['startAt'] = seen
-            res = self.get('search', params=params)
-            for issue in res['issues']:
-                yield self.__fmt_item(issue, field_map)
-                seen += 1
-                if limit and seen >= limit:
-                    break
-            if limit:
-                total = min(res['total'], limit)
-            else:
-                total = res['total']
+        pool, parent = None, instrument.current()
+        try:
+            while 0 > total or total > seen:
+                params['startAt'] = seen
+                res = self.get('search', params=params)
+                instrument.count('rows_fetched', len(res['issues']))
+                page = res['issues'][:limit - seen] if limit \
+                           else res['issues']
+
+                # fetch truncated changelogs in the background, while the
+                # rest of the page is formatted, waiting on each only once
+                # reached
+                hashes, changelogs = [], {}
+                for issue in page:
+                    hashes.append(self.__content_hash(issue, field_map))
+                    if known and known.get(issue.get('key')) == hashes[-1]:
+                        hashes[-1] = None
+                    elif self.__truncated(issue):
+                        if pool is None:
+                            pool = ThreadPool(int(self.config.get(
+                                'changelog_workers', CHANGELOG_WORKERS_DFLT)))
+                        changelogs[issue['key']] = pool.apply_async(
+                            self.__changelog, (issue['key'], parent))
+                instrument.count('changelogs_fetched', len(changelogs))
+
+                for issue, content_hash in zip(page, hashes):
+                    if content_hash is None:
+                        instrument.count('rows_unchanged')
+                    else:
+                        if issue.get('key') in changelogs:
+                            with instrument.span('changelog_wait'):
+                                issue['changelog']['histories'] = \
+                                    changelogs[issue['key']].get()
+                        item = self.__fmt_item(issue, field_map)
+                        item['content_hash'] = content_hash
+                        yield item
+                    seen += 1
+                if limit:
+                    total = min(res['total'], limit)
+                else:
+                    total = res['total']
+        finally:
+            # also run if the search is abandoned, e.g. on closing it
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
     def __jira_map(self, our_map):
         '''Create a map suitable for caching from our field names to jira's'''
@@ -249,9 +410,10 @@ class Connector(object):
         return self.__task_map_cache
 
     ### EXPOSED API
-    def iterations(self, since=None, limit=None, ids=null):
+    def iterations(self, since=None, limit=None, ids=null, known=None):
         '''Return a list of iteration dicts, capable of being sent to
-           models.Iteration'''
+           models.Iteration, skipping those whose content_hash matches
+           ``known``, a dict of ext_id => content_hash'''
         validate = True
         jql = self.config.get('epic_jql', '')
         if ids is not null:
@@ -263,7 +425,7 @@ class Connector(object):
                 ]))
         return self.__full_search(self.__jql(jql, since=since),
                                   self.__iteration_map, limit=limit,
-                                  validate=validate)
+                                  validate=validate, known=known)
     def iteration(self, ext_id):
         '''Return an iteration dict, capable of being sent to
            models.Iteration'''
@@ -271,9 +433,14 @@ class Connector(object):
             return iter_
         return None
 
-    def tasks(self, since=None, limit=None, ids=null):
+    def tasks(self, since=None, limit=None, ids=null, known=None):
         '''Return a list of task dicts, capable of being sent to
-           models.Task'''
+           models.Task, skipping those whose content_hash matches ``known``,
+           a dict of ext_id => content_hash.
+
+           Search truncates the changelogs of issues (e.g. at 100 histories),
+           so the full changelog of each truncated issue is paged from the
+           issue changelog method, by a pool of changelog_workers threads.'''
         validate = True
         jql = self.config.get('work_jql', '')
         if ids is not null:
@@ -285,8 +452,10 @@ class Connector(object):
             for task in self.__full_search(self.__jql(jql, since=since),
                                            self.__task_map,
                                            expand='changelog', limit=limit,
-                                           validate=validate):
-                yield self.__fmt_task(task, since=since)
+                                           validate=validate, known=known):
+                with instrument.span('fmt_task'):
+                    task = self.__fmt_task(task, since=since)
+                yield task
 
     def task(self, ext_id, since=None):
         '''Return an task dict, capable of being sent to models.Task'''
@@ -294,12 +463,70 @@ class Connector(object):
             return task
         return None
 
+    def hook_task(self, payload):
+        '''Return a task dict, capable of being sent to models.Task, from a
+           Jira issue created or updated webhook ``payload``, or None if it
+           carries no task.
+
+           Only the change carried by the payload is known, so status dates
+           and round trips neither overridden nor set by it are left out of
+           the task dict, rather than cleared, until the next full sync.'''
+        if payload.get('webhookEvent') not in WEBHOOK_EVENTS:
+            return None
+        issue = dict(payload['issue'])
+        fields = issue.get('fields', {})
+        if (fields.get('issuetype') or {}).get('name') == 'Epic':
+            return None
+
+        # the change is shaped as a history of the expanded changelog
+        items = (payload.get('changelog') or {}).get('items') or []
+        issue['changelog'] = {'histories': []}
+        if items and fields.get('updated'):
+            issue['changelog']['histories'].append({
+                'created': fields['updated'],
+                'items': items,
+            })
+
+        task = self.__fmt_item(issue, self.__task_map)
+        unknown = [f for f in set(self.status_map.values())
+                       if f and task.get(f) is None]
+        with instrument.span('fmt_task'):
+            task = self.__fmt_task(task)
+        for field in unknown:
+            if field == 'round_trips' or task.get(field) is None:
+                task.pop(field, None)
+        return task
+
+    def xml_items(self, xml_file):
+        '''Generate tuples of length 2 of 'iteration' or 'task' and a dict
+           capable of being sent to models.Iteration or models.Task, for each
+           item of a Jira XML export (e.g. for sync.sync_backfill).
+
+           The export is streamed, and each item cleared once generated, so
+           memory use is flat regardless of export size. Exports carry no
+           changelog, so tasks have no events, status dates come from the
+           override fields (and resolved, for the prod done status), and
+           users have no email unless xml_email_fmt is set, e.g.
+           '{}@example.com', formatted with the assignee's username.'''
+        channel = None
+        for event, elem in iterparse(xml_file, events=('start', 'end',)):
+            if event == 'start':
+                if elem.tag == 'channel':
+                    channel = elem
+            elif elem.tag == 'item' and channel is not None:
+                yield self.__xml_item(elem)
+                channel.clear()
+
     def get(self, method, **kwargs):
         '''REST get method with auth and method builder helpers'''
-        resp = requests.get(self.__url(method), auth=self.__auth(), **kwargs)
+        with instrument.span('jira_get'):
+            resp = requests.get(self.__url(method), auth=self.__auth(),
+                                **kwargs)
+        instrument.count('bytes_received', len(resp.content))
         if resp.status_code != 200:
             raise JiraLinkError(resp.status_code,
                                 resp.json()['errorMessages'])
         return resp.json()
 
-__all__ = ['Connector', 'JiraLinkError']
+__all__ = ['WEBHOOK_EVENTS', 'XML_TIME_FMT', 'CHANGELOG_WORKERS_DFLT',
+           'CHANGELOG_PAGE_DFLT', 'Connector', 'JiraLinkError']
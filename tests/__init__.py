@@ -0,0 +1,86 @@
+'''tests/__init__.py -- test suite for stackpm
+
+   Run from the top of the source tree:
+
+     python -m unittest discover -t . -s tests
+
+   Tests run against an in-memory sqlite database configured by
+   tests/stackpm.cfg, with the fake project_manager and calendar connector
+   of tests.fakelink, unless STACKPM_CONFIG is already set.
+
+   classes: DBTestCase
+   functions: fake_link, recorded, iteration, task
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import json
+import os
+import unittest
+from datetime import datetime, date, time, timedelta
+
+### GLOBALS
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+JIRA_DATA = os.path.join(TESTS_DIR, 'data', 'jira')
+os.environ.setdefault('STACKPM_CONFIG',
+                      os.path.join(TESTS_DIR, 'stackpm.cfg'))
+
+# a recent Monday, so that tests can count workdays by eye, and stats and
+# simulations, which run until today, are quick
+MONDAY = datetime.combine(date.today() - timedelta(
+                              days=date.today().weekday() + 28), time())
+
+### INTERNAL IMPORTS
+# NB: after STACKPM_CONFIG is set, config is loaded on first use
+from stackpm import db, links, sync, estimates, api
+
+### EXPOSED CLASSES
+class DBTestCase(unittest.TestCase):
+    '''TestCase with an empty database, and empty in-process caches, for
+       each test'''
+    def setUp(self):
+        db.create_all()
+        fake_link().reset()
+        sync._reset_days_off()
+        estimates._INDEX['models'].clear()
+        api.invalidate()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+### EXPOSED METHODS
+def fake_link():
+    '''Return the tests.fakelink Connector used as project_manager and
+       calendar link'''
+    return links.connector('project_manager')
+
+def recorded(name):
+    '''Return recorded Jira response or webhook payload ``name``, from
+       tests/data/jira, dated in the week of MONDAY'''
+    with open(os.path.join(JIRA_DATA, '{}.json'.format(name))) as f:
+        raw = f.read()
+    for day, day_name in enumerate(('monday', 'tuesday')):
+        raw = raw.replace('{{{}}}'.format(day_name),
+                          (MONDAY + timedelta(days=day)).strftime('%Y-%m-%d'))
+    return json.loads(raw)
+
+def iteration(ext_id, **kwargs):
+    '''Return an iteration dict, as returned by a project_manager link'''
+    return dict({'ext_id': ext_id, 'name': ext_id, 'rank': 1,
+                 'created_on': MONDAY, 'updated_on': MONDAY,
+                 'effort_est': None, 'value_est': None, 'team': None},
+                **kwargs)
+
+def task(ext_id, email='dev@example.com', **kwargs):
+    '''Return a task dict, as returned by a project_manager link'''
+    return dict({'ext_id': ext_id, 'name': ext_id, 'rank': 1,
+                 'created_on': MONDAY, 'updated_on': MONDAY,
+                 'user': {'email': email, 'pm_name': email.split('@')[0]},
+                 'iteration_ext_id': None, 'events': [],
+                 'effort_est': 'S', 'resolution': None, 'round_trips': None,
+                 'started_on': None, 'dev_done_on': None,
+                 'prod_done_on': None}, **kwargs)
+
+__all__ = ['TESTS_DIR', 'JIRA_DATA', 'MONDAY', 'DBTestCase', 'fake_link',
+           'recorded', 'iteration', 'task']
@@ -0,0 +1,66 @@
+'''tests/fakelink.py -- fake project_manager and calendar connector
+
+   Serves copies of the iteration, task, holiday and vacation dicts loaded
+   into it, as a link would, and records each call made to it.
+
+   classes: Connector
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import copy
+
+### INTERNAL IMPORTS
+from stackpm import null, instrument
+from stackpm.links import noop
+
+### EXPOSED CLASSES
+class Connector(noop.Connector):
+    '''Connector serving ``items``, see load'''
+    def __init__(self, config=None):
+        self.reset()
+
+    def __repr__(self):
+        return '<FakeLink>'
+
+    def __select(self, kind, since, ids, known):
+        '''Return copies of ``kind`` items, as selected by a link'''
+        self.calls.append((kind, since, ids, known))
+        items = []
+        for item in self.items[kind]:
+            if ids not in (None, null) and item['ext_id'] not in ids:
+                continue
+            if ids in (None, null) and since is not None and \
+                    item['updated_on'] < since:
+                continue
+            if known and item.get('content_hash') is not None and \
+                    known.get(item['ext_id']) == item['content_hash']:
+                continue
+            items.append(copy.deepcopy(item))
+        instrument.count('rows_fetched', len(items))
+        return iter(items)
+
+    def reset(self):
+        '''Drop every item loaded, and every call recorded'''
+        self.items = {'iterations': [], 'tasks': [], 'holidays': [],
+                      'vacations': []}
+        self.calls = []
+
+    def load(self, **items):
+        '''Replace the items of each kind passed, e.g. tasks=[...]'''
+        self.items.update(items)
+
+    def iterations(self, since=None, limit=None, ids=None, known=None):
+        return self.__select('iterations', since, ids, known)
+
+    def tasks(self, since=None, limit=None, ids=None, known=None):
+        return self.__select('tasks', since, ids, known)
+
+    def holidays(self, year=None):
+        return copy.deepcopy(self.items['holidays'])
+
+    def vacations(self, email=None):
+        return [copy.deepcopy(v) for v in self.items['vacations']
+                    if email is None or v['user']['email'] == email]
+
+__all__ = ['Connector']
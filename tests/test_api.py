@@ -0,0 +1,200 @@
+'''tests/test_api.py -- tests for stackpm.api
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import json
+import unittest
+from datetime import timedelta
+
+### INTERNAL IMPORTS
+from stackpm import stackpm_app, db, config, links, sync, api
+from stackpm.models import User, Task, Sync
+from tests import MONDAY, DBTestCase, fake_link, recorded, iteration, task
+
+### EXPOSED CLASSES
+class JiraWebhookTest(DBTestCase):
+    '''Recorded Jira webhook payloads are queued by project_manager_hook,
+       mapped by the jira connector's hook_task, and synced in a
+       micro-batch by sync_pushed_tasks'''
+    def setUp(self):
+        super(JiraWebhookTest, self).setUp()
+        self.links = config['links']
+        config['links'] = dict(self.links, project_manager='jira')
+        self.webhooks = config.get('webhooks', {})
+        config['webhooks'] = {}
+
+        # serve recorded responses, rather than calling out to Jira
+        self.requests = []
+        def get(method, **kwargs):
+            self.requests.append(method)
+            return recorded({'field': 'field',
+                              'search': 'search_epic'}[method])
+        links.connector('project_manager').get = get
+
+        # sync pushed tasks here, rather than in a PushWorker
+        self.start_push_worker = api.start_push_worker
+        api.start_push_worker = lambda: None
+        self.client = stackpm_app.test_client()
+
+    def tearDown(self):
+        api.start_push_worker = self.start_push_worker
+        config['links'] = self.links
+        config['webhooks'] = self.webhooks
+        sync.pop_pushed_tasks(wait=0, batch_wait=0)
+        super(JiraWebhookTest, self).tearDown()
+
+    def post(self, payload, url='/api/hooks/project_manager'):
+        return self.client.post(url, data=json.dumps(payload),
+                                content_type='application/json')
+
+    def test_replay(self):
+        for name in ('issue_created', 'issue_updated'):
+            resp = self.post(recorded(name))
+            self.assertEqual(202, resp.status_code)
+            self.assertEqual({'queued': 1}, json.loads(resp.data))
+
+        tasks = sync.pop_pushed_tasks(wait=0)
+        self.assertEqual(['WEB-102', 'WEB-101'],
+                         [t['ext_id'] for t in tasks])
+        record = sync.sync_pushed_tasks(tasks)
+        self.assertEqual('push', record.type)
+        self.assertEqual(None, sync._sync_since('task'))
+
+        created = Task.query.filter_by(ext_id='WEB-102').one()
+        self.assertEqual(('other@example.com', 'S', None, None),
+                         (created.user.email, created.effort_est,
+                          created.started_on, created.iteration))
+
+        updated = Task.query.filter_by(ext_id='WEB-101').one()
+        self.assertEqual('Check out with saved cards', updated.name)
+        self.assertEqual(MONDAY + timedelta(days=1, hours=10, minutes=15,
+                                            seconds=30), updated.started_on)
+        self.assertEqual(('dev@example.com', 'M', 'WEB-1', 'WEB'),
+                         (updated.user.email, updated.effort_est,
+                          updated.iteration.ext_id, updated.iteration.team))
+        # the iteration is fetched, as it was not yet synced
+        self.assertEqual('search', self.requests[-1])
+
+    def test_replay_update(self):
+        self.post(recorded('issue_updated'))
+        sync.sync_pushed_tasks(sync.pop_pushed_tasks(wait=0))
+
+        # a later update carrying no status change leaves started_on be
+        payload = recorded('issue_updated')
+        payload['issue']['fields']['summary'] = 'Pay with saved cards'
+        del payload['changelog']
+        self.post(payload)
+        sync.sync_pushed_tasks(sync.pop_pushed_tasks(wait=0))
+
+        updated = Task.query.filter_by(ext_id='WEB-101').one()
+        self.assertEqual('Pay with saved cards', updated.name)
+        self.assertEqual(MONDAY + timedelta(days=1, hours=10, minutes=15,
+                                            seconds=30), updated.started_on)
+        self.assertEqual(2, Sync.query.filter_by(type='push').count())
+
+    def test_epic(self):
+        payload = recorded('issue_created')
+        payload['issue']['fields']['issuetype']['name'] = 'Epic'
+        resp = self.post(payload)
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual({'queued': 0}, json.loads(resp.data))
+        self.assertEqual([], sync.pop_pushed_tasks(wait=0))
+
+    def test_bad_payload(self):
+        payload = recorded('issue_created')
+        del payload['issue']['fields']['summary']
+        self.assertEqual(400, self.post(payload).status_code)
+        self.assertEqual(400, self.post(['not', 'an', 'object']).status_code)
+        self.assertEqual([], sync.pop_pushed_tasks(wait=0))
+
+    def test_token(self):
+        config['webhooks'] = {'token': 's3cret'}
+        payload = recorded('issue_created')
+        self.assertEqual(403, self.post(payload).status_code)
+        self.assertEqual(403, self.post(
+            payload, '/api/hooks/project_manager?token=guess').status_code)
+        self.assertEqual(202, self.post(
+            payload, '/api/hooks/project_manager?token=s3cret').status_code)
+
+class WhatIfTest(DBTestCase):
+    '''iteration_what_if simulates edits against a warm model'''
+    def setUp(self):
+        super(WhatIfTest, self).setUp()
+        day = timedelta(days=1)
+        done = [task('D-{}'.format(i), iteration_ext_id='IT-1',
+                     started_on=MONDAY + i*day,
+                     dev_done_on=MONDAY + (i + 1)*day,
+                     prod_done_on=MONDAY + (i + 2)*day) for i in range(6)]
+        fake_link().load(iterations=[iteration('IT-1')],
+                         tasks=done + [task('O-1', iteration_ext_id='IT-1'),
+                                       task('O-2', iteration_ext_id='IT-1')])
+        sync.sync_tasks()
+        sync.sync_stats()
+        self.client = stackpm_app.test_client()
+
+    def post(self, *edits):
+        resp = self.client.post('/api/iterations/IT-1/what-if',
+                                data=json.dumps({'edits': list(edits)}),
+                                content_type='application/json')
+        return resp.status_code, json.loads(resp.data)
+
+    def test_what_if(self):
+        status, body = self.post(['remove', 'O-2'])
+        self.assertEqual(200, status)
+        self.assertEqual(200, body['baseline']['plays'])
+        self.assertTrue(body['what_if']['latest_date'] <=
+                        body['baseline']['latest_date'])
+
+    def test_errors(self):
+        self.assertEqual(400, self.post(['remove', 'D-1'])[0])
+        self.assertEqual(400, self.post(['rename', 'O-1'])[0])
+        status, body = self.post(['block', 'O-1', 'O-2'],
+                                 ['block', 'O-2', 'O-1'])
+        self.assertEqual(409, status)
+        self.assertEqual(['O-1', 'O-2'], sorted(body['cycle']))
+
+class CacheTest(DBTestCase):
+    '''Cached responses are evicted once another Sync is recorded, by any
+       process, and the least recently used beyond [server] cache_size'''
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        self.server = config.get('server', {})
+        config['server'] = dict(self.server, cache_size=3)
+        db.session.add(User(email='dev@example.com'))
+        db.session.add(Sync(type='task', last_seen_update=MONDAY))
+        db.session.commit()
+        self.client = stackpm_app.test_client()
+
+    def tearDown(self):
+        config['server'] = self.server
+        super(CacheTest, self).tearDown()
+
+    def test_bounded(self):
+        url = '/api/stats/dev@example.com?since=2015-01-0{}'
+        for day in range(1, 6):
+            self.assertEqual(200, self.client.get(url.format(day)).status_code)
+        self.assertEqual([url.format(d) for d in (3, 4, 5)],
+                         [k[1] for k in api._CACHE])
+
+        # a hit is most recently used
+        self.client.get(url.format(3))
+        self.client.get(url.format(6))
+        self.assertEqual(['5', '3', '6'], [k[1][-1] for k in api._CACHE])
+
+    def test_other_process(self):
+        self.client.get('/api/stats/dev@example.com')
+        self.client.get('/api/stats/dev@example.com?since=2015-01-01')
+        # recorded by another process, so no after_insert invalidation here
+        with db.engine.begin() as conn:
+            conn.execute(Sync.__table__.insert().values(
+                type='task', last_seen_update=MONDAY + timedelta(days=1)))
+
+        self.client.get('/api/stats/dev@example.com')
+        key = api._sync_key()
+        self.assertEqual([(key, '/api/stats/dev@example.com?')],
+                         list(api._CACHE))
+
+if __name__ == '__main__':
+    unittest.main()
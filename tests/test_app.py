@@ -0,0 +1,40 @@
+'''tests/test_app.py -- tests for stackpm's lazy application setup
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import os
+import subprocess
+import sys
+import unittest
+
+### INTERNAL IMPORTS
+from tests import TESTS_DIR
+
+### GLOBALS
+# modules whose import must not import flask, or load config
+_PURE = ('stackpm', 'stackpm.calendars', 'stackpm.simulate', 'stackpm.stats',
+         'stackpm.instrument', 'stackpm.querylog', 'stackpm.links')
+
+### EXPOSED CLASSES
+class LazyImportTest(unittest.TestCase):
+    '''Computation modules import without flask, config or a database'''
+    def test_pure(self):
+        check = '; '.join([
+            'import sys, {}',
+            'import stackpm',
+            'assert "flask" not in sys.modules, "flask imported"',
+            'assert not stackpm.config.loaded, "config loaded"'])
+        env = dict(os.environ, STACKPM_CONFIG='/nonexistent/stackpm.cfg')
+        for module in _PURE:
+            proc = subprocess.Popen([sys.executable, '-c',
+                                     check.format(module)],
+                                    cwd=os.path.dirname(TESTS_DIR), env=env,
+                                    stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+            self.assertEqual(0, proc.returncode, '{}: {}'.format(module,
+                                                                 err))
+
+if __name__ == '__main__':
+    unittest.main()
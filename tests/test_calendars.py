@@ -0,0 +1,70 @@
+'''tests/test_calendars.py -- tests for stackpm.calendars
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import math
+import unittest
+from datetime import datetime, timedelta
+
+### 3RD PARTY IMPORTS
+import numpy
+from workdays import workday
+
+### INTERNAL IMPORTS
+from stackpm import calendars
+
+### GLOBALS
+# a Wednesday, with a holiday on the Friday and the Tuesday after
+START = datetime(2015, 1, 7)
+HOLIDAYS = [datetime(2015, 1, 9), datetime(2015, 1, 13)]
+
+### EXPOSED CLASSES
+class WorkdayOffsetsTest(unittest.TestCase):
+    '''workday_offsets agrees with a workdays.workday loop'''
+    def expected(self, starts, offsets, holidays):
+        '''Return the dates of a workdays.workday loop, fractional offsets
+           being done on the date of their ceiling'''
+        return [workday(s, int(math.ceil(o)), holidays=holidays).date()
+                    for s,o in zip(starts, offsets)]
+
+    def dates(self, done):
+        '''Return a list of the dates of datetime64 array ``done``'''
+        return done.astype('datetime64[D]').tolist()
+
+    def test_workday(self):
+        # every start of a fortnight, weekends and holidays included
+        starts, offsets = [], []
+        for day in range(14):
+            for offset in numpy.arange(0, 12, 0.25):
+                starts.append(START + timedelta(days=day))
+                offsets.append(offset)
+
+        done = calendars.workday_offsets(starts, offsets,
+                                         calendars.dates(HOLIDAYS))
+        self.assertEqual(self.expected(starts, offsets, HOLIDAYS),
+                         self.dates(done))
+        done = calendars.workday_offsets(starts, offsets)
+        self.assertEqual(self.expected(starts, offsets, []),
+                         self.dates(done))
+
+    def test_fraction(self):
+        done = calendars.workday_offsets(START, [0.5, 1, 1.25])
+        self.assertEqual([datetime(2015, 1, 8, 12),
+                          datetime(2015, 1, 8),
+                          datetime(2015, 1, 9, 6)], done.tolist())
+
+    def test_keys(self):
+        offsets = numpy.arange(0, 8, 0.5)
+        keys = numpy.arange(len(offsets)) % 2
+        done = calendars.workday_offsets(
+            START, offsets, {0: calendars.dates(HOLIDAYS),
+                             1: calendars.dates([])}, keys=keys)
+        self.assertEqual(
+            [self.expected([START], [o], HOLIDAYS if k == 0 else [])[0]
+                 for o,k in zip(offsets, keys)],
+            self.dates(done))
+
+if __name__ == '__main__':
+    unittest.main()
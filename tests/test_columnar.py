@@ -0,0 +1,78 @@
+'''tests/test_columnar.py -- tests for stackpm.columnar
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import select, type_coerce
+
+### INTERNAL IMPORTS
+from stackpm import db, sync, columnar
+from tests import MONDAY, DBTestCase, fake_link, iteration, task
+
+### GLOBALS
+DAY = timedelta(days=1)
+
+### EXPOSED CLASSES
+class RoundTripTest(DBTestCase):
+    '''Exported tables are restored row for row, as stored'''
+    def setUp(self):
+        super(RoundTripTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        done = [task('D-{}'.format(i), iteration_ext_id='IT-1',
+                     effort_est='SM'[i % 2], round_trips=i % 3 or None,
+                     started_on=MONDAY + i*DAY,
+                     dev_done_on=MONDAY + (i + 1)*DAY,
+                     prod_done_on=MONDAY + (i + 2)*DAY) for i in range(5)]
+        fake_link().load(iterations=[iteration('IT-1')],
+                         tasks=done + [task('O-1', effort_est=None,
+                                            email='other@example.com')])
+        sync.sync_tasks()
+        sync.sync_stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(RoundTripTest, self).tearDown()
+
+    def rows(self):
+        '''Return a dict of table => rows, as stored'''
+        rows = {}
+        for table in columnar._tables(columnar.EXPORT_TABLES):
+            query = select([type_coerce(c, columnar._raw_type(c))
+                                for c in table.columns])\
+                        .order_by(*table.primary_key.columns)
+            rows[table.name] = [tuple(r) for r in
+                                    db.engine.execute(query).fetchall()]
+        return rows
+
+    def test_round_trip(self):
+        stored = self.rows()
+        counts = dict((t, len(r)) for t,r in stored.iteritems())
+        # in chunks smaller than each table
+        self.assertEqual(counts, columnar.export(self.path, chunk=2))
+
+        db.session.remove()
+        db.drop_all()
+        self.assertEqual(counts, columnar.restore(self.path, chunk=2))
+        self.assertEqual(stored, self.rows())
+
+    def test_load(self):
+        columnar.export(self.path)
+        task, vocabs = columnar.load(self.path, 'task')
+        ext_ids = columnar.decode(task['ext_id'], vocabs['ext_id']).tolist()
+        by_ext_id = lambda vals: [v for _,v in sorted(zip(ext_ids, vals))]
+        self.assertEqual(['S', 'M', 'S', 'M', 'S', None], by_ext_id(
+            columnar.decode(task['effort_est'], vocabs['effort_est'])))
+        # null integers are masked, rather than stored as 0
+        self.assertEqual([True, False, False, True, False, True],
+                         by_ext_id(task['round_trips.null'].tolist()))
+        self.assertEqual('datetime64[us]', str(task['created_on'].dtype))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+'''tests/test_daemon.py -- tests for stackpm.daemon
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+### INTERNAL IMPORTS
+from stackpm import sync, daemon
+
+### GLOBALS
+TIMEOUT = 5
+
+### INTERNAL METHODS
+def _wait_for(predicate, timeout=TIMEOUT):
+    '''Poll ``predicate`` until it is true, or ``timeout`` seconds pass'''
+    until = time.time() + timeout
+    while not predicate() and time.time() < until:
+        time.sleep(0.01)
+    return predicate()
+
+### EXPOSED CLASSES
+class DaemonTest(unittest.TestCase):
+    '''Bursts of triggers, and triggers arriving during a run, are
+       coalesced into a single run'''
+    def setUp(self):
+        self.daemon = daemon.Daemon(interval=3600, coalesce=0.2)
+        self.runs, self.release = [], threading.Event()
+        self.release.set()
+        def run_once(jobs):
+            self.runs.append(sorted(jobs))
+            self.release.wait(TIMEOUT)
+            return True
+        self.daemon.run_once = run_once
+        self.thread = threading.Thread(target=self.daemon.run)
+        self.thread.start()
+        # the first run syncs everything
+        self.assertTrue(_wait_for(lambda: len(self.runs) == 1))
+        self.assertEqual([['calendar', 'incremental']], self.runs)
+
+    def tearDown(self):
+        self.release.set()
+        self.daemon.stop()
+        self.thread.join(TIMEOUT)
+
+    def test_burst(self):
+        for _ in range(5):
+            self.daemon.trigger()
+            time.sleep(0.05)
+        self.daemon.trigger('calendar')
+        self.assertTrue(_wait_for(lambda: len(self.runs) == 2))
+        time.sleep(0.4)
+        self.assertEqual([['calendar', 'incremental']], self.runs[1:])
+
+    def test_running(self):
+        self.release.clear()
+        self.daemon.trigger()
+        self.assertTrue(_wait_for(lambda: len(self.runs) == 2))
+        for _ in range(3):
+            self.daemon.trigger()
+        self.release.set()
+        self.assertTrue(_wait_for(lambda: len(self.runs) == 3))
+        time.sleep(0.4)
+        self.assertEqual([['incremental'], ['incremental']], self.runs[1:])
+
+class SyncLockTest(unittest.TestCase):
+    '''sync_lock excludes syncs in this process, and in any other process
+       holding the lock file'''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.lock_file = os.path.join(self.path, 'sync.lock')
+        self.entered = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def enter(self):
+        '''Enter sync_lock in another thread, and return the thread'''
+        def run():
+            with daemon.sync_lock(self.lock_file):
+                self.entered.set()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_thread(self):
+        with daemon.sync_lock(self.lock_file):
+            thread = self.enter()
+            self.assertFalse(self.entered.wait(0.2))
+        thread.join(TIMEOUT)
+        self.assertTrue(self.entered.is_set())
+
+    def test_lock_file(self):
+        # as held by another process, e.g. python -m stackpm.daemon --once
+        with open(self.lock_file, 'a') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            thread = self.enter()
+            self.assertFalse(self.entered.wait(0.2))
+            fcntl.flock(held, fcntl.LOCK_UN)
+        thread.join(TIMEOUT)
+        self.assertTrue(self.entered.is_set())
+
+class PushWorkerTest(unittest.TestCase):
+    '''The PushWorker outlives failures to pop or sync pushed tasks'''
+    def setUp(self):
+        self.pop, self.sync = sync.pop_pushed_tasks, sync.sync_pushed_tasks
+        self.synced = []
+        pops = [IOError('queue'), [{'ext_id': 'T-1'}], ValueError('sync'),
+                [{'ext_id': 'T-2'}]]
+        def pop(**kwargs):
+            if not pops:
+                # stops the worker, quietly
+                raise SystemExit()
+            popped = pops.pop(0)
+            if isinstance(popped, Exception):
+                raise popped
+            return popped
+        def sync_pushed(tasks, stat_cache=None):
+            if tasks[0]['ext_id'] == 'T-1':
+                raise ValueError('sync')
+            self.synced.append(tasks)
+        sync.pop_pushed_tasks, sync.sync_pushed_tasks = pop, sync_pushed
+
+    def tearDown(self):
+        sync.pop_pushed_tasks, sync.sync_pushed_tasks = self.pop, self.sync
+
+    def test_failures(self):
+        worker = daemon.PushWorker(batch_wait=0)
+        worker.start()
+        worker.join(TIMEOUT)
+        self.assertEqual([[{'ext_id': 'T-2'}]], self.synced)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+'''tests/test_jira.py -- tests for stackpm_jira, against recorded responses
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import threading
+import unittest
+from datetime import timedelta
+
+### INTERNAL IMPORTS
+from stackpm import config
+from stackpm_jira import Connector
+from tests import MONDAY, recorded
+
+### EXPOSED CLASSES
+class ChangelogTest(unittest.TestCase):
+    '''Changelogs truncated by search are paged in full, by a pool of
+       threads closed once the search ends'''
+    def setUp(self):
+        self.link = Connector(dict(config['jira'], changelog_page_size=2))
+        self.requests = []
+        changelog = recorded('changelog')['values']
+        def get(method, params=None, **kwargs):
+            self.requests.append((method, (params or {}).get('startAt')))
+            if method.endswith('/changelog'):
+                start, page = params['startAt'], params['maxResults']
+                return {'startAt': start, 'maxResults': page,
+                        'total': len(changelog),
+                        'isLast': start + page >= len(changelog),
+                        'values': changelog[start:start + page]}
+            return recorded({'field': 'field',
+                             'search': 'search_truncated'}[method])
+        self.link.get = get
+
+    def test_truncated(self):
+        threads = threading.active_count()
+        tasks = list(self.link.tasks())
+        self.assertEqual(threads, threading.active_count())
+
+        self.assertEqual([('issue/WEB-101/changelog', 0),
+                          ('issue/WEB-101/changelog', 2),
+                          ('issue/WEB-101/changelog', 4)],
+                         [r for r in self.requests if r[0] != 'field'
+                                                   and r[0] != 'search'])
+        task, = tasks
+        self.assertEqual((MONDAY + timedelta(hours=9, minutes=30),
+                          MONDAY + timedelta(days=1, hours=9),
+                          MONDAY + timedelta(days=1, hours=16), 1),
+                         (task['started_on'], task['dev_done_on'],
+                          task['prod_done_on'], task['round_trips']))
+        self.assertEqual([('estimate-change', '3', '5')],
+                         [(e['type'], e['from_effort_est'],
+                           e['to_effort_est']) for e in task['events']])
+
+    def test_abandoned(self):
+        threads = threading.active_count()
+        tasks = self.link.tasks()
+        next(tasks)
+        tasks.close()
+        self.assertEqual(threads, threading.active_count())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+'''tests/test_migrate.py -- tests for stackpm.migrate
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import unittest
+
+### 3RD PARTY IMPORTS
+from sqlalchemy import MetaData, Table
+
+### INTERNAL IMPORTS
+from stackpm import db, sync
+from stackpm.migrate import migrate
+from stackpm.models import Simulation, Sync
+from tests import DBTestCase, fake_link, task
+
+### GLOBALS
+# columns added to existing tables since the first release, by table
+_ADDED = {'iteration': ('content_hash',), 'task': ('content_hash',),
+          'simulation': ('seed', 'input_hash', 'critical_path')}
+
+# the sync table as created by the first release
+_OLD_SYNC = '''CREATE TABLE sync (
+    id INTEGER NOT NULL,
+    synced_on DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    last_seen_update DATETIME NOT NULL,
+    type VARCHAR(10) NOT NULL,
+    notes TEXT,
+    PRIMARY KEY (id),
+    CHECK (type IN ('full', 'iteration', 'task', 'holiday', 'vacation'))
+)'''
+
+### INTERNAL METHODS
+def _drop_columns(conn, name, columns):
+    '''Re-create table ``name`` without ``columns``, keeping its rows and
+       primary key'''
+    table = db.metadata.tables[name]
+    keep = [c for c in table.columns if c.name not in columns]
+    conn.execute('CREATE TABLE "_old" AS SELECT * FROM "{}"'.format(name))
+    conn.execute('DROP TABLE "{}"'.format(name))
+    Table(name, MetaData(), *[c.copy() for c in keep]).create(conn)
+    names = ', '.join(['"{}"'.format(c.name) for c in keep])
+    conn.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM "_old"'.format(
+                     name, names))
+    conn.execute('DROP TABLE "_old"')
+
+### EXPOSED CLASSES
+class MigrateTest(DBTestCase):
+    '''migrate brings a database created by an earlier stackpm up to date'''
+    def setUp(self):
+        super(MigrateTest, self).setUp()
+        with db.engine.begin() as conn:
+            conn.execute("INSERT INTO simulation (simulation_on, "
+                         "iteration_id, algorithm, plays) VALUES "
+                         "('2014-01-06 00:00:00.000000', 1, 'monte-carlo', "
+                         "1000)")
+            for name, columns in _ADDED.iteritems():
+                _drop_columns(conn, name, columns)
+            conn.execute('DROP TABLE stat_window')
+            conn.execute('DROP TABLE sync')
+            conn.execute(_OLD_SYNC)
+            conn.execute("INSERT INTO sync (last_seen_update, type, notes) "
+                         "VALUES ('2014-01-06 00:00:00.000000', 'task', "
+                         "NULL)")
+
+    def test_migrate(self):
+        changes = migrate()
+        self.assertEqual(set(['added iteration.content_hash',
+                              'added task.content_hash',
+                              'added simulation.seed',
+                              'added simulation.input_hash',
+                              'added simulation.critical_path',
+                              'added sync.source',
+                              'created stat_window',
+                              'rebuilt sync for stat, simulation, push, '
+                              'backfill']),
+                         set([c for c in changes
+                                  if not c.startswith('indexed')]))
+        self.assertEqual([], migrate())
+
+        # rows are kept, and new Sync types and columns may be written
+        sim = Simulation.query.one()
+        self.assertEqual((1000, None), (sim.plays, sim.seed))
+        sim.seed = 1
+        db.session.commit()
+        self.assertEqual(['task'], [s.type for s in Sync.query.all()])
+        self.assertEqual('simulation', sync.sync_simulations().type)
+        self.assertEqual('push', sync.sync_pushed_tasks([task('T-1')]).type)
+        self.assertEqual('backfill', sync.sync_backfill([
+                             ('task', task('T-2'))]).type)
+        fake_link().load(tasks=[task('T-3')])
+        self.assertEqual(None, sync.sync_tasks().source)
+
+if __name__ == '__main__':
+    unittest.main()
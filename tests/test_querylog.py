@@ -0,0 +1,131 @@
+'''tests/test_querylog.py -- query budgets of sync and the API, guarding
+   against N+1 patterns, see stackpm.querylog
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import json
+import unittest
+from datetime import timedelta
+
+### INTERNAL IMPORTS
+from stackpm import stackpm_app, sync, api
+from stackpm.models import User
+from stackpm.querylog import QueryLog, QueryBudgetError, query_budget
+from tests import MONDAY, DBTestCase, fake_link, iteration, task
+
+### GLOBALS
+DAY = timedelta(days=1)
+
+### INTERNAL METHODS
+def _tasks(n, **kwargs):
+    '''Return ``n`` task dicts, across 4 users and 2 iterations'''
+    return [task('T-{}'.format(i), 'dev{}@example.com'.format(i % 4),
+                 iteration_ext_id='IT-{}'.format(1 + i % 2), **kwargs)
+                for i in range(n)]
+
+### EXPOSED CLASSES
+class QueryLogTest(DBTestCase):
+    '''QueryLog counts queries by region, and query_budget enforces them'''
+    def test_regions(self):
+        with QueryLog() as log:
+            with log.region('outer'):
+                User.query.all()
+                with log.region('inner'):
+                    for email in ('a@example.com', 'b@example.com'):
+                        User.query.filter_by(email=email).first()
+        self.assertEqual((3, 2), (log.count('outer'),
+                                  log.count('outer/inner')))
+        self.assertEqual([2], [n for n,_ in log.repeated('outer')])
+        self.assertEqual([], log.duplicates())
+        self.assertRaises(QueryBudgetError, log.check, 1, 'outer/inner')
+
+    def test_budget(self):
+        with query_budget(1):
+            User.query.all()
+        with self.assertRaises(QueryBudgetError) as caught:
+            with query_budget(1):
+                User.query.all()
+                User.query.all()
+        self.assertEqual((1, 2), (caught.exception.budget,
+                                  caught.exception.issued))
+
+class SyncBudgetTest(DBTestCase):
+    '''sync_tasks issues a number of queries independent of the number of
+       tasks updated, and one insert per task created'''
+    def sync(self, tasks):
+        fake_link().load(iterations=[iteration('IT-1'), iteration('IT-2')],
+                         tasks=tasks)
+        with query_budget(300) as log:
+            sync.sync_tasks()
+        return log.count()
+
+    def test_sync_tasks(self):
+        edit = {'effort_est': 'M', 'updated_on': MONDAY + DAY}
+        created = self.sync(_tasks(10))
+        updated = self.sync(_tasks(10, **edit))
+
+        # start over, with 4 times the tasks
+        self.tearDown()
+        self.setUp()
+        self.assertEqual(created + 30, self.sync(_tasks(40)))
+        self.assertEqual(updated, self.sync(_tasks(40, **edit)))
+
+class APIBudgetTest(DBTestCase):
+    '''Cached API views issue a number of queries independent of the
+       number of rows on a miss, and only the Sync lookup on a hit'''
+    def load(self, n):
+        '''Sync ``n`` tasks, a quarter of them with an estimate change'''
+        tasks = _tasks(n)
+        for t in tasks[::4]:
+            t['events'] = [{'type': 'estimate-change',
+                            'occured_on': MONDAY + DAY,
+                            'from_effort_est': 'XS', 'to_effort_est': 'S'}]
+        fake_link().load(iterations=[iteration('IT-1'), iteration('IT-2')],
+                         tasks=tasks)
+        sync.sync_tasks()
+
+    def miss(self, url):
+        '''Return the response to ``url``, and the queries it issued'''
+        api.invalidate()
+        with query_budget(10) as log:
+            resp = self.client.get(url)
+        self.assertEqual(200, resp.status_code)
+        return json.loads(resp.data), log.count()
+
+    def setUp(self):
+        super(APIBudgetTest, self).setUp()
+        self.load(8)
+        self.client = stackpm_app.test_client()
+
+    def test_views(self):
+        for url in ('/api/stats/dev1@example.com', '/api/iterations/IT-1',
+                    '/api/iterations/IT-1/simulations'):
+            with query_budget(5):
+                resp = self.client.get(url)
+            self.assertEqual(200, resp.status_code)
+            with query_budget(1):
+                self.assertEqual(200, self.client.get(url).status_code)
+            with query_budget(1):
+                self.assertEqual(304, self.client.get(url, headers={
+                    'If-None-Match': resp.headers['ETag']}).status_code)
+
+    def test_snapshot(self):
+        url = '/api/iterations/IT-1?as_of={}'.format(
+                  MONDAY.strftime(api.API_DATE_FMT))
+        snapshot, issued = self.miss(url)
+        # tasks with no events are kept, and estimates are rolled back
+        self.assertEqual([('T-0', 'XS'), ('T-2', 'S'), ('T-4', 'XS'),
+                          ('T-6', 'S')],
+                         sorted([(t['ext_id'], t['effort_est'])
+                                     for t in snapshot['tasks']]))
+
+        # 4 times the tasks and events, in as many queries
+        self.load(32)
+        snapshot, more = self.miss(url)
+        self.assertEqual(16, len(snapshot['tasks']))
+        self.assertEqual(issued, more)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+'''tests/test_simulate.py -- tests for stackpm.simulate
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import unittest
+from datetime import date
+
+### 3RD PARTY IMPORTS
+import numpy
+
+### INTERNAL IMPORTS
+from stackpm import simulate
+
+### EXPOSED CLASSES
+class ToposortTest(unittest.TestCase):
+    '''toposort keeps priority order, but for blocked tasks'''
+    def test_priority(self):
+        self.assertEqual([1, 2, 3], simulate.toposort([1, 2, 3], {}))
+        # blockers not being sorted are ignored
+        self.assertEqual([1, 2, 3], simulate.toposort([1, 2, 3], {1: [9]}))
+
+    def test_blocked(self):
+        self.assertEqual([2, 1, 3], simulate.toposort([1, 2, 3], {1: [2]}))
+        self.assertEqual([3, 2, 1], simulate.toposort([1, 2, 3],
+                                                      {1: [2], 2: [3]}))
+        # 1 goes as soon as it is unblocked, ready tasks by priority
+        self.assertEqual([2, 3, 4, 1], simulate.toposort([1, 2, 3, 4],
+                                                         {1: [4]}))
+        self.assertEqual([2, 1, 3, 4], simulate.toposort([1, 2, 3, 4],
+                                                         {1: [2]}))
+
+    def test_cycle(self):
+        with self.assertRaises(simulate.CycleError) as caught:
+            simulate.toposort([1, 2, 3, 4], {2: [3], 3: [2], 4: [3]})
+        # only tasks on the cycle, not 4 waiting on it
+        self.assertEqual([2, 3], caught.exception.keys)
+        self.assertIn('2, 3', str(caught.exception))
+
+        with self.assertRaises(simulate.CycleError) as caught:
+            simulate.toposort([1, 2], {1: [1]})
+        self.assertEqual([1], caught.exception.keys)
+
+class SummaryTest(unittest.TestCase):
+    '''Summaries survive encoding, and merge as if played together'''
+    def setUp(self):
+        base = date(2015, 1, 5).toordinal()
+        stream = numpy.random.RandomState(0)
+        self.first = base + stream.randint(0, 20, size=500)
+        self.second = base + 10 + stream.randint(0, 30, size=300)
+
+    def assertSummaryEqual(self, expected, actual):
+        self.assertEqual((expected.base, expected.counts.tolist(),
+                          expected.percentiles),
+                         (actual.base, actual.counts.tolist(),
+                          actual.percentiles))
+
+    def test_round_trip(self):
+        summary = simulate.Summary.from_ordinals(self.first)
+        decoded = simulate.Summary.loads(summary.dumps())
+        self.assertSummaryEqual(summary, decoded)
+        self.assertEqual(500, decoded.plays)
+        # percentiles are read back as stored, and agree with the plays
+        ordered = numpy.sort(self.first)
+        for p, ordinal in decoded.percentiles.iteritems():
+            self.assertEqual(ordered[int((500 - 1)*p/100.)], ordinal)
+
+    def test_merge(self):
+        first = simulate.Summary.from_ordinals(self.first)
+        second = simulate.Summary.from_ordinals(self.second)
+        both = simulate.Summary.from_ordinals(
+                   numpy.concatenate([self.first, self.second]))
+        self.assertSummaryEqual(both, first.merge(second))
+        self.assertSummaryEqual(both, second.merge(first))
+        # merging decoded summaries unpacks their histograms
+        self.assertSummaryEqual(both, simulate.Summary.loads(
+            first.dumps()).merge(simulate.Summary.loads(second.dumps())))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+'''tests/test_stats.py -- tests for stackpm.stats
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import unittest
+from datetime import datetime, date, time, timedelta
+
+### 3RD PARTY IMPORTS
+import numpy
+
+### INTERNAL IMPORTS
+from stackpm import db, config, sync, stats, simulate
+from stackpm.models import Task, Iteration
+from tests import MONDAY, DBTestCase, fake_link, iteration, task
+
+### GLOBALS
+DAY = timedelta(days=1)
+
+### EXPOSED CLASSES
+class CycleTest(DBTestCase):
+    '''Dependency cycles between open tasks are reported on simulations of
+       their iterations, and those between done tasks are ignored'''
+    def setUp(self):
+        super(CycleTest, self).setUp()
+        done = [task('D-{}'.format(i), iteration_ext_id='IT-1',
+                     started_on=MONDAY + i*DAY,
+                     dev_done_on=MONDAY + (i + 1)*DAY,
+                     prod_done_on=MONDAY + (i + 2)*DAY) for i in range(6)]
+        fake_link().load(
+            iterations=[iteration('IT-1'), iteration('IT-2', rank=2)],
+            tasks=done + [task('O-1', iteration_ext_id='IT-1', rank=1),
+                          task('O-2', iteration_ext_id='IT-1', rank=2),
+                          task('O-3', iteration_ext_id='IT-2', rank=1)])
+        sync.sync_tasks()
+        sync.sync_stats()
+        self.tasks = dict([(t.ext_id, t) for t in Task.query])
+        self.today = datetime.combine(date.today(), time())
+
+    def block(self, ext_id, blocker_ext_id):
+        '''Make task ``ext_id`` wait on task ``blocker_ext_id``'''
+        self.tasks[ext_id].blocks.append(self.tasks[blocker_ext_id])
+        db.session.commit()
+
+    def forecast(self):
+        '''Return today's simulations of IT-1 and IT-2, by ext_id'''
+        iters = Iteration.query.all()
+        return dict([(s['iteration'].ext_id, s) for s in
+                         stats.forecast_portfolio(iters, self.today)])
+
+    def test_done(self):
+        self.block('D-0', 'D-1')
+        self.block('D-1', 'D-0')
+        sims = self.forecast()
+        self.assertEqual(None, sims['IT-1']['errors'])
+        self.assertEqual(200, sims['IT-1']['plays'])
+
+    def test_open(self):
+        self.block('O-1', 'O-2')
+        self.block('O-2', 'O-1')
+        sims = self.forecast()
+        self.assertEqual([('O-1', ['O-1', 'O-2']), ('O-2', ['O-1', 'O-2'])],
+                         [(e['task'], e['cycle'])
+                              for e in sims['IT-1']['errors']])
+        self.assertEqual(None, sims['IT-1']['data'])
+        # tasks on the cycle are still worked, ahead of IT-2
+        self.assertEqual(None, sims['IT-2']['errors'])
+        self.assertEqual(200, sims['IT-2']['plays'])
+
+    def test_what_if(self):
+        self.block('O-1', 'O-2')
+        model = stats.WhatIf(Iteration.query.all(), day=self.today)
+        with self.assertRaises(simulate.CycleError) as caught:
+            model.simulate([('block', 'O-2', 'O-1')])
+        self.assertEqual(['O-1', 'O-2'], caught.exception.keys)
+
+        # a cycle already in the model is reported, as by forecast
+        self.block('O-2', 'O-1')
+        model = stats.WhatIf(Iteration.query.all(), day=self.today)
+        sims = model.simulate([('estimate', 'O-3', 'M')])
+        self.assertEqual(2, len(sims[self.tasks['O-1'].iteration_id]
+                                    ['errors']))
+
+class ForecastTest(DBTestCase):
+    '''Rolling forecasts agree with forecasts of each day alone, re-drawing
+       a task only when its inputs change; adaptive forecasts stop once
+       converged, or at max_plays; and a seed yields the same simulations
+       for any number of workers'''
+    def setUp(self):
+        super(ForecastTest, self).setUp()
+        self.forecast_cfg = config['forecast']
+        done = [task('D-{}'.format(i), iteration_ext_id='IT-1',
+                     started_on=MONDAY + i*DAY,
+                     dev_done_on=MONDAY + (i + 9)*DAY,
+                     prod_done_on=MONDAY + (i + 10)*DAY) for i in range(6)]
+        fake_link().load(iterations=[iteration('IT-1')], tasks=done + [
+            task('O-1', iteration_ext_id='IT-1', rank=2),
+            task('O-2', iteration_ext_id='IT-1', rank=1,
+                 started_on=MONDAY + 21*DAY)])
+        sync.sync_tasks()
+        sync.sync_stats()
+        self.iter_ = Iteration.query.one()
+        self.tasks = dict([(t.ext_id, t.id) for t in Task.query])
+
+    def tearDown(self):
+        config['forecast'] = self.forecast_cfg
+        super(ForecastTest, self).tearDown()
+
+    def sims(self, on_date, to_date=None, **kwargs):
+        '''Return a list of (day, plays, counts) of forecasts of IT-1'''
+        return [(s['simulation_on'], s['plays'], s['data'].counts.tolist())
+                    for s in stats.forecast(self.iter_, on_date, to_date,
+                                            seed=3, **kwargs)]
+
+    def test_rolling(self):
+        drawn = []
+        def stream(seed, batch, key):
+            drawn.append(key)
+            return self.stream(seed, batch, key)
+        self.stream, simulate._stream = simulate._stream, stream
+        try:
+            # Monday to Sunday, O-2 is in progress on weekdays only
+            rolling = self.sims(MONDAY + 21*DAY, MONDAY + 27*DAY)
+        finally:
+            simulate._stream = self.stream
+
+        self.assertEqual(rolling, sum([self.sims(MONDAY + d*DAY)
+                                           for d in range(21, 28)], []))
+        # a draw for each of 2 batches, per distinct inputs
+        self.assertEqual((2, 10), (drawn.count(self.tasks['O-1']),
+                                   drawn.count(self.tasks['O-2'])))
+
+    def test_adaptive(self):
+        day = MONDAY + 21*DAY
+        config['forecast'] = dict(self.forecast_cfg, max_plays=500,
+                                  tolerance=100)
+        self.assertEqual([100], [p for _,p,_ in self.sims(day,
+                                                          adaptive=True)])
+        config['forecast'] = dict(self.forecast_cfg, max_plays=500,
+                                  tolerance=0)
+        self.assertEqual([500], [p for _,p,_ in self.sims(day,
+                                                          adaptive=True)])
+
+    def test_workers(self):
+        day = MONDAY + 21*DAY
+        config['forecast'] = dict(self.forecast_cfg, max_plays=500,
+                                  tolerance=0.5)
+        for adaptive in (False, True):
+            self.assertEqual(self.sims(day, adaptive=adaptive, workers=1),
+                             self.sims(day, adaptive=adaptive, workers=3))
+
+class PortfolioTest(DBTestCase):
+    '''A user works their tasks across iterations jointly, in rank order,
+       and iterations waiting on a task that can't be simulated are not
+       reported'''
+    def setUp(self):
+        super(PortfolioTest, self).setUp()
+        done = [task('D-{}'.format(i), iteration_ext_id='IT-1',
+                     started_on=MONDAY + i*DAY,
+                     dev_done_on=MONDAY + (i + 1)*DAY,
+                     prod_done_on=MONDAY + (i + 2)*DAY) for i in range(6)]
+        self.iterations = [iteration('IT-1'), iteration('IT-2', rank=2),
+                           iteration('IT-3', rank=3)]
+        self.tasks = done + [task('O-1', iteration_ext_id='IT-1'),
+                             task('O-2', iteration_ext_id='IT-2'),
+                             task('O-3', 'other@example.com',
+                                  iteration_ext_id='IT-3')]
+        self.today = datetime.combine(date.today(), time())
+
+    def forecast(self):
+        '''Return today's simulations, by ext_id, jointly and alone'''
+        fake_link().load(iterations=self.iterations, tasks=self.tasks)
+        sync.sync_tasks()
+        sync.sync_stats()
+        iters = Iteration.query.order_by(Iteration.rank).all()
+        return (dict([(s['iteration'].ext_id, s) for s in
+                          stats.forecast_portfolio(iters, self.today)]),
+                dict([(i.ext_id, list(stats.forecast(i, self.today))[0])
+                          for i in iters]))
+
+    def test_ranked(self):
+        joint, alone = self.forecast()
+        # IT-2 waits on IT-1, worked by the same user
+        self.assertEqual(joint['IT-1']['data'].percentiles,
+                         alone['IT-1']['data'].percentiles)
+        for p in simulate.PERCENTILES:
+            self.assertTrue(joint['IT-2']['data'].percentile(p) >
+                            alone['IT-2']['data'].percentile(p))
+
+    def test_no_history(self):
+        self.tasks.append(task('O-4', iteration_ext_id='IT-1',
+                               effort_est='XL'))
+        joint, _ = self.forecast()
+        self.assertEqual(['Cannot Simulate, No History'],
+                         [e['error'] for e in joint['IT-1']['errors']])
+        self.assertEqual([('O-2', 'O-4')],
+                         [(e['task'], e['waiting_on'])
+                              for e in joint['IT-2']['errors']])
+        self.assertEqual(None, joint['IT-2']['data'])
+        # IT-3 is worked by another user, whose history of other is empty
+        self.assertEqual(['Cannot Simulate, No History'],
+                         [e['error'] for e in joint['IT-3']['errors']])
+
+class TrailingTest(unittest.TestCase):
+    '''Trailing windows summed from prefix sums agree with re-scanning the
+       items done in each window'''
+    def setUp(self):
+        stream = numpy.random.RandomState(0)
+        self.items = sorted(
+            [(MONDAY + timedelta(hours=int(h)), float(v)) for h, v in zip(
+                stream.randint(0, 40*24, size=200),
+                stream.randint(1, 10, size=200))] +
+            # on a day's boundary, and many done at once
+            [(MONDAY + 3*DAY, 7.), (MONDAY + 20*DAY, 2.),
+             (MONDAY + 20*DAY, 4.)], key=lambda x:x[0])
+        self.days = [MONDAY - DAY + n*DAY for n in range(50)]
+
+    def brute(self, day, window):
+        vals = [v for dt, v in self.items if day - window*DAY < dt <= day]
+        if not vals:
+            return (0, None, None)
+        return (len(vals), numpy.mean(vals), numpy.std(vals))
+
+    def test_windows(self):
+        days = numpy.array(self.days, dtype='datetime64[us]')
+        for window in (1, 7, 30):
+            sizes, means, stddevs = stats._trailing(self.items, days, window)
+            for i, day in enumerate(self.days):
+                size, mean, stddev = self.brute(day, window)
+                self.assertEqual(size, sizes[i])
+                if size:
+                    self.assertAlmostEqual(mean, means[i])
+                    self.assertAlmostEqual(stddev, stddevs[i])
+                else:
+                    self.assertTrue(numpy.isnan(means[i]))
+
+    def test_empty(self):
+        days = numpy.array(self.days[:3], dtype='datetime64[us]')
+        sizes, means, _ = stats._trailing([], days, 7)
+        self.assertEqual([0, 0, 0], sizes.tolist())
+        self.assertTrue(numpy.isnan(means).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+'''tests/test_sync.py -- tests for stackpm.sync
+
+   @author: Matthew Story <matt.story@axial.net>
+   @license: BSD 3-Clause (see LICENSE.txt)'''
+
+### STANDARD LIBRARY IMPORTS
+import unittest
+from datetime import datetime, date, time, timedelta
+
+### INTERNAL IMPORTS
+from stackpm import db, config, sync, estimates
+from stackpm.models import Sync, Task, Event, Holiday, Vacation, \
+                           Simulation
+from tests import MONDAY, DBTestCase, fake_link, iteration, task
+
+### GLOBALS
+DAY = timedelta(days=1)
+
+### EXPOSED CLASSES
+class TaskChangeWindowTest(DBTestCase):
+    '''Changes to a task re-run stats and simulations from the earliest date
+       they affect, see sync._log_task_change'''
+    def setUp(self):
+        super(TaskChangeWindowTest, self).setUp()
+        fake_link().load(iterations=[iteration('IT-1')],
+                         tasks=[task('T-1', iteration_ext_id='IT-1',
+                                     started_on=MONDAY + DAY,
+                                     dev_done_on=MONDAY + 3*DAY,
+                                     prod_done_on=MONDAY + 4*DAY)])
+        sync.sync_tasks()
+        self.task = Task.query.filter_by(ext_id='T-1').one()
+
+    def resync(self, **values):
+        '''Sync ``values`` to T-1, and return the task change log'''
+        log = sync._task_change_log()
+        sync._batch_sync(None, {'T-1': values}, Task, 'ext_id',
+                         task_changes=log)
+        return log
+
+    def test_changed(self):
+        self.assertEqual({}, sync._changed(self.task, {
+            'name': 'T-1', 'user': self.task.user,
+            'iteration': self.task.iteration}))
+        self.assertEqual({'effort_est': 'M'}, sync._changed(self.task, {
+            'effort_est': 'M', 'started_on': MONDAY + DAY}))
+
+    def test_date_change(self):
+        log = self.resync(dev_done_on=MONDAY + 5*DAY)
+        self.assertEqual({self.task.user_id: {'S': MONDAY + 3*DAY}},
+                         log['stats'])
+        self.assertEqual({self.task.iteration_id: MONDAY + 3*DAY},
+                         log['iterations'])
+        self.assertEqual(set(), log['unchanged'])
+
+    def test_estimate_change(self):
+        # stats from when the task was done, sims from when it was created
+        log = self.resync(effort_est='M')
+        self.assertEqual({self.task.user_id: {'S': MONDAY + 3*DAY,
+                                              'M': MONDAY + 3*DAY}},
+                         log['stats'])
+        self.assertEqual({self.task.iteration_id: MONDAY},
+                         log['iterations'])
+
+    def test_rank_change(self):
+        log = self.resync(rank=5, name='renamed')
+        self.assertEqual({}, log['stats'])
+        self.assertEqual({self.task.iteration_id:
+                              datetime.combine(date.today(), time())},
+                         log['iterations'])
+
+    def test_inert_change(self):
+        log = self.resync(name='renamed', updated_on=MONDAY + 7*DAY)
+        self.assertEqual({}, log['stats'])
+        self.assertEqual({}, log['iterations'])
+        self.assertEqual(set(['T-1']), log['unchanged'])
+        self.assertEqual('renamed', Task.query.get(self.task.id).name)
+
+    def test_unchanged(self):
+        log = self.resync(name='T-1', effort_est='S',
+                          dev_done_on=MONDAY + 3*DAY)
+        self.assertEqual({}, log['stats'])
+        self.assertEqual(set(['T-1']), log['unchanged'])
+
+    def test_days_off_change(self):
+        self.assertEqual(3, self.task.dev_done_workdays)
+        db.session.add(Holiday(date=MONDAY + 2*DAY))
+        db.session.commit()
+        sync._reset_days_off()
+
+        log = sync._update_task_net_workdays(MONDAY + 2*DAY)
+        self.assertEqual({self.task.user_id: {'S': MONDAY + 2*DAY}},
+                         log['stats'])
+        self.assertEqual({self.task.iteration_id: MONDAY + 2*DAY},
+                         log['iterations'])
+        self.assertEqual(2, Task.query.get(self.task.id).dev_done_workdays)
+
+    def test_days_off_outside_task(self):
+        log = sync._update_task_net_workdays(MONDAY + 7*DAY)
+        self.assertEqual({}, log['stats'])
+        self.assertEqual({}, log['iterations'])
+
+class ContentHashTest(DBTestCase):
+    '''Tasks whose content hash is unchanged are skipped by the link, and
+       hashes are written only once stats and simulations are updated'''
+    def setUp(self):
+        super(ContentHashTest, self).setUp()
+        fake_link().load(tasks=[task('T-1', content_hash='h1',
+                                     started_on=MONDAY)])
+
+    def test_skip(self):
+        sync.sync_tasks()
+        self.assertEqual('h1', Task.query.one().content_hash)
+
+        fake_link().calls = []
+        record = sync.sync_tasks()
+        self.assertEqual([('tasks', MONDAY, sync.null, {'T-1': 'h1'})],
+                         fake_link().calls)
+        self.assertEqual(0, record.notes['skipped'])
+
+    def test_hash_change(self):
+        sync.sync_tasks()
+        fake_link().items['tasks'][0]['content_hash'] = 'h2'
+        record = sync.sync_tasks()
+        self.assertEqual(1, record.notes['skipped'])
+        self.assertEqual('h2', Task.query.one().content_hash)
+
+    def test_failed_sync(self):
+        def fail(task_log):
+            raise RuntimeError('failed')
+        update, sync._update_stats_and_sims = sync._update_stats_and_sims, \
+                                              fail
+        try:
+            self.assertRaises(RuntimeError, sync.sync_tasks)
+        finally:
+            sync._update_stats_and_sims = update
+        self.assertEqual(None, Task.query.one().content_hash)
+
+        fake_link().calls = []
+        sync.sync_tasks()
+        self.assertEqual({}, fake_link().calls[0][3])
+        self.assertEqual('h1', Task.query.one().content_hash)
+
+class CalendarSyncTest(DBTestCase):
+    '''Holidays and vacations are synced by set difference, see
+       sync.sync_holidays and sync.sync_vacations'''
+    def setUp(self):
+        super(CalendarSyncTest, self).setUp()
+        fake_link().load(tasks=[task('T-1', started_on=MONDAY,
+                                     dev_done_on=MONDAY + 4*DAY)])
+        sync.sync_tasks()
+
+    def vacation(self, day, email='dev@example.com'):
+        return {'date': day, 'user': {'email': email, 'pm_name': None}}
+
+    def test_holidays(self):
+        fake_link().load(holidays=[{'date': MONDAY + DAY},
+                                   {'date': MONDAY + 2*DAY}])
+        record = sync.sync_holidays()
+        self.assertEqual((2, 0), (record.notes['inserted'],
+                                  record.notes['deleted']))
+        self.assertEqual(3, Task.query.one().dev_done_workdays)
+
+        fake_link().load(holidays=[{'date': MONDAY + 2*DAY},
+                                   {'date': MONDAY + 7*DAY}])
+        record = sync.sync_holidays()
+        self.assertEqual((1, 1), (record.notes['inserted'],
+                                  record.notes['deleted']))
+        self.assertEqual(set([MONDAY + 2*DAY, MONDAY + 7*DAY]),
+                         set([h.date for h in Holiday.query.all()]))
+        self.assertEqual(4, Task.query.one().dev_done_workdays)
+
+        record = sync.sync_holidays()
+        self.assertEqual((0, 0), (record.notes['inserted'],
+                                  record.notes['deleted']))
+
+    def test_vacations(self):
+        fake_link().load(vacations=[
+            self.vacation(MONDAY + DAY),
+            self.vacation(MONDAY + DAY, 'other@example.com')])
+        record = sync.sync_vacations()
+        self.assertEqual((2, 0), (record.notes['inserted'],
+                                  record.notes['deleted']))
+        self.assertEqual(4, Task.query.one().dev_done_workdays)
+
+        # only the vacations of the user synced are diffed
+        fake_link().load(vacations=[self.vacation(MONDAY + 3*DAY)])
+        record = sync.sync_vacations(email='dev@example.com')
+        self.assertEqual((1, 1), (record.notes['inserted'],
+                                  record.notes['deleted']))
+        self.assertEqual(set([(MONDAY + 3*DAY, 'dev@example.com'),
+                              (MONDAY + DAY, 'other@example.com')]),
+                         set([(v.date, v.user.email)
+                                  for v in Vacation.query.all()]))
+        self.assertEqual(4, Task.query.one().dev_done_workdays)
+
+class SyncSourcesTest(DBTestCase):
+    '''Sources are fetched in a pool, and synced by the calling thread, see
+       sync.sync_sources'''
+    def setUp(self):
+        super(SyncSourcesTest, self).setUp()
+        fake_link().load(iterations=[iteration('IT-1')],
+                         tasks=[task('T-1', iteration_ext_id='IT-1',
+                                     started_on=MONDAY)])
+        self.instrument = config.get('instrument', {})
+
+    def tearDown(self):
+        config['instrument'] = self.instrument
+        super(SyncSourcesTest, self).tearDown()
+
+    def test_idle(self):
+        self.assertEqual(['iteration', 'task'],
+                         [r.type for r in sync.sync_sources()])
+        self.assertEqual(1, Task.query.one().iteration.id)
+
+        # re-fetching what is unchanged, at the cursor, records nothing
+        self.assertEqual([], sync.sync_sources())
+        self.assertEqual(2, Sync.query.count())
+
+        fake_link().items['tasks'][0].update(effort_est='M',
+                                             updated_on=MONDAY + DAY)
+        self.assertEqual(['task'], [r.type for r in sync.sync_sources()])
+
+    def test_instrument(self):
+        config['instrument'] = {'enabled': True}
+        record = sync.sync_sources()[-1]
+        summary = record.notes['instrument']
+        self.assertEqual(2, summary['counters']['rows_fetched'])
+        self.assertEqual(1, summary['spans']['sync_sources/fetch']['calls'])
+        self.assertEqual(2, summary['spans']['sync_sources/fetch']\
+                                           ['rows_fetched'])
+
+class BackfillTest(DBTestCase):
+    '''Exported items are synced through the batched task path, and tasks
+       are linked to epics exported after them, see sync.sync_backfill'''
+    def test_backfill(self):
+        record = sync.sync_backfill([
+            ('task', task('T-1', iteration_ext_id='IT-1')),
+            ('task', task('T-2', email='other@example.com')),
+            ('iteration', iteration('IT-1'))])
+        self.assertEqual('backfill', record.type)
+        self.assertEqual(None, sync._sync_since('task'))
+        self.assertEqual([('T-1', 'IT-1'), ('T-2', None)],
+                         [(t.ext_id, t.iteration and t.iteration.ext_id)
+                              for t in Task.query.order_by(Task.ext_id)])
+        # the iteration wasn't fetched from the link
+        self.assertEqual([], fake_link().calls)
+
+class OutlierTest(DBTestCase):
+    '''Tasks taking longer than usual are flagged with an outlier event,
+       once, however thresholds move, see sync._outlier_events'''
+    def done(self, prefix, workdays, updated_on=MONDAY):
+        '''Return 8 done tasks, taking ``workdays`` to dev done'''
+        return [task('{}-{}'.format(prefix, i), updated_on=updated_on,
+                     started_on=MONDAY + i*DAY,
+                     dev_done_on=MONDAY + (i + workdays)*DAY,
+                     prod_done_on=MONDAY + (i + workdays + 1)*DAY)
+                    for i in range(8)]
+
+    def outliers(self, ext_id):
+        return [e.occured_on for e in Event.query.filter_by(type='outlier')
+                    if e.task.ext_id == ext_id]
+
+    def sync(self, tasks, stats=False):
+        fake_link().load(tasks=tasks)
+        sync.sync_tasks()
+        if stats:
+            sync.sync_stats()
+
+    def test_once(self):
+        quick = self.done('Q', 1)
+        self.sync(quick, stats=True)
+        self.sync(quick + [task('O-1', started_on=MONDAY,
+                                updated_on=MONDAY + DAY)])
+        flagged = self.outliers('O-1')
+        self.assertEqual(1, len(flagged))
+
+        # slower tasks move the thresholds, O-1 is still flagged once
+        slow = self.done('S', 3, updated_on=MONDAY + 2*DAY)
+        self.sync(quick + slow + [task('O-1', started_on=MONDAY,
+                                       updated_on=MONDAY + 3*DAY)],
+                  stats=True)
+        self.sync(quick + slow + [task('O-1', name='renamed',
+                                       started_on=MONDAY,
+                                       updated_on=MONDAY + 4*DAY)])
+        self.assertEqual(flagged, self.outliers('O-1'))
+
+class SimulationSyncTest(DBTestCase):
+    '''Syncs re-simulate at most [forecast] history days, and reuse stored
+       simulations run with another random seed'''
+    def setUp(self):
+        super(SimulationSyncTest, self).setUp()
+        self.forecast = config['forecast']
+        config['forecast'] = dict(self.forecast, history=3)
+        fake_link().load(iterations=[iteration('IT-1')],
+                         tasks=[task('T-1', iteration_ext_id='IT-1')])
+        sync.sync_tasks()
+        self.today = datetime.combine(date.today(), time())
+
+    def tearDown(self):
+        config['forecast'] = self.forecast
+        super(SimulationSyncTest, self).tearDown()
+
+    def test_history(self):
+        # rather than every day since T-1 was created
+        self.assertEqual([self.today - n*DAY for n in (3, 2, 1, 0)],
+                         [s.simulation_on for s in Simulation.query.order_by(
+                              Simulation.simulation_on)])
+
+    def test_random_seed(self):
+        config['forecast'] = dict(self.forecast, seed=None, history=3)
+        sync.sync_simulations(since=MONDAY)
+        notes = sync.sync_simulations(since=MONDAY, record=False)
+        self.assertEqual((4, 0), (notes['simulations']['hits'],
+                                  notes['simulations']['misses']))
+
+        # a pinned seed is an input, as any other
+        config['forecast'] = dict(self.forecast, seed=1, history=3)
+        notes = sync.sync_simulations(since=MONDAY, record=False)
+        self.assertEqual((0, 4), (notes['simulations']['hits'],
+                                  notes['simulations']['misses']))
+
+class DaysOffTest(DBTestCase):
+    '''Days off are cached until holidays or vacations are next synced, see
+       sync._days_off'''
+    def test_stats(self):
+        fake_link().load(tasks=[task('T-1', started_on=MONDAY)])
+        sync.sync_tasks()
+        key = sync._CALENDAR['key']
+        self.assertEqual('stat', sync.sync_stats().type)
+        sync._days_off([])
+        self.assertEqual(key, sync._CALENDAR['key'])
+
+class EstimateIndexTest(DBTestCase):
+    '''The estimates index follows every committed ORM write, see
+       estimates.reindex'''
+    def setUp(self):
+        super(EstimateIndexTest, self).setUp()
+        fake_link().load(tasks=[task('T-1'), task('T-2', effort_est='M')])
+        sync.sync_tasks()
+        self.assertEqual(['M', 'S'], estimates.task_efforts())
+
+    def test_writes(self):
+        # written outside of sync, recording no Sync
+        Task.query.filter_by(ext_id='T-1').one().effort_est = 'L'
+        db.session.commit()
+        self.assertEqual(['L', 'M'], estimates.task_efforts())
+
+        db.session.delete(Task.query.filter_by(ext_id='T-2').one())
+        db.session.commit()
+        self.assertEqual(['L'], estimates.task_efforts())
+
+        # rolled back, after a flush
+        Task.query.one().effort_est = 'XL'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(['L'], estimates.task_efforts())
+
+if __name__ == '__main__':
+    unittest.main()